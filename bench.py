@@ -0,0 +1,540 @@
+#!/usr/bin/python
+'''
+Benchmarks for md.py
+====================
+
+Usage:
+
+    python bench.py [--size N ...] [--json] [-o FILE] [benchmark ...]
+
+Runs the given benchmarks (all of them, if none is given) and prints
+the timings as a table or, with --json, as a JSON object suitable for
+tracking regressions across versions.
+
+Benchmarks
+----------
+
+   macros   -- compares applying the macros one after another with
+               the single pass expansion for 10, 100 and 1000 macros
+   defs     -- compares matching the blocks of the generated documents
+               against the start and end patterns of definition blocks
+               (see mdx_defs) with the prefiltered matching, and times
+               parsing the documents into blocks
+   nesting  -- parses tests/nested.tmd and generated proofs with claims
+               nested 10, 100, 400 and 2000 levels deep, checking the
+               nesting of the resulting definition blocks
+   incremental -- times re-rendering the generated documents after
+               editing a paragraph of one top-level section, from
+               scratch and with the sections of the previous version
+               cached (see md.render_incremental), checking that the
+               outputs are identical
+   pipeline -- times each stage of md.py on a synthetic document
+               (see generate_document) with --size top-level sections
+
+Each pipeline run happens in a fresh process so that the reported
+peak memory (the maximal resident set size) belongs to that run only.
+
+'''
+
+import argparse
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import sys
+import time
+
+import lxml.etree
+import markdown
+
+import mdx_macros
+
+logger = logging.getLogger(__name__)
+
+
+def best_of(func, repeat=3):
+    """ Returns the result of @func and the best time of @repeat runs """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time()-start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def peak_memory():
+    """ Returns the maximal resident set size of this process in kilobytes """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+    return rss
+
+
+def macro_document(count, calls=20000, seed=0):
+    """ Returns an Abbreviations block defining @count macros (with
+        zero, one and two arguments, some of them optional) and
+        a document containing @calls calls of these macros """
+    rnd = random.Random(seed)
+    defs = []
+    uses = []
+    for i in range(count):
+        name = 'm'+str(i)+'x'
+        kind = i % 3
+        if kind == 0:
+            defs.append('\\'+name+' = {\\mathcal{M}_{'+str(i)+'}};')
+            uses.append('\\'+name)
+        elif kind == 1:
+            defs.append('\\'+name+'(x) = {\\langle x \\rangle_{'+str(i)+'}};')
+            uses.append('\\'+name+'(a_'+str(i)+')')
+        else:
+            defs.append('\\'+name+'(x,y=1) = {\\|x\\|_{y}};')
+            uses.append('\\'+name+'({f,g})')
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', '$x$', '\\alpha', 'where']
+    text = []
+    for i in range(calls):
+        text.append(rnd.choice(words))
+        text.append(' $'+rnd.choice(uses)+'$ ')
+        if i % 15 == 14:
+            text.append('\n\n')
+    block = '=== Abbreviations ===\n'+'\n'.join(defs)+'\n\n=== Abbreviations ===\n'
+    return block+''.join(text)
+
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit',
+         'sed', 'do', 'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore',
+         'magna', 'aliqua', 'every', 'set', 'is', 'measurable', 'and', 'bounded', '*dense*', '**closed**']
+MATH = ['$\\R^n$', '$\\norm(x)$', '$\\ip(u,v)$', '$\\ip(\\norm(x))$', '$x_{i+1} \\leq \\epsilon$',
+        '$\\sum_{k=0}^\\infty a_k$', '$f\\colon \\R \\to \\R$']
+BLOCKS = ['Theorem', 'Lemma', 'Proposition', 'Definition', 'Example', 'Observation']
+BIB_KEYS = ['Balcar', 'Dow', 'Jech', 'Kunen']
+
+
+class DocumentGenerator(object):
+    def __init__(self, seed):
+        self.rnd = random.Random(seed)
+        self.labels = []
+        self.next_label = 0
+
+    def sentence(self):
+        words = []
+        for i in range(self.rnd.randint(6, 16)):
+            r = self.rnd.random()
+            if r < 0.12:
+                words.append(self.rnd.choice(MATH))
+            elif r < 0.15 and self.labels:
+                words.append('{ref:#'+self.rnd.choice(self.labels)+'}')
+            elif r < 0.17:
+                words.append('{bib:'+self.rnd.choice(BIB_KEYS)+'}')
+            else:
+                words.append(self.rnd.choice(WORDS))
+        text = ' '.join(words)
+        # A block starting with '{ref:...' would be a nested definition block
+        if text.startswith('{'):
+            text = 'see '+text
+        return text[0].upper()+text[1:]+'.'
+
+    def paragraph(self):
+        return ' '.join([ self.sentence() for i in range(self.rnd.randint(2, 5)) ])
+
+    def label(self):
+        label = 'l'+str(self.next_label)
+        self.next_label += 1
+        return label
+
+    def block(self, out):
+        """ Appends a numbered block followed by a proof (possibly
+            containing nested claims with proofs) to the list @out """
+        label = self.label()
+        out.append(self.rnd.choice(BLOCKS)+': '+self.paragraph()+' {#'+label+'}\n')
+        if self.rnd.random() < 0.3:
+            out.append('\n'+self.paragraph()+'\n')
+        out.append('{}\n\n')
+        out.append('Proof: '+self.paragraph()+'\n\n')
+        if self.rnd.random() < 0.4:
+            out.append('Claim: '+self.sentence()+' {#'+self.label()+'}\n{}\n\n')
+            out.append('Proof: '+self.paragraph()+'\n{}\n\n')
+        out.append(self.paragraph()+'\n{}\n\n')
+        self.labels.append(label)
+
+    def section(self, out, level, number, max_level):
+        label = self.label()
+        out.append('#'*level+' Section '+number+' '+'#'*level+' {#'+label+'}\n\n')
+        self.labels.append(label)
+        for i in range(self.rnd.randint(1, 3)):
+            out.append(self.paragraph()+'\n\n')
+            self.block(out)
+        if self.rnd.random() < 0.3:
+            for i in range(self.rnd.randint(2, 4)):
+                out.append('* '+self.sentence()+'\n')
+            out.append('\n')
+        if level < max_level:
+            for i in range(self.rnd.randint(1, 3)):
+                self.section(out, level+1, number+'.'+str(i+1), max_level)
+
+
+# The macros defined by generate_document
+GENERATED_MACROS = ['\\R = {\\mathbb{R}};',
+                    '\\norm(x) = {\\|x\\|};',
+                    '\\ip(x,y=x) = {\\langle x, y \\rangle};']
+
+
+def generate_document(size, seed=0, depth=4):
+    """ Returns a synthetic TMD document with @size top-level sections,
+        each having subsections nested up to @depth levels. The
+        document uses macros, MathJax, numbered blocks with nested
+        proofs and claims, labels with references to them and
+        bibliography citations. """
+    gen = DocumentGenerator(seed)
+    # The last definition must be followed by a blank line to be parsed
+    out = ['Title: Benchmark\n\n',
+           '=== Abbreviations ===\n',
+           '\n'.join(GENERATED_MACROS)+'\n\n',
+           '=== Abbreviations ===\n\n']
+    for i in range(size):
+        gen.section(out, 1, str(i+1), depth)
+    return ''.join(out)
+
+
+def document_macros(document):
+    """ Returns the list of the macros defined in the Abbreviations
+        block of @document """
+    m = mdx_macros.ABBREVS_RE.search(document)
+    return mdx_macros.parse_macros(m.group('abbrevs')) if m else []
+
+
+def bench_macros(options):
+    """ Compares applying the macros one after another with the
+        single pass expansion for different numbers of macros """
+    results = []
+    for count in (10, 100, 1000):
+        document = macro_document(count)
+        macros = document_macros(document)
+        assert len(macros) == count, 'parsed '+str(len(macros))+' of '+str(count)+' macros'
+        body = mdx_macros.ABBREVS_RE.sub('\n\n', document)
+        repeat = 1 if count >= 1000 else options.repeat
+        old, old_time = best_of(lambda: mdx_macros.apply_sequentially(macros, body), repeat)
+        new, new_time = best_of(lambda: mdx_macros.MacroExpander(macros).expand(body), repeat)
+        if old != new:
+            logger.error('The outputs differ for '+str(count)+' macros')
+        results.append({
+            'benchmark':'macros',
+            'macros':count,
+            'bytes':len(body),
+            'sequential':old_time,
+            'single_pass':new_time,
+            'identical':old == new
+        })
+    return results
+
+
+def _match_blocks_regex(blocks):
+    """ Matches the @blocks the way DefinitionBlockProcessor used to:
+        START_RE in test and again in run, END_RE in test and run """
+    from mdx_defs import DefinitionBlockProcessor
+    ret = []
+    for block in blocks:
+        m = DefinitionBlockProcessor.START_RE.match(block)
+        if m and DefinitionBlockProcessor._valid_type(m.group('type'), m.groupdict()):
+            ret.append(DefinitionBlockProcessor.START_RE.match(block).group('type'))
+        elif DefinitionBlockProcessor.END_RE.match(block):
+            ret.append(DefinitionBlockProcessor.END_RE.match(block).group(1))
+        else:
+            ret.append(None)
+    return ret
+
+
+def _match_blocks(blocks):
+    from mdx_defs import DefinitionBlockProcessor
+    ret = []
+    for block in blocks:
+        m = DefinitionBlockProcessor.match_start(block)
+        if m:
+            ret.append(m.group('type'))
+        else:
+            ret.append(DefinitionBlockProcessor.match_end(block))
+    return ret
+
+
+def nested_document(depth, width=3):
+    """ Returns a document with @width proofs, each containing a claim
+        with a proof containing a claim ... @depth levels deep """
+    out = ['Nested proofs\n\n']
+    for i in range(width):
+        for level in range(depth):
+            out.append('Claim: Level '+str(level)+' {#c'+str(i)+'_'+str(level)+'}\n{}\n\n')
+            out.append('Proof: of {ref:#c'+str(i)+'_'+str(level)+'}\n\n')
+        out.append('The innermost argument.\n\n')
+        out.append('{}\n\n'*depth)
+    return ''.join(out)
+
+
+def _block_depth(element):
+    """ Returns the maximal nesting of definition blocks in @element """
+    ret = 0
+    stack = [(element, 0)]
+    while stack:
+        element, depth = stack.pop()
+        if 'block' in (element.get('class') or '').split(' '):
+            depth += 1
+            ret = max(ret, depth)
+        stack.extend([ (child, depth) for child in element ])
+    return ret
+
+
+def bench_nesting(options):
+    """ Times the block parsing of documents with deeply nested definition blocks """
+    import md
+    results = []
+    documents = [('tests/nested.tmd', open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'nested.tmd')).read(), 2)]
+    for depth in (10, 100, 400, 2000):
+        documents.append(('nested '+str(depth), nested_document(depth), depth))
+    for (name, doc, depth) in documents:
+        doc = doc.decode('utf-8')
+        renderer = md.get_renderer()
+        def parse():
+            renderer.reset()
+            lines = doc.split('\n')
+            for prep in renderer.preprocessors.values():
+                lines = prep.run(lines)
+            return renderer.parser.parseDocument(lines).getroot()
+        root, elapsed = best_of(parse, options.repeat)
+        blocks = doc.count('\n\n')
+        results.append({
+            'benchmark':'nesting',
+            'document':name,
+            'depth':_block_depth(root),
+            'expected_depth':depth,
+            'blocks':blocks,
+            'parse':elapsed,
+            'per_block':elapsed/blocks
+        })
+    return results
+
+
+def bench_defs(options):
+    """ Compares the regex and the prefiltered matching of definition
+        blocks and times the block parsing of generated documents """
+    import md
+    results = []
+    for size in options.size:
+        doc = mdx_macros.pre_process(generate_document(size, options.seed).decode('utf-8'))
+        blocks = doc.split('\n\n')
+        old, old_time = best_of(lambda: _match_blocks_regex(blocks), options.repeat)
+        new, new_time = best_of(lambda: _match_blocks(blocks), options.repeat)
+        if old != new:
+            logger.error('The matches differ for size '+str(size))
+        renderer = md.get_renderer()
+        def parse():
+            renderer.reset()
+            lines = doc.split('\n')
+            for prep in renderer.preprocessors.values():
+                lines = prep.run(lines)
+            return renderer.parser.parseDocument(lines)
+        # The generated documents are not meant to be warning-free
+        level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.CRITICAL)
+        try:
+            parse_time = best_of(parse, options.repeat)[1]
+        finally:
+            logging.getLogger().setLevel(level)
+        results.append({
+            'benchmark':'defs',
+            'size':size,
+            'blocks':len(blocks),
+            'regex':old_time,
+            'prefiltered':new_time,
+            'parse':parse_time,
+            'identical':old == new
+        })
+    return results
+
+
+def edit_document(doc, text):
+    """ Returns @doc with the paragraph @text inserted after the heading
+        of its middle top-level section """
+    headings = [ m.start() for m in re.finditer(r'\n# ', doc) ]
+    pos = doc.index('\n\n', headings[len(headings)//2])+2
+    return doc[:pos]+text+'\n\n'+doc[pos:]
+
+
+def bench_incremental(options):
+    """ Compares the edit-to-output latency of converting the whole
+        document and of converting only the edited section """
+    import chunks
+    import md
+    from postprocess import build_sections
+
+    def render(doc, sections):
+        tree = md.render_md(doc, tree='lxml', sections=sections)[1]
+        return lxml.etree.tostring(build_sections(tree))
+
+    results = []
+    level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.CRITICAL)
+    try:
+        for size in options.size:
+            source = generate_document(size, options.seed).decode('utf-8')
+            sections = chunks.SectionCache()
+            render(source, sections)
+            # Each run edits the document differently, so that the
+            # edited section is never in the cache
+            edits = [0]
+            def edited():
+                edits[0] += 1
+                return edit_document(source, u'Edited paragraph '+str(edits[0])+'.')
+            full_time = best_of(lambda: render(edited(), None), options.repeat)[1]
+            misses = sections.misses
+            incremental_time = best_of(lambda: render(edited(), sections), options.repeat)[1]
+            converted = (sections.misses-misses)/float(options.repeat)
+            doc = edited()
+            results.append({
+                'benchmark':'incremental',
+                'size':size,
+                'bytes':len(source.encode('utf-8')),
+                'sections':len(chunks.split_document(mdx_macros.pre_process(source), min_size=0) or []),
+                'converted':converted,
+                'full':full_time,
+                'incremental':incremental_time,
+                'identical':render(doc, None) == render(doc, sections)
+            })
+    finally:
+        logging.getLogger().setLevel(level)
+    return results
+
+
+def _run_pipeline(size, seed, repeat, selector):
+    """ Times the stages of md.py on a generated document with @size
+        sections and returns the result dict (run in a fresh process) """
+    import md
+    from mdx_defs import build_headings
+    from mdx_tolatex import laTeXRenderer
+    from postprocess import build_sections
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    source = generate_document(size, seed).decode('utf-8')
+    macros = document_macros(source)
+    assert len(macros) == len(GENERATED_MACROS), 'parsed '+str(len(macros))+' of '+str(len(GENERATED_MACROS))+' macros'
+    template = md.load_template(None, 'html') or u'{{ content }}'
+    stages = {}
+
+    def stage(name, func):
+        result, elapsed = best_of(func, repeat)
+        stages[name] = elapsed
+        return result
+
+    doc = stage('pre_process', lambda: mdx_macros.pre_process(source))
+    renderer = md.get_renderer()
+    def convert():
+        renderer.reset()
+        return renderer.convert(doc)
+    html = stage('convert', convert)
+    stage('parse_html', lambda: md.parse_html(html, 'lxml'))
+    stage('build_sections', lambda: build_sections(md.parse_html(html, 'lxml')))
+    tree = build_sections(md.parse_html(html, 'lxml'))
+    stage('query', lambda: md.query(selector, tree))
+    stage('filter', lambda: md.filter(selector, copy.deepcopy(tree)))
+    html_tree = md.html_document([copy.deepcopy(tree)])
+    stage('headings', lambda: build_headings(html_tree, position='after', format='css'))
+    stage('latex', lambda: laTeXRenderer({}).render_from_dom(html_tree))
+    content = lxml.etree.tostring(tree, method='html', encoding='unicode')
+    stage('render_template', lambda: md.render_template(template, {'content':content, 'toc':u'', 'headings_css':u''}))
+
+    return {
+        'benchmark':'pipeline',
+        'size':size,
+        'bytes':len(source.encode('utf-8')),
+        'stages':stages,
+        'total':sum(stages.values()),
+        'peak_memory_kb':peak_memory()
+    }
+
+
+def bench_pipeline(options):
+    """ Times the stages of md.py on synthetic documents of the given sizes """
+    results = []
+    for size in options.size:
+        # A fresh process for each size, so that the peak memory is meaningful
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            result = pool.apply(_run_pipeline, (size, options.seed, options.repeat, options.selector))
+        finally:
+            pool.close()
+            pool.join()
+        result['throughput'] = result['bytes']/result['total'] if result['total'] else None
+        results.append(result)
+    return results
+
+
+BENCHMARKS = {
+    'defs':bench_defs,
+    'incremental':bench_incremental,
+    'macros':bench_macros,
+    'nesting':bench_nesting,
+    'pipeline':bench_pipeline,
+}
+
+
+def print_table(results):
+    for r in results:
+        if r['benchmark'] == 'macros':
+            print('macros %5d  sequential %8.3fs  single pass %8.3fs  speedup %6.1fx  %s' % (
+                r['macros'], r['sequential'], r['single_pass'], r['sequential']/max(r['single_pass'], 1e-9),
+                'identical' if r['identical'] else 'DIFFERENT'))
+        elif r['benchmark'] == 'defs':
+            print('defs size %d (%d blocks)  regex %8.4fs  prefiltered %8.4fs  speedup %6.1fx  block parsing %8.4fs  %s' % (
+                r['size'], r['blocks'], r['regex'], r['prefiltered'], r['regex']/max(r['prefiltered'], 1e-9), r['parse'],
+                'identical' if r['identical'] else 'DIFFERENT'))
+        elif r['benchmark'] == 'nesting':
+            print('nesting %-16s depth %5d%s  %6d blocks  parse %8.4fs  %6.1fus per block' % (
+                r['document'], r['depth'], '' if r['depth'] == r['expected_depth'] else ' (expected '+str(r['expected_depth'])+')',
+                r['blocks'], r['parse'], 1e6*r['per_block']))
+        elif r['benchmark'] == 'incremental':
+            print('incremental size %d (%d bytes, %d sections)  full %8.4fs  incremental %8.4fs (%.1f sections converted)  speedup %6.1fx  %s' % (
+                r['size'], r['bytes'], r['sections'], r['full'], r['incremental'], r['converted'], r['full']/max(r['incremental'], 1e-9),
+                'identical' if r['identical'] else 'DIFFERENT'))
+        elif r['benchmark'] == 'pipeline':
+            print('pipeline size %d (%d bytes): %.3fs, %.1f kB/s, peak memory %d kB' % (
+                r['size'], r['bytes'], r['total'], (r['throughput'] or 0)/1024.0, r['peak_memory_kb']))
+            for (name, elapsed) in sorted(r['stages'].items(), key=lambda x: -x[1]):
+                print('    %-16s %8.4fs %5.1f%%' % (name, elapsed, 100*elapsed/max(r['total'], 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for md.py')
+    parser.add_argument('benchmarks', nargs='*', choices=sorted(BENCHMARKS.keys())+[[]], help='the benchmarks to run (default: all)')
+    parser.add_argument('--size', type=int, nargs='+', help='the numbers of top-level sections of the generated documents', default=[2, 5, 10])
+    parser.add_argument('--seed', type=int, help='the seed of the document generator', default=0)
+    parser.add_argument('--repeat', type=int, help='the number of runs of which the best time is taken', default=3)
+    parser.add_argument('--selector', help='the css selector used by the filter and query stages', default='.Theorem')
+    parser.add_argument('--json', action='store_true', help='output the results as JSON', default=False)
+    parser.add_argument('-o', '--output', help='write the results to this file instead of the standard output')
+    args = parser.parse_args()
+    logging.basicConfig()
+    results = []
+    for name in args.benchmarks or sorted(BENCHMARKS.keys()):
+        results.extend(BENCHMARKS[name](args))
+    out = open(args.output, 'w') if args.output else sys.stdout
+    if args.json:
+        json.dump({
+            'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python':platform.python_version(),
+            'markdown':getattr(markdown, 'version', ''),
+            'results':results
+        }, out, indent=2, sort_keys=True)
+        out.write('\n')
+    else:
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            print_table(results)
+        finally:
+            sys.stdout = stdout
+
+if __name__ == "__main__":
+    main()
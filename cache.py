@@ -0,0 +1,199 @@
+'''
+On-disk render cache
+====================
+
+Stores rendered documents under the hash of everything the output
+depends on (see md.cache_key). Each entry is a file whose first line
+is a JSON header listing the files whose existence influenced the
+output (e.g. the .pdf versions of images used by the LaTeX renderer)
+followed by the utf-8 encoded output. An entry is only used if the
+listed files are still (not) there.
+
+When the total size of the entries exceeds the limit, the least
+recently used ones (by modification time, which is updated on each
+hit) are removed. The total size is computed once (by listing the
+cache directory) and then kept up to date by the stores, so that
+the directory is only listed again when entries must be removed.
+
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+logger =  logging.getLogger(__name__)
+
+
+def default_directory():
+    base = os.environ.get('XDG_CACHE_HOME', None) or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'md')
+
+
+def hash_strings(strings):
+    """ Returns the hex digest of the sha1 hash of the (unicode) @strings """
+    h = hashlib.sha1()
+    for s in strings:
+        if s is None:
+            s = u''
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8')
+        # Include the lengths so that different splits give different hashes
+        h.update(str(len(s)).encode('ascii')+b':')
+        h.update(s)
+    return h.hexdigest()
+
+
+class RenderCache(object):
+    def __init__(self, directory=None, max_size=256*1024*1024):
+        self.directory = directory or default_directory()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # The total size of the entries (None until computed, see total_size)
+        self.size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _open(self, key):
+        """ Returns the open entry stored under @key positioned after
+            its header or None if there is no (fresh) entry """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        try:
+            header = json.loads(f.readline().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            f.close()
+            self.misses += 1
+            return None
+        for (fname, exists) in header.get('dependencies', {}).items():
+            if os.path.exists(fname) != exists:
+                logger.debug('Cache entry '+key+' is stale ('+fname+')')
+                f.close()
+                self.misses += 1
+                return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return f
+
+    def get(self, key):
+        """ Returns the output stored under @key or None if there is none """
+        f = self._open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read().decode('utf-8')
+
+    def copy_to(self, key, out):
+        """ Copies the (utf-8 encoded) output stored under @key to
+            the file object @out. Returns False if there is none. """
+        f = self._open(key)
+        if f is None:
+            return False
+        with f:
+            shutil.copyfileobj(f, out)
+        return True
+
+    def _store(self, key, dependencies, write):
+        path = self._path(key)
+        total = self.total_size()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            header = json.dumps({'dependencies':dependencies or {}})
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header.encode('utf-8')+b'\n')
+                write(f)
+                size = f.tell()
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            # Renaming is atomic, so concurrent readers never see partial entries
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logger.warn('Could not write cache entry '+path+' ('+str(e)+')')
+            return
+        self.size = total+size-replaced
+        if self.size > self.max_size:
+            self.evict()
+
+    def put(self, key, output, dependencies=None):
+        """ Stores @output under @key. The @dependencies map filenames
+            to whether they existed when the output was rendered. """
+        self._store(key, dependencies, lambda f: f.write(output.encode('utf-8')))
+
+    def put_file(self, key, fname, dependencies=None):
+        """ Stores the contents of the file @fname (the utf-8 encoded
+            output) under @key without reading it into memory """
+        def copy(f):
+            with open(fname, 'rb') as src:
+                shutil.copyfileobj(src, f)
+        self._store(key, dependencies, copy)
+
+    def entries(self):
+        """ Returns a list of (mtime, size, path) triples describing the entries """
+        ret = []
+        if not os.path.isdir(self.directory):
+            return ret
+        for subdir in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir):
+                continue
+            for fname in os.listdir(subdir):
+                path = os.path.join(subdir, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                ret.append((st.st_mtime, st.st_size, path))
+        return ret
+
+    def total_size(self):
+        """ Returns the total size of the entries, listing the cache
+            directory only the first time """
+        if self.size is None:
+            self.size = sum([ size for (mtime, size, path) in self.entries() ])
+        return self.size
+
+    def evict(self):
+        """ Removes the least recently used entries until the
+            total size of the cache is below max_size """
+        # Other processes may have changed the cache, so list it again
+        entries = self.entries()
+        total = sum([ size for (mtime, size, path) in entries ])
+        if total > self.max_size:
+            for (mtime, size, path) in sorted(entries):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+                if total <= self.max_size:
+                    break
+        self.size = total
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self.size = 0
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'entries':len(entries),
+            'size':sum([ size for (mtime, size, path) in entries ])
+        }
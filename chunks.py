@@ -0,0 +1,390 @@
+'''
+Chunked rendering of large documents
+====================================
+
+A (macro expanded) document is split into chunks at its top-level
+(`# ...`) headings which can be converted by separate markdown
+instances (see md.render_parallel) and the resulting trees are
+merged into the tree a single conversion of the whole document
+would produce.
+
+A heading only starts a new chunk if it is preceded by a blank line
+and it is not inside a fenced code block, a raw html block or a
+definition block. Documents using footnotes or abbreviations (whose
+definitions apply to the whole document) are not split. The metadata
+and the link reference definitions are repeated in each chunk.
+
+Most of the document-wide state is reproduced by starting the section
+numbering of each chunk at the number of top-level sections before it,
+which is predicted by split_document (the chunks whose prediction
+turns out to be wrong are converted again, see check_offsets). The
+rest is fixed when merging the chunks:
+
+   - references to labels defined in other chunks are resolved,
+   - the ids of the headings are made unique across chunks,
+   - the tables of contents are merged.
+
+The results of converting the chunks can be kept in a SectionCache,
+so that re-rendering an edited document only converts the top-level
+sections which changed (see md.render_incremental).
+
+'''
+
+import collections
+import logging
+import re
+
+import lxml.etree
+from markdown.extensions.headerid import unique
+from markdown.extensions.meta import BEGIN_RE, END_RE, META_MORE_RE, META_RE
+from markdown.util import isBlockLevel
+
+import cache
+from mdx_defs import DefinitionBlockProcessor
+from mdx_references import TOCNode, resolve_references
+
+logger =  logging.getLogger(__name__)
+
+
+H1_RE = re.compile(r'^#(?!#)')
+SETEXT_H1_RE = re.compile(r'^=+[ \t]*$')
+FENCED_BLOCK_RE = re.compile(r'^(?P<fence>~{3,}|`{3,})[^\n]*\n.*?(?<=\n)(?P=fence)[ ]*$', re.MULTILINE | re.DOTALL)
+HTML_BLOCK_RE = re.compile(r'^<(?P<tag>[a-zA-Z][a-zA-Z0-9]*)')
+REFERENCE_RE = re.compile(r'^[ ]{0,3}\[([^\]]*)\]:\s*([^ ]*)[ ]*([ ]*(\"(.*)\"|\'(.*)\'|\((.*)\))[ ]*)?$')
+LIST_ITEM_RE = re.compile(r'^[ ]{0,3}(?:[*+-]|\d+\.)[ ]+(?P<item>.*)')
+REFERENCE_TITLE_RE = re.compile(r'^[ ]*(\"(.*)\"|\'(.*)\'|\((.*)\))[ ]*$')
+
+# Footnotes and abbreviations are numbered/defined document-wide
+UNSPLITTABLE_RE = re.compile(r'\[\^|^[*]\[', re.MULTILINE)
+
+HEADINGS = set(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+
+# Chunks smaller than this are merged with their neighbours
+MIN_CHUNK_SIZE = 16*1024
+
+# The number of converted sections kept by a SectionCache
+MAX_CACHED_SECTIONS = 4096
+
+
+def _meta_lines(lines):
+    """ Returns the number of @lines at the start of the document
+        consumed by the meta extension (see MetaPreprocessor) """
+    pos = 0
+    if lines and BEGIN_RE.match(lines[0]):
+        pos = 1
+    key = False
+    while pos < len(lines):
+        line = lines[pos]
+        if line.strip() == '' or END_RE.match(line):
+            return pos+1
+        if META_RE.match(line):
+            key = True
+        elif not (key and META_MORE_RE.match(line)):
+            return pos
+        pos += 1
+    return pos
+
+
+def _line_starts(lines):
+    """ Returns the list of the offsets of the @lines in the text (and its length) """
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1]+len(line)+1)
+    return starts
+
+
+def _fenced_lines(text, starts):
+    """ Returns the set of the indices of the lines of @text (starting
+        at @starts) which belong to fenced code blocks """
+    ret = set()
+    index = 0
+    for m in FENCED_BLOCK_RE.finditer(text):
+        while starts[index] < m.start():
+            index += 1
+        while index < len(starts)-1 and starts[index] < m.end():
+            ret.add(index)
+            index += 1
+    return ret
+
+
+def _strip_block_starts(text):
+    """ Returns the depth of the definition blocks started at the
+        beginning of @text and the rest of @text """
+    depth = 0
+    m = DefinitionBlockProcessor.match_start(text)
+    while m:
+        depth += 1
+        text = m.group('rest')
+        m = DefinitionBlockProcessor.match_start(text)
+    return depth, text
+
+
+def _split_points(lines, start, fenced):
+    """ Returns the list of the pairs (index, top-level headings) of the
+        lines starting a new chunk and the predicted number of top-level
+        headings between the previous such line and this one. The last
+        pair has index len(@lines). """
+    points = []
+    depth = 0
+    html_tag = None
+    headings = 0
+    block = []
+    for index in range(start, len(lines)+1):
+        line = lines[index] if index < len(lines) else ''
+        if index in fenced:
+            block.append('')
+            continue
+        if line.strip():
+            if not block and H1_RE.match(line) and depth == 0 and html_tag is None and index > start:
+                points.append((index, headings))
+                headings = 0
+            if H1_RE.match(line) or (SETEXT_H1_RE.match(line) and block and block[-1]):
+                headings += 1
+            block.append(line)
+            continue
+        if not block:
+            continue
+        # Track the definition blocks; what follows the start of a block
+        # (even one in a list item, e.g. '* {ref:#label} ...') may be a heading
+        for line in block:
+            m = LIST_ITEM_RE.match(line)
+            if m and H1_RE.match(_strip_block_starts(m.group('item'))[1]):
+                headings += 1
+        text = '\n'.join(block)
+        block = []
+        started, text = _strip_block_starts(text)
+        if started > 0 and H1_RE.match(text):
+            headings += 1
+        depth += started
+        if depth > 0 and DefinitionBlockProcessor.match_end(text) is not None:
+            depth -= 1
+        # Track the raw html blocks (conservatively)
+        if html_tag is None:
+            m = HTML_BLOCK_RE.match(text)
+            if m and isBlockLevel(m.group('tag')) and '</'+m.group('tag')+'>' not in text:
+                html_tag = m.group('tag')
+        elif '</'+html_tag+'>' in text:
+            html_tag = None
+    points.append((len(lines), headings))
+    return points
+
+
+def split_document(text, min_size=None):
+    """ Splits the (macro expanded) document @text into chunks at its
+        top-level headings. Returns the list of pairs (chunk, offset)
+        where offset is the predicted number of top-level headings
+        before the chunk, or None if the document can not be split.
+        Chunks are at least @min_size (default MIN_CHUNK_SIZE) long. """
+    if min_size is None:
+        min_size = MIN_CHUNK_SIZE
+    if UNSPLITTABLE_RE.search(text):
+        return None
+    lines = text.split('\n')
+    meta = _meta_lines(lines)
+    starts = _line_starts(lines)
+    fenced = _fenced_lines(text, starts)
+    # The lines needed to render a chunk in the same way as the whole document
+    prefix = lines[:meta]
+    if meta > 0 and prefix[-1].strip():
+        prefix.append('')
+    for (index, line) in enumerate(lines):
+        if index in fenced or index < meta:
+            continue
+        if REFERENCE_RE.match(line):
+            prefix.append(line)
+            if index+1 < len(lines) and REFERENCE_TITLE_RE.match(lines[index+1]):
+                prefix.append(lines[index+1])
+    if len(prefix) > meta:
+        prefix.append('')
+    chunks = []
+    start = 0
+    offset = 0
+    headings = 0
+    for (index, count) in _split_points(lines, meta, fenced):
+        headings += count
+        if starts[index]-starts[start] < min_size and index < len(lines):
+            continue
+        if start > 0:
+            chunk = prefix+lines[start:index]
+        else:
+            chunk = prefix+lines[meta:index]
+        chunks.append(('\n'.join(chunk), offset))
+        offset += headings
+        headings = 0
+        start = index
+    if len(chunks) < 2:
+        return None
+    return chunks
+
+
+class RecordingSet(set):
+    """ A set recording, for each added id, the id originally passed
+        to unique (see markdown.extensions.headerid) """
+    def __init__(self):
+        set.__init__(self)
+        self.log = []
+        self.pending = None
+
+    def __contains__(self, id):
+        if self.pending is None:
+            self.pending = id
+        return set.__contains__(self, id)
+
+    def add(self, id):
+        self.log.append((self.pending, id))
+        self.pending = None
+        set.add(self, id)
+
+
+def _toc_entries(node, path=()):
+    ret = []
+    for (id, child) in node.items():
+        ret.append((path+(id,), child.title))
+        ret.extend(_toc_entries(child, path+(id,)))
+    return ret
+
+
+def chunk_result(md, tree, offset):
+    """ Returns the (picklable) result of converting a chunk with the
+        markdown instance @md into the lxml @tree, where the section
+        numbering started after @offset top-level headings """
+    numbering = md.treeprocessors['blocknumbering']
+    headerids = md.treeprocessors['headerid'].IDs
+    return {
+        'tree':lxml.etree.tostring(tree),
+        'offset':offset,
+        'end':numbering.current_section_tuple[0],
+        'labels':numbering.labels,
+        'ids':getattr(headerids, 'log', []),
+        'toc':_toc_entries(md.TOC),
+        'meta':getattr(md, 'Meta', None),
+        'block_types':md.BlockTypes,
+        'proof_depth':md.ProofDepth,
+        'unterminated':md.parser.blockprocessors['definitionblock'].unterminated
+    }
+
+
+def check_offsets(results):
+    """ Returns the list of the pairs (index, offset) of the @results
+        whose section numbering started at a wrong offset and the right
+        offset. The number of top-level headings of a chunk does not
+        depend on its offset, so the right offsets are known after
+        converting each chunk once. """
+    wrong = []
+    expected = 0
+    for (index, result) in enumerate(results):
+        if result['offset'] != expected:
+            wrong.append((index, expected))
+        expected += result['end']-result['offset']
+    return wrong
+
+
+class MergedDocument(object):
+    """ Stands for the markdown instance which converted the whole
+        document (provides the TOC, Meta, BlockTypes, ProofDepth and
+        Labels of the document) """
+    def __init__(self, toc, meta, block_types, proof_depth, labels):
+        self.TOC = toc
+        if meta is not None:
+            self.Meta = meta
+        self.BlockTypes = block_types
+        self.ProofDepth = proof_depth
+        self.Labels = labels
+
+
+def _fix_heading_ids(body, log, ids):
+    """ Makes the ids the headerid extension gave to the top-level
+        headings in @body (the pairs of the original and the assigned
+        id in @log) unique with respect to @ids """
+    pos = 0
+    for e in body:
+        if pos >= len(log):
+            break
+        if e.tag in HEADINGS and e.get('id') == log[pos][1]:
+            id = unique(log[pos][0], ids)
+            if id != log[pos][1]:
+                e.set('id', id)
+            pos += 1
+    if pos < len(log):
+        raise ValueError('Heading ids do not match')
+
+
+def merge(results, external_labels=None):
+    """ Merges the converted chunks (see chunk_result) into the pair
+        (MergedDocument, lxml tree) corresponding to the whole document.
+        References to labels not defined in the document are resolved
+        using @external_labels (see resolve_references). Raises
+        ValueError if the chunks can not be merged. """
+    if [ r for r in results[:-1] if r['unterminated'] ]:
+        raise ValueError('Unterminated definition block')
+    labels = {}
+    for r in results:
+        labels.update(r['labels'])
+    toc = TOCNode(root=True)
+    ids = set()
+    root = None
+    for r in results:
+        tree = lxml.etree.fromstring(r['tree'])
+        chunk_body = tree.find('body')
+        _fix_heading_ids(chunk_body, r['ids'], ids)
+        if root is None:
+            root = tree
+            body = chunk_body
+        else:
+            # The serialized document has a newline between top-level elements
+            if len(body) > 0 and body[-1].tail is None:
+                body[-1].tail = '\n'
+            if chunk_body.text:
+                if len(body) > 0:
+                    body[-1].tail = (body[-1].tail or '')+chunk_body.text
+                else:
+                    body.text = (body.text or '')+chunk_body.text
+            body.extend(list(chunk_body))
+        for (path, title) in r['toc']:
+            node = toc._get_descendant(list(path), create=True)
+            if title is not None:
+                node.title = title
+    resolve_references(body, labels, external_labels)
+    block_types = set()
+    for r in results:
+        block_types.update(r['block_types'])
+    proof_depth = max([ r['proof_depth'] for r in results ])
+    return MergedDocument(toc, results[0]['meta'], block_types, proof_depth, labels), root
+
+
+class SectionCache(object):
+    """ Keeps the results of converting chunks (see chunk_result) in
+        memory, keyed by the text of the chunk, the offset its section
+        numbering started at and the configuration of the conversion.
+        When more than @max_entries are stored, the least recently
+        used ones are dropped. The results are never modified (merge
+        parses a new tree from each of them). """
+    def __init__(self, max_entries=MAX_CACHED_SECTIONS):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text, offset, config):
+        """ Returns the fingerprint of the chunk @text converted with
+            the configuration @config starting after @offset sections """
+        return cache.hash_strings([ text, str(offset), repr(config) ])
+
+    def get(self, key):
+        result = self.entries.pop(key, None)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = result
+        return result
+
+    def put(self, key, result):
+        self.entries.pop(key, None)
+        self.entries[key] = result
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'entries':len(self.entries)}
@@ -0,0 +1,128 @@
+'''
+Project label index
+===================
+
+Records the labels defined in the documents of a project, so that
+a reference to a label defined in another document can be resolved
+without converting that document (see md.update_label_index and
+md.external_labels).
+
+The index is a single JSON file mapping each document (relative to
+the directory of the index) to the fingerprint of everything its
+labels depend on (see md.label_fingerprint) and to its labels, each
+given by the pair [number, anchor]:
+
+    {"version":1,"documents":{"lecture1.md":{"fingerprint":"...",
+      "labels":{"compactness":["1.2","1.2"],"intro":["sec1","sec1"]}}}}
+
+A document is only converted again when its fingerprint changes.
+
+'''
+
+import json
+import logging
+import os
+import tempfile
+
+logger =  logging.getLogger(__name__)
+
+
+class LabelIndex(object):
+    VERSION = 1
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.directory = os.path.dirname(os.path.abspath(fname))
+        self.entries = {}
+        self.changed = False
+        self.load()
+
+    def _key(self, document):
+        return os.path.relpath(os.path.abspath(document), self.directory)
+
+    def _document(self, key):
+        return os.path.relpath(os.path.join(self.directory, key))
+
+    def load(self):
+        """ Reads the index from its file (an index which can not be
+            read is treated as empty and rebuilt) """
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(self.fname, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError):
+            return
+        except ValueError as e:
+            logger.warn('Could not read the label index '+self.fname+' ('+str(e)+')')
+            return
+        if data.get('version', None) != self.VERSION:
+            logger.info('Ignoring the label index '+self.fname+' written by another version')
+            return
+        self.entries = data.get('documents', {})
+
+    def save(self):
+        """ Writes the index to its file if it changed """
+        if not self.changed:
+            return
+        try:
+            data = json.dumps({'version':self.VERSION, 'documents':self.entries}, separators=(',', ':'), sort_keys=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data.encode('utf-8')+b'\n')
+            os.rename(tmp, self.fname)
+        except (IOError, OSError) as e:
+            logger.warn('Could not write the label index '+self.fname+' ('+str(e)+')')
+            return
+        self.changed = False
+
+    def documents(self):
+        """ Returns the list of the indexed documents """
+        return sorted([ self._document(key) for key in self.entries ])
+
+    def fingerprint(self, document):
+        """ Returns the fingerprint of the indexed @document or None """
+        entry = self.entries.get(self._key(document), None)
+        return entry and entry['fingerprint']
+
+    def _set(self, document, entry):
+        """ Replaces the entry of @document by @entry (None removes it).
+            Returns the set of the keys of the labels which were added,
+            removed or renumbered. """
+        key = self._key(document)
+        old = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        self.changed = True
+        old = old and old['labels'] or {}
+        new = entry and entry['labels'] or {}
+        return set([ k for k in set(old) | set(new) if old.get(k, None) != new.get(k, None) ])
+
+    def update(self, document, fingerprint, labels):
+        """ Records the @labels (mapping the keys to the pairs (number,
+            anchor)) of @document with the given @fingerprint. Returns
+            the set of the keys of the labels which changed. """
+        labels = dict([ (k, list(v)) for (k, v) in labels.items() ])
+        return self._set(document, {'fingerprint':fingerprint, 'labels':labels})
+
+    def remove(self, document):
+        """ Removes @document from the index. Returns the set of the
+            keys of its labels. """
+        if self._key(document) not in self.entries:
+            return set()
+        return self._set(document, None)
+
+    def labels(self, exclude=None):
+        """ Returns the dict mapping the keys of the labels defined in
+            the indexed documents other than @exclude to the triples
+            (document, number, anchor). A label defined in several
+            documents is taken from the first one (in sorted order). """
+        exclude = exclude and self._key(exclude)
+        ret = {}
+        for key in sorted(self.entries, reverse=True):
+            if key == exclude:
+                continue
+            document = self._document(key)
+            for (label, (number, anchor)) in self.entries[key]['labels'].items():
+                ret[label] = (document, number, anchor)
+        return ret
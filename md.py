@@ -1,61 +1,102 @@
 #!/usr/bin/python
 import argparse
+import copy
+import cProfile
+import glob
+import multiprocessing
 import os
 import re
+import sys
+import tempfile
+import time
+import traceback
 
 import markdown
 from markdown.util import etree
 import lxml
 import lxml.etree
-from lxml.cssselect import CSSSelector
 
 from mdx_tolatex import laTeXRenderer
-from mdx_defs import build_headings
+from mdx_defs import build_headings, headings_from_types
 from postprocess import build_sections
-from utils import get_by_id
+from utils import build_id_index, get_by_id, selector_cache
 import logging
 import mdx_macros
+import mdtree
+import cache
+import chunks
+import labelindex
+from mdx_references import REFERENCE_RE
+import profiling
+import simpletemplate
 
-template_system = None
-try:
-    import django.conf
-    import django.template
+logger = logging.getLogger("md")
+root_logger = logging.getLogger()
 
-    logging.basicConfig()
-    django.conf.settings.configure()
-    template_system = "DJANGO"
-except:
-    pass
 
-if not template_system:
+# The template system used by render_template ("DJANGO", "JINJA2" or
+# "NONE" for the built-in engine of simpletemplate), determined by load_template_system on first use
+template_system = None
+
+def load_template_system():
+    """ Imports the template library (Django if available, otherwise
+        Jinja2) the first time it is called and returns template_system """
+    global template_system, django, jinja_env
+    if template_system is not None:
+        return template_system
+    template_system = "NONE"
     try:
-        import jinja2
-        jinja_env=jinja2.Environment(extensions=['jinja2.ext.autoescape'])
-        template_system = "JINJA2"
+        import django.conf
+        import django.template
+
+        django.conf.settings.configure()
+        template_system = "DJANGO"
     except:
         pass
 
-logger = logging.getLogger("md")
-root_logger = logging.getLogger()
+    if template_system == "NONE":
+        try:
+            import jinja2
+            jinja_env=jinja2.Environment(extensions=['jinja2.ext.autoescape'])
+            template_system = "JINJA2"
+        except:
+            pass
+    if template_system == "NONE":
+        logger.debug("No template library found, using the built-in template engine")
+    return template_system
+
+
+# Compiled templates keyed by their source
+_compiled_templates = {}
+MAX_COMPILED_TEMPLATES = 16
+
+def compile_template(tpl):
+    """ Returns the template @tpl compiled by the template system.
+        Each distinct template is compiled only once per process. """
+    compiled = _compiled_templates.get(tpl, None)
+    if compiled is not None:
+        return compiled
+    system = load_template_system()
+    if system == "DJANGO":
+        compiled = django.template.Template(tpl)
+    elif system == "JINJA2":
+        compiled = jinja_env.from_string(tpl)
+    else:
+        compiled = simpletemplate.Template(tpl)
+    if len(_compiled_templates) >= MAX_COMPILED_TEMPLATES:
+        _compiled_templates.clear()
+    _compiled_templates[tpl] = compiled
+    return compiled
 
 
 def render_template(tpl, context):
+    compiled = compile_template(tpl)
     if template_system == "DJANGO":
-        dtpl = django.template.Template(tpl)
-        return dtpl.render(django.template.Context(context))
-
-    elif template_system == "JINJA2":
-        print(jinja_env.extensions)
-        dtpl = jinja_env.from_string(tpl)
-        return dtpl.render(context)
+        return compiled.render(django.template.Context(context))
     else:
-        logging.getLogger("md").warn("No template library found!")
-        for (key,value) in context.items():
-            exp = re.compile(r"{{\s*"+key+"\s*}}",re.UNICODE | re.IGNORECASE)
-            tpl=exp.sub(value.replace("\\", "\\\\"),tpl)
-        exp = re.compile("{%[^%]*%}")
-        tpl = exp.sub("",tpl)
-        return tpl
+        # Jinja2 and the built-in engine
+        return compiled.render(context)
+
 
 def text_content(element):
     """ Returns the contents of the element @element
@@ -94,23 +135,237 @@ def parse_html( html, tree ):
         raise e
 
 
-def render_md( md_text, tree = None, ext_config = {} ):
-    """ Converts the (unicode) markdown @md_text to html.
+MD_EXTENSIONS = ['extra','defs','mymathjax','wikilinks','headerid','references','bibliography','meta']
+
+# Markdown instances keyed by their (hashable) extension configuration,
+# see get_renderer
+_renderers = {}
+
+def _config_key(ext_config):
+    return tuple(sorted([ (ext, tuple(sorted(cfg.items()))) for (ext, cfg) in ext_config.items() ]))
+
+def get_renderer(ext_config = {}):
+    """ Returns a markdown.Markdown instance with the extensions
+        configured by @ext_config, ready to convert a new document.
+        Instances are created (and the extensions loaded) only once
+        per configuration and are reset before each reuse. """
+    key = _config_key(ext_config)
+    md = _renderers.get(key, None)
+    if md is None:
+        md = markdown.Markdown(extensions=MD_EXTENSIONS,extension_configs=ext_config)
+        _renderers[key] = md
+    else:
+        md.reset()
+        # The abbr extension (from extra) registers a new inline pattern for
+        # each abbreviation it finds and has no reset of its own
+        for name in [ name for name in md.inlinePatterns.keys() if name.startswith('abbr-') ]:
+            del md.inlinePatterns[name]
+    return md
+
+def html_document(elements):
+    """ Returns an lxml <html> tree whose body consists of the @elements,
+        i.e. the tree parse_html would produce from the serialized
+        @elements joined by newlines. The @elements are moved into
+        the new tree except for those nested in another one of the
+        @elements, which are copied. """
+    root = lxml.etree.Element('html')
+    lxml.etree.SubElement(root,'head')
+    body = lxml.etree.SubElement(root,'body')
+    selected = set(elements)
+    for (i, e) in enumerate(elements):
+        for ancestor in e.iterancestors():
+            if ancestor in selected:
+                e = copy.deepcopy(e)
+                break
+        body.append(e)
+        if i < len(elements)-1:
+            e.tail = (e.tail or '')+'\n'
+    return root
+
+def render_md( md_text, tree = None, ext_config = {}, base_dir = '.', jobs = None, sections = None, labels = None ):
+    """ Converts the (unicode) markdown @md_text to html
+        (macro libraries are imported relative to @base_dir).
         And returns the pair (md,html) where
-          md is the resulting parser instance
+          md is the resulting parser instance (which is reused
+             by the next call with the same @ext_config)
         and the html is
              - html string (@tree = None)
              - parsed lxml.etree (@tree='lxml')
              - parsed markdown.util.etree (@tree='md')
+        If @jobs is given (and @tree='lxml'), large documents are
+        converted in chunks by @jobs processes (see render_parallel).
+        If the chunks.SectionCache @sections is given (and @tree='lxml'),
+        only the top-level sections not found in it are converted (see
+        render_incremental).
+        References to labels not defined in the document are resolved
+        using @labels (see external_labels).
     """
-    md = markdown.Markdown(extensions=['extra','defs','mymathjax','wikilinks','headerid','references','bibliography','meta'],extension_configs=ext_config)
-    doc = mdx_macros.pre_process(md_text)
-    html = md.convert(doc)
+    with profiling.stage('pre_process'):
+        doc = mdx_macros.pre_process(md_text, base_dir)
+    if sections is not None and tree == 'lxml':
+        with profiling.stage('incremental'):
+            try:
+                result = render_incremental(doc, ext_config, sections, jobs, labels)
+            except Exception as e:
+                # Converting the whole document reports the problem if it persists
+                logger.warn('Could not convert the document section by section ('+str(e)+'), converting it whole')
+                result = None
+        if result is not None:
+            return result
+    elif jobs is not None and tree == 'lxml':
+        with profiling.stage('parallel'):
+            result = render_parallel(doc, ext_config, jobs, labels)
+        if result is not None:
+            return result
+    md = get_renderer(ext_config)
+    md.treeprocessors['blocknumbering'].external_labels = labels or {}
+    profiling.instrument(md)
+    try:
+        if tree == 'lxml':
+            # Build the lxml tree directly from the markdown tree
+            with profiling.stage('markdown'):
+                root = mdtree.convert_to_tree(md, doc)
+            with profiling.stage('to_lxml'):
+                lxml_tree = mdtree.to_lxml(md, root)
+            if lxml_tree is None:
+                with profiling.stage('serialize'):
+                    html = mdtree.serialize(md, root)
+                with profiling.stage('parse_html'):
+                    lxml_tree = parse_html(html, tree)
+            return md, lxml_tree
+        with profiling.stage('markdown'):
+            html = md.convert(doc)
+    except:
+        # The instance may be left in an inconsistent state
+        del _renderers[_config_key(ext_config)]
+        raise
+    finally:
+        profiling.uninstrument(md)
     if tree:
-        return md, parse_html(html, tree)
+        with profiling.stage('parse_html'):
+            return md, parse_html(html, tree)
     else:
         return md, html
 
+
+def _render_chunk(task):
+    """ Converts a chunk of a document (see chunks.split_document)
+        and returns the result of chunks.chunk_result """
+    text, offset, ext_config = task
+    md = get_renderer(ext_config)
+    numbering = md.treeprocessors['blocknumbering']
+    numbering.current_section_tuple = [offset]
+    numbering.warn_undefined = False
+    md.treeprocessors['headerid'].IDs = chunks.RecordingSet()
+    try:
+        root = mdtree.convert_to_tree(md, text)
+        lxml_tree = mdtree.to_lxml(md, root)
+        if lxml_tree is None:
+            lxml_tree = parse_html(mdtree.serialize(md, root), 'lxml')
+        return chunks.chunk_result(md, lxml_tree, offset)
+    except:
+        del _renderers[_config_key(ext_config)]
+        raise
+
+
+# The converted sections kept between the renders of --watch
+# (see render_incremental), None when not watching
+_section_cache = None
+
+# The pool of processes used by render_parallel and its size
+_chunk_pool = None
+_chunk_pool_size = None
+
+def _get_chunk_pool(jobs):
+    global _chunk_pool, _chunk_pool_size
+    if _chunk_pool is None or _chunk_pool_size != jobs:
+        if _chunk_pool is not None:
+            _chunk_pool.terminate()
+        _chunk_pool = multiprocessing.Pool(jobs)
+        _chunk_pool_size = jobs
+    return _chunk_pool
+
+
+def render_parallel(doc, ext_config, jobs, labels=None):
+    """ Converts the (macro expanded) markdown @doc in chunks split at
+        its top-level headings (see chunks.split_document) in a pool of
+        @jobs processes and merges the results. Returns the same pair
+        as render_md with tree='lxml' or None if the document can not
+        be split (or merged), in which case it must be converted whole. """
+    parts = chunks.split_document(doc)
+    if parts is None:
+        return None
+    tasks = [ (text, offset, ext_config) for (text, offset) in parts ]
+    results = _get_chunk_pool(jobs).map(_render_chunk, tasks, chunksize=1)
+    # Chunks whose section numbering started at a wrong offset are
+    # converted again (e.g. a heading which the scanning in split_document
+    # missed); the right offsets are known after the first conversion
+    wrong = chunks.check_offsets(results)
+    if wrong:
+        logger.debug('Converting chunks '+', '.join([ str(index) for (index, offset) in wrong ])+' again')
+        tasks = [ (parts[index][0], offset, ext_config) for (index, offset) in wrong ]
+        for ((index, offset), result) in zip(wrong, _get_chunk_pool(jobs).map(_render_chunk, tasks, chunksize=1)):
+            results[index] = result
+    try:
+        return chunks.merge(results, labels)
+    except (ValueError, lxml.etree.XMLSyntaxError) as e:
+        logger.debug('Could not merge the chunks ('+str(e)+'), converting the document whole')
+        return None
+
+def _convert_sections(tasks, jobs):
+    """ Converts the chunks described by the @tasks (see _render_chunk)
+        in this process or, if @jobs is given, in the chunk pool """
+    if jobs is None or len(tasks) < 2:
+        return [ _render_chunk(task) for task in tasks ]
+    return _get_chunk_pool(jobs).map(_render_chunk, tasks, chunksize=1)
+
+
+def render_incremental(doc, ext_config, sections, jobs=None, labels=None):
+    """ Converts the (macro expanded) markdown @doc section by section,
+        taking the converted top-level sections from the chunks.SectionCache
+        @sections where possible (the others are converted, by @jobs
+        processes if given, and stored in it), and merges the results.
+        Returns the same pair as render_md with tree='lxml' or None if
+        the document must be converted whole (see render_parallel).
+
+        The numbers of the sections (and of the blocks in them) are part
+        of the converted sections, so inserting or removing a top-level
+        section converts the sections after it again. References, heading
+        ids and the TOC are fixed when merging (see chunks.merge). """
+    parts = chunks.split_document(doc, min_size=0)
+    if parts is None:
+        return None
+    config = _config_key(ext_config)
+    results = [ None ]*len(parts)
+    offsets = [ offset for (text, offset) in parts ]
+    # The predicted offsets are checked after the first round, the
+    # second one converts the sections whose offset was wrong
+    for attempt in range(2):
+        missing = []
+        for (index, (text, offset)) in enumerate(parts):
+            if results[index] is not None and results[index]['offset'] == offsets[index]:
+                continue
+            key = sections.key(text, offsets[index], config)
+            results[index] = sections.get(key)
+            if results[index] is None:
+                missing.append((index, key))
+        if missing:
+            logger.debug('Converting '+str(len(missing))+' of '+str(len(parts))+' sections')
+            tasks = [ (parts[index][0], offsets[index], ext_config) for (index, key) in missing ]
+            for ((index, key), result) in zip(missing, _convert_sections(tasks, jobs)):
+                sections.put(key, result)
+                results[index] = result
+        wrong = chunks.check_offsets(results)
+        if not wrong:
+            break
+        for (index, offset) in wrong:
+            offsets[index] = offset
+    try:
+        return chunks.merge(results, labels)
+    except (ValueError, lxml.etree.XMLSyntaxError) as e:
+        logger.debug('Could not merge the sections ('+str(e)+'), converting the document whole')
+        return None
+
 def filter(css_selector, lxmltree, include_references = True):
     """ Returns an iterable over the elements from @lxmltree matching
         the css selector @css_selector. If @include_references is True,
@@ -118,9 +373,9 @@ def filter(css_selector, lxmltree, include_references = True):
         which will contain all referenced elements not already present.
     """
     try:
-        selector = CSSSelector(css_selector)
+        selector = selector_cache.get(css_selector)
         if include_references:
-            refs_selector = CSSSelector('ref')
+            refs_selector = selector_cache.get('ref')
             ref_ids = set([])
             ret = []
             # Find all references in the selected elements
@@ -140,20 +395,33 @@ def filter(css_selector, lxmltree, include_references = True):
                 ref_h.text = 'References'
                 references_found = False
 
+                # Index the ids in the document and in the selected elements
+                # once instead of searching the tree for each reference
+                index = build_id_index(lxmltree)
+                selected_ids = set(build_id_index(ret).keys())
+
                 # Iterate over the reference ids and check that they exist
                 # and are not already present in the selected elements
                 for id in sorted(ref_ids):
-                    if id:
+                    # References to other documents are not included
+                    if id and id.startswith('#'):
                         logger.debug("Checking reference "+id)
                         # Only include the reference if it is not already present in the selected elements
-                        if get_by_id(selector(lxmltree),id[1:]) is None:
+                        if id[1:] not in selected_ids:
                             logger.debug("Adding reference "+id)
-                            ref = get_by_id(lxmltree,id[1:])
+                            ref = get_by_id(lxmltree,id[1:],index)
                             if ref is None:
                                 logger.warn("Reference "+id+" not found")
                             else:
                                 references_found = True
                                 ref_parent.append(ref)
+                                # The reference (with its descendants) is no
+                                # longer part of the tree
+                                for moved in ref.iter():
+                                    moved_id = moved.get('id',None)
+                                    if moved_id is not None and index.get(moved_id,None) is moved:
+                                        del index[moved_id]
+                                        selected_ids.discard(moved_id)
                 # Do not include the <references> element if there were no references
                 if references_found:
                     ret.append(ref_parent)
@@ -180,19 +448,36 @@ def query( css_selector, lxmltree ):
     return ret
 
 
-def load_template(tpl, fmt):
+def template_candidates(tpl, fmt):
+  """ Returns the list of filenames, in order of precedence,
+      where the template @tpl for the format @fmt is looked for """
   format_exts = {
     'html':'html',
     'latex':'tex'
   }
   base_name = tpl or 'default-template'
   search_dirs = [ '.', os.environ['HOME'], os.path.dirname(os.path.realpath(__file__)) ]
+  return [ os.path.join(dirname,base_name+'.'+format_exts[fmt]) for dirname in search_dirs ]
+
+
+# Loaded templates keyed by (absolute filename, mtime), so that the templates
+# of the same (relative) name in different working directories (e.g. of the
+# requests processed by the server) are kept apart
+_loaded_templates = {}
 
-  for dirname in search_dirs:
+def load_template(tpl, fmt):
+  """ Returns the template @tpl for the format @fmt (see template_candidates).
+      A template file is only read again when it is modified, so that
+      an unchanged template is not compiled again (see compile_template). """
+  for fname in template_candidates(tpl, fmt):
     try:
-      fname = os.path.join(dirname,base_name+'.'+format_exts[fmt])
-      return unicode(file(fname,'r').read(),encoding='utf-8',errors='ignore')
-    except:
+      key = (os.path.abspath(fname), os.path.getmtime(fname))
+      if key not in _loaded_templates:
+        if len(_loaded_templates) >= MAX_COMPILED_TEMPLATES:
+          _loaded_templates.clear()
+        _loaded_templates[key] = unicode(file(fname,'r').read(),encoding='utf-8',errors='ignore')
+      return _loaded_templates[key]
+    except (IOError, OSError):
       pass
 
   if tpl:
@@ -201,13 +486,20 @@ def load_template(tpl, fmt):
   else:
     logger.warn('Could not open default template')
     template = '{{ content }}'
+    return template
 
 
-def main():
-  parser = argparse.ArgumentParser(description='A markdown processor')
+COMMENTS_RE = re.compile('^\/\/.*$', re.MULTILINE)
+OUTPUT_EXTENSIONS = {
+    'html':'.html',
+    'latex':'.tex'
+}
+
+def build_arg_parser():
+  parser = argparse.ArgumentParser(prog='md.py', description='A markdown processor')
   parser.add_argument('-t', '--template', help='document template')
   parser.add_argument('-ao', '--autooutput', help='automatically create the output file with appropriate extension', action='store_true')
-  parser.add_argument('-o', '--output', type=argparse.FileType('w'),help='output file')
+  parser.add_argument('-o', '--output', help='output file')
   parser.add_argument('-f', '--format',help='output format', choices=['html','latex'],default='html')
   parser.add_argument('-s', '--subs',help='template substitutions',default='')
   parser.add_argument('--filter',help='process only elements matching a given css selector',default=None)
@@ -217,111 +509,774 @@ def main():
   parser.add_argument('--numberreferencedonly',help='only number blocks which are actually referenced',action='store_true')
   parser.add_argument('--verbose', '-v', action='count',help='be verbose',default=0)
   parser.add_argument('--renderoptions', help='a comma separated list of key=value pairs which will be passed as options to the renderer',default=None)
-  parser.add_argument('document',type=argparse.FileType('r'),help='filename of the document to transform')
+  parser.add_argument('-j', '--jobs', type=int, help='number of worker processes used when compiling several documents or with --parallel (defaults to the number of cpus)', default=None)
+  parser.add_argument('--parallel', help='convert a large document in chunks (split at its top-level headings) using --jobs processes', action='store_true')
+  parser.add_argument('-w', '--watch', help='keep running and recompile the documents whenever they, the template or the .md-substitutions change (converting only the changed top-level sections again)', action='store_true')
+  parser.add_argument('--labelindex', help='a file indexing the labels of the project documents; references to labels defined in other (indexed) documents link to them', default=None)
+  parser.add_argument('--nocache', help='do not use the render cache', action='store_true')
+  parser.add_argument('--clearcache', help='remove all entries from the render cache', action='store_true')
+  parser.add_argument('--cachestats', help='print render and selector cache statistics', action='store_true')
+  parser.add_argument('--cachedir', help='directory of the render cache (defaults to ~/.cache/md)', default=None)
+  parser.add_argument('--cachesize', type=int, help='maximal size of the render cache in MB', default=256)
+  parser.add_argument('--profile', help='print the time spent in each stage and markdown processor and the peak RSS growth (in KiB, i.e. how much the maximal resident set size grew, not the memory allocated) to the standard error; use with --nocache to profile the rendering itself', action='store_true')
+  parser.add_argument('--profile-format', dest='profile_format', choices=['table','json'], help='the format of the --profile statistics (defaults to table)', default='table')
+  parser.add_argument('--profile-dump', dest='profile_dump', help='write cProfile statistics (readable by pstats) to this file', default=None)
+  parser.add_argument('document', nargs='*', help='filename(s) of the document(s) to transform; directories and glob patterns are expanded to the .md files they contain')
+  return parser
 
-  args = parser.parse_args()
 
-  root_logger.setLevel(logging.FATAL-args.verbose*10)
+def expand_documents(paths):
+    """ Expands the directories and glob patterns in @paths into
+        a list of document filenames. Directories are searched
+        recursively for files ending with '.md'. """
+    ret = []
+    for path in paths:
+        if path == '-':
+            ret.append(path)
+        elif os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for fname in sorted(filenames):
+                    if fname.endswith('.md'):
+                        ret.append(os.path.join(dirpath,fname))
+        elif glob.has_magic(path):
+            ret.extend(sorted(glob.glob(path)))
+        else:
+            ret.append(path)
+    return ret
+
+
+def read_document(fname):
+    """ Reads the document @fname ('-' meaning the standard input)
+        and returns its source with comments removed """
+    if fname == '-':
+        source = sys.stdin.read()
+    else:
+        source = open(fname,'r').read()
+    doc_source = unicode(source,encoding='utf-8',errors='ignore')
+    return COMMENTS_RE.sub('',doc_source)
+
+
+def load_substitutions():
+    """ Returns the template substitutions defined in the
+        .md-substitutions file in the current directory """
+    dct = {}
+    try:
+        for l in open('.md-substitutions','r').readlines():
+            if l.strip().startswith('#'):
+                continue
+            try:
+                k,v = l.strip().split('=')
+                dct[k.strip()] = v.strip()
+            except:
+                pass
+    except:
+        pass
+    return dct
+
+
+def parse_render_options(renderoptions):
+    render_options = {}
+    if renderoptions:
+      try:
+          for opt in renderoptions.split(','):
+              key,value = opt.split('=')
+              render_options[key]=eval(value)
+      except Exception as e:
+          logger.warn('Bad render options: '+renderoptions+' ('+str(e)+')')
+    return render_options
+
+
+def document_directory(fname):
+    """ Returns the directory relative to which the files referenced by the document @fname are looked up """
+    if fname == '-':
+        return '.'
+    return os.path.dirname(fname) or '.'
+
+
+def document_basename(fname):
+    if fname.endswith('.md'):
+        return fname[:-3]
+    return fname
+
+
+def parallel_jobs(args):
+    """ Returns the number of processes converting a single document
+        or None if it should not be converted in chunks """
+    if not args.parallel:
+        return None
+    return args.jobs or multiprocessing.cpu_count()
+
+
+def query_document(fname, args):
+    """ Returns the lines describing the elements of the document @fname
+        which match the query @args.query """
+    doc_source = read_document(fname)
+    md, lxml_tree = render_md(doc_source,tree='lxml',ext_config={'references':{'number_referenced_only':args.numberreferencedonly}},base_dir=document_directory(fname),jobs=parallel_jobs(args),labels=external_labels(fname, args))
+    with profiling.stage('build_sections'):
+        lxml_tree = build_sections(lxml_tree)
+    attrs = args.attrs.split(',')
+    with profiling.stage('query'):
+        return [ ','.join([ attr+'='+e[attr] for attr in attrs if attr in e ]) for e in query(args.query, lxml_tree) ]
+
+
+_code_fingerprint = None
+
+def code_fingerprint():
+    """ Returns a string identifying the version of the code producing
+        the output (the version of markdown and the modification times
+        of the python files in this directory) """
+    global _code_fingerprint
+    if _code_fingerprint is None:
+        base = os.path.dirname(os.path.realpath(__file__))
+        parts = [ getattr(markdown, 'version', '') ]
+        for fname in sorted(os.listdir(base)):
+            if fname.endswith('.py'):
+                parts.append(fname+':'+str(os.path.getmtime(os.path.join(base, fname))))
+        _code_fingerprint = ','.join(parts)
+    return _code_fingerprint
+
+
+def cache_key(doc_source, fname, args, template, substitutions):
+    """ Returns the key under which the output of compile_document is cached """
+    options = [ args.format, args.filter, str(args.norefs), str(args.numberreferencedonly), args.renderoptions, args.subs ]
+    subs = [ k+'='+v for (k,v) in sorted(substitutions.items()) ]
+    macros = mdx_macros.macro_sources(doc_source, document_directory(fname))
+    labels = external_labels(fname, args) or {}
+    refs = [ k+'='+'#'.join(labels[k]) for k in sorted(referenced_labels(doc_source, fname)) if k in labels ]
+    return cache.hash_strings([ code_fingerprint(), doc_source, document_basename(fname), template ] + options + subs + macros + refs)
+
+
+def open_cache(args):
+    """ Returns the render cache configured by @args or None if caching is disabled """
+    if args.nocache:
+        mdx_macros.cache_directory = None
+        return None
+    render_cache = cache.RenderCache(args.cachedir, args.cachesize*1024*1024)
+    mdx_macros.cache_directory = os.path.join(render_cache.directory, 'macros')
+    return render_cache
+
+
+# The label index of the project (see open_label_index), None if not used
+_label_index = None
+
+def open_label_index(args):
+    """ Returns the label index given by @args (which is also used
+        by external_labels) or None if no index is used """
+    global _label_index
+    if args.labelindex:
+        _label_index = labelindex.LabelIndex(args.labelindex)
+    else:
+        _label_index = None
+    return _label_index
+
 
-  template = load_template(args.template, args.format)
+def referenced_labels(doc_source, fname):
+    """ Returns the set of the keys of the labels referenced by @doc_source
+        of the document @fname (or by the macro libraries it imports) """
+    ret = set()
+    for text in [ doc_source ] + mdx_macros.macro_sources(doc_source, document_directory(fname)):
+        ret.update(REFERENCE_RE.findall(text))
+    return ret
+
+
+def label_fingerprint(doc_source, fname, args):
+    """ Returns the hash of everything the labels of the document
+        @fname with source @doc_source depend on """
+    macros = mdx_macros.macro_sources(doc_source, document_directory(fname))
+    return cache.hash_strings([ code_fingerprint(), doc_source, str(args.numberreferencedonly) ] + macros)
+
+
+def document_labels(fname, args):
+    """ Converts the document @fname and returns the dict mapping the keys
+        of the labels it defines to the pairs (number, anchor) """
+    doc_source = read_document(fname)
+    md = render_md(doc_source,tree='lxml',ext_config={'references':{'number_referenced_only':args.numberreferencedonly}},base_dir=document_directory(fname),jobs=parallel_jobs(args),sections=_section_cache)[0]
+    return dict([ (key, (number, number)) for (key, number) in md.Labels.items() ])
+
+
+def _index_document(task):
+    """ Returns the labels of a document (see document_labels) or None
+        if it can not be converted (which is reported when rendering it) """
+    fname, args = task
+    try:
+        return document_labels(fname, args)
+    except Exception:
+        logger.debug('Could not index '+fname+':\n'+traceback.format_exc())
+        return None
+
+
+def update_label_index(index, documents, args):
+    """ Brings the label @index up to date with the @documents and the
+        documents already in it: the documents whose fingerprint (see
+        label_fingerprint) changed are converted (by a pool of @args.jobs
+        processes if there are several of them) and indexed again and
+        those which no longer exist are removed. Saves the @index and
+        returns the set of the keys of the labels which changed. """
+    changed = set()
+    stale = []
+    for fname in sorted(set([ f for f in documents if f != '-' ]+index.documents())):
+        if not os.path.exists(fname):
+            changed |= index.remove(fname)
+            continue
+        fingerprint = label_fingerprint(read_document(fname), fname, args)
+        if index.fingerprint(fname) != fingerprint:
+            stale.append((fname, fingerprint))
+    if stale:
+        logger.info('Indexing the labels of '+', '.join([ fname for (fname, fingerprint) in stale ]))
+        # The warnings are reported when the documents are rendered
+        level = root_logger.level
+        root_logger.setLevel(max(level, logging.ERROR))
+        try:
+            if len(stale) > 1 and args.jobs != 1 and not args.watch:
+                # The documents are already converted in parallel
+                worker_args = copy.copy(args)
+                worker_args.parallel = False
+                pool = multiprocessing.Pool(args.jobs)
+                try:
+                    labels = pool.map(_index_document, [ (fname, worker_args) for (fname, fingerprint) in stale ], chunksize=1)
+                    pool.close()
+                finally:
+                    pool.join()
+            else:
+                labels = [ _index_document((fname, args)) for (fname, fingerprint) in stale ]
+        finally:
+            root_logger.setLevel(level)
+        for ((fname, fingerprint), doc_labels) in zip(stale, labels):
+            if doc_labels is not None:
+                changed |= index.update(fname, fingerprint, doc_labels)
+    index.save()
+    return changed
+
+
+def external_labels(fname, args):
+    """ Returns the dict mapping the keys of the labels defined in the
+        other documents of the label index (see open_label_index) to the
+        pairs (number, href), where href links the output of @fname to
+        the label in the output of the other document, or None if no
+        index is used. """
+    if _label_index is None:
+        return None
+    out_fname = output_filename(fname, args) if fname != '-' else None
+    if out_fname is None:
+        out_fname = document_basename(fname)+OUTPUT_EXTENSIONS[args.format]
+    base = os.path.dirname(out_fname) or '.'
+    ret = {}
+    for (key, (document, number, anchor)) in _label_index.labels(exclude=fname if fname != '-' else None).items():
+        target = os.path.relpath(document_basename(document)+OUTPUT_EXTENSIONS[args.format], base)
+        ret[key] = (number, target+'#'+anchor)
+    return ret
+
+
+def compile_document(fname, args, template, substitutions=None, render_cache=None):
+  """ Converts the document @fname according to the command line
+      options @args, renders it using the @template and returns the
+      result. The @substitutions default to the contents of the
+      .md-substitutions file. If a @render_cache is given, the result
+      is taken from it when possible and stored in it otherwise. """
+  doc_source = read_document(fname)
+  if substitutions is None:
+      substitutions = load_substitutions()
+  if render_cache is None:
+      return render_document(doc_source, fname, args, template, substitutions)[0]
+  with profiling.stage('cache_lookup'):
+      key = cache_key(doc_source, fname, args, template, substitutions)
+      output = render_cache.get(key)
+  if output is None:
+      output, dependencies = render_document(doc_source, fname, args, template, substitutions)
+      with profiling.stage('cache_store'):
+          render_cache.put(key, output, dependencies)
+  return output
+
+
+def output_filename(fname, args):
+  """ Returns the name of the file the output for the document @fname
+      should be written to or None if it goes to the standard output """
+  if args.output:
+    return args.output
+  elif args.autooutput:
+    return document_basename(fname)+OUTPUT_EXTENSIONS[args.format]
+  return None
 
-  doc_source = unicode(args.document.read(),encoding='utf-8',errors='ignore');
-  comments_re = re.compile('^\/\/.*$', re.MULTILINE)
-  doc_source = comments_re.sub('',doc_source)
-  md, lxml_tree = render_md(doc_source,tree='lxml',ext_config={'references':{'number_referenced_only':args.numberreferencedonly}})
-  lxml_tree = build_sections(lxml_tree)
 
-  if args.query:
-      attrs = args.attrs.split(',')
-      for e in query(args.query, lxml_tree):
-          print(','.join([ attr+'='+e[attr] for attr in attrs if attr in e ]))
+def _replace_file(tmp, fname):
+  """ Renames the file @tmp to @fname, with the permissions a file
+      created by open(@fname, 'w') would have """
+  umask = os.umask(0)
+  os.umask(umask)
+  os.chmod(tmp, 0o666 & ~umask)
+  os.rename(tmp, fname)
+
+
+def write_document(fname, args, template, substitutions=None, render_cache=None):
+  """ Compiles the document @fname (see compile_document) and writes
+      the result where @args say. Output going to a file is streamed
+      there while it is being rendered (see render_document), so that
+      the whole output is never held in memory. It is streamed to a
+      temporary file which replaces the output file when it is complete,
+      so a failure leaves the previous output in place. """
+  out_fname = output_filename(fname, args)
+  if out_fname is None:
+      write_output(fname, compile_document(fname, args, template, substitutions, render_cache), args)
       return
+  doc_source = read_document(fname)
+  if substitutions is None:
+      substitutions = load_substitutions()
+  out = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(out_fname)), prefix='.'+os.path.basename(out_fname)+'.', delete=False)
+  try:
+      with out:
+          cached = False
+          if render_cache is not None:
+              with profiling.stage('cache_lookup'):
+                  key = cache_key(doc_source, fname, args, template, substitutions)
+                  cached = render_cache.copy_to(key, out)
+          if not cached:
+              output, dependencies = render_document(doc_source, fname, args, template, substitutions, out)
+      _replace_file(out.name, out_fname)
+  except:
+      os.remove(out.name)
+      raise
+  if render_cache is not None and not cached:
+      with profiling.stage('cache_store'):
+          render_cache.put_file(key, out_fname, dependencies)
+
+
+# Containers whose serialization is streamed piecewise by html_chunks
+STREAMED_ELEMENTS = set(['html', 'body', 'section', 'div', 'references', 'ol', 'ul', 'blockquote'])
+
+def _html_start_tag(e):
+  """ Returns the html serialization of the start tag and the text of @e """
+  shallow = lxml.etree.Element(e.tag)
+  for (k, v) in e.items():
+      shallow.set(k, v)
+  shallow.text = e.text
+  return lxml.etree.tostring(shallow, method='html')[:-len(e.tag)-3]
+
+def _html_end_tag(e):
+  """ Returns the html serialization of the end tag and the tail of @e """
+  shallow = lxml.etree.Element(e.tag)
+  shallow.tail = e.tail
+  return '</'+e.tag+'>'+lxml.etree.tostring(shallow, method='html')[len(e.tag)*2+5:]
+
+def html_chunks(elements):
+  """ Yields the html serialization of the @elements (including their
+      tails) in pieces: the serialization of the STREAMED_ELEMENTS is
+      split into their start tag, the pieces of their children and
+      their end tag, all other elements are serialized at once. """
+  stack = list(reversed(elements))
+  while stack:
+      e = stack.pop()
+      if isinstance(e, str):
+          yield e
+      elif isinstance(e.tag, basestring) and e.tag in STREAMED_ELEMENTS and len(e) > 0:
+          yield _html_start_tag(e)
+          stack.append(_html_end_tag(e))
+          stack.extend(reversed(e))
+      else:
+          yield lxml.etree.tostring(e, method='html')
+
+
+class _Utf8Writer(object):
+  """ Encodes the (unicode) strings written to it and writes them to @out """
+  def __init__(self, out):
+      self.out = out
+
+  def write(self, s):
+      self.out.write(s.encode('utf-8'))
+
+
+IMAGE_PATH_RE = re.compile(r'(<img\s*[^>]*)\s*src=[\'"]([^\'"]*)[\'"]([^>]*>)')
+
+# Stands for the rendered document in the template context of render_document
+_CONTENT = object()
+
+def split_template(template, dct):
+  """ Renders the @template with the context @dct except for the content.
+      Returns the pair (head, tail) of the output before and after the
+      content or None if the content does not appear in the output
+      exactly once and unchanged (e.g. because it is escaped). """
+  marker = u'<md-content-'+os.urandom(8).encode('hex')+u'/>'
+  context = dict(dct)
+  context['content'] = marker
+  parts = render_template(template, context).split(marker)
+  if len(parts) != 2:
+      return None
+  return parts[0], parts[1]
+
+
+def render_document(doc_source, fname, args, template, substitutions, out=None):
+  """ Converts the @doc_source of the document @fname and renders it
+      using the @template. Returns the pair (output, dependencies),
+      where dependencies maps the names of the files whose existence
+      was checked while rendering to the result of the check.
+
+      If the file object @out is given, the (utf-8 encoded) output
+      is written to it instead, with the content streamed between the
+      parts of the template before and after it (see split_template),
+      and the returned output is None. """
+  dependencies = {}
+  md, lxml_tree = render_md(doc_source,tree='lxml',ext_config={'references':{'number_referenced_only':args.numberreferencedonly}},base_dir=document_directory(fname),jobs=parallel_jobs(args),sections=_section_cache,labels=external_labels(fname, args))
+  with profiling.stage('build_sections'):
+    lxml_tree = build_sections(lxml_tree)
 
   if args.filter:
-      html = '\n'.join([lxml.etree.tostring(e,method='html') for e in filter(args.filter, lxml_tree, include_references=not args.norefs)])
+      with profiling.stage('filter'):
+          elements = filter(args.filter, lxml_tree, include_references=not args.norefs)
   else:
-      html = lxml.etree.tostring(lxml_tree,method='html')
-
-  html_tree = parse_html(html,tree='lxml')
+      elements = [lxml_tree]
 
   dct = {}
-  render_options = {}
-  if args.renderoptions:
-    try:
-        for opt in args.renderoptions.split(','):
-            key,value = opt.split('=')
-            render_options[key]=eval(value)
-    except Exception as e:
-        logger.warn('Bad render options: '+args.renderoptions+' ('+str(e)+')')
+  render_options = parse_render_options(args.renderoptions)
+
+  html_tree = html_document(elements)
 
+  # The block types of the whole document are known from the
+  # conversion, only a filtered document needs to be walked
   if args.format == 'html':
-    output = html
-    dct['headings_css'] = build_headings(html_tree,position='after',format='css')
+    with profiling.stage('headings'):
+      if args.filter:
+        dct['headings_css'] = build_headings(html_tree,position='after',format='css')
+      else:
+        dct['headings_css'] = headings_from_types(md.BlockTypes,position='after',format='css')
   elif args.format == 'latex':
-    dct['headings'] = build_headings(html_tree,position='after',format='latex')
+    with profiling.stage('headings'):
+      if args.filter:
+        dct['headings'] = build_headings(html_tree,position='after',format='latex')
+      else:
+        dct['headings'] = headings_from_types(md.BlockTypes,position='after',format='latex')
     latex = laTeXRenderer(render_options)
-    output = latex.render_from_dom(html_tree)
 
-  dct['content']=output
+  dct['content']=_CONTENT
   if hasattr(md, 'Meta'):
     for (k,v) in md.Meta.items():
         dct[k] = ' '.join(v)
 
   dct['toc']=etree.tostring(md.TOC.to_element())
 
-  try:
-      for l in open('.md-substitutions','r').readlines():
-          if l.strip().startswith('#'):
-              continue
-          try:
-              k,v = l.strip().split('=')
-              dct[k.strip()] = v.strip()
-          except:
-              pass
-  except:
-      pass
+  dct.update(substitutions)
 
   if args.subs:
       for ts in args.subs.split(','):
           k,v = ts.split('=')
           dct[k] = v
 
-  if 'image_path' in dct:
-      exp = re.compile(r'(<img\s*[^>]*)\s*src=[\'"]([^\'"]*)[\'"]([^>]*>)')
-      dct['content']=exp.sub(r'\1src="'+dct['image_path']+r'\2"\3',dct['content'])
+  dct['basename'] = document_basename(fname)
 
+  # The body of html_tree serializes to the elements joined by newlines
+  body = html_tree.find('body')
+  image_path = dct.get('image_path', None)
 
-  if args.document.name.endswith('.md'):
-      dct['basename'] = args.document.name[:-3]
-  else:
-      dct['basename'] = args.document.name
+  parts = None
+  if out is not None and dct['content'] is _CONTENT and not (args.format == 'latex' and image_path is not None):
+    with profiling.stage('template'):
+      parts = split_template(template, dct)
+  if parts is not None:
+    out.write(parts[0].encode('utf-8'))
+    if args.format == 'html':
+      with profiling.stage('tostring'):
+        for chunk in html_chunks(list(body)):
+          if image_path is not None:
+              chunk = IMAGE_PATH_RE.sub(r'\1src="'+image_path+r'\2"\3',chunk)
+          out.write(chunk)
+    elif args.format == 'latex':
+      with profiling.stage('latex'):
+        latex.render_from_dom(html_tree, out=_Utf8Writer(out))
+      dependencies = latex.dependencies
+    out.write(parts[1].encode('utf-8'))
+    return None, dependencies
 
-  output = render_template(template, dct)
+  if dct['content'] is _CONTENT:
+    if args.format == 'html':
+      with profiling.stage('tostring'):
+        dct['content'] = ''.join([lxml.etree.tostring(e,method='html') for e in body])
+    elif args.format == 'latex':
+      with profiling.stage('latex'):
+        dct['content'] = latex.render_from_dom(html_tree)
+      dependencies = latex.dependencies
 
-  if args.output:
-    args.output.write(output.encode('utf-8'))
-  elif args.autooutput:
-    extensions = {
-        'html':'.html',
-        'latex':'.tex'
-    }
-    base = args.document.name;
-    if base.endswith('.md'):
-        base = base[:-3]
-    out_fname=base+extensions[args.format]
+  if image_path is not None:
+      dct['content']=IMAGE_PATH_RE.sub(r'\1src="'+image_path+r'\2"\3',dct['content'])
+
+  with profiling.stage('template'):
+    output = render_template(template, dct)
+  if out is not None:
+    out.write(output.encode('utf-8'))
+    return None, dependencies
+  return output, dependencies
+
+
+def write_output(fname, output, args):
+  out_fname = output_filename(fname, args)
+  if out_fname is not None:
     open(out_fname,'w').write(output.encode('utf-8'))
   else:
     print(output.encode('utf-8'))
 
-if __name__ == "__main__":
-  main()
 
+# Per-process state of the batch workers (see _init_batch_worker)
+_batch_args = None
+_batch_template = None
+_batch_substitutions = None
+_batch_cache = None
+
+def _init_batch_worker(args, template, substitutions):
+    global _batch_args, _batch_template, _batch_substitutions, _batch_cache
+    root_logger.setLevel(logging.FATAL-args.verbose*10)
+    # The documents are already processed in parallel (and
+    # the daemonic workers can not have pools of their own)
+    args.parallel = False
+    _batch_args = args
+    _batch_template = template
+    _batch_substitutions = substitutions
+    _batch_cache = open_cache(args)
+    open_label_index(args)
+    if args.profile:
+        profiling.start()
+
+def _batch_profile():
+    """ Returns (and clears) the profile of the documents processed
+        by this worker since the last call (None if not profiling) """
+    if profiling.active is None:
+        return None
+    stats = profiling.active.stats()
+    profiling.active.reset()
+    return stats
+
+def _batch_process(fname):
+    """ Processes a single document of a batch. Returns a tuple
+        (fname, result, error, cache_hit, profile) where result is the
+        list of query lines (for queries) or None, error is a formatted
+        traceback or None, cache_hit tells whether the output was
+        taken from the render cache (None if the cache was not used)
+        and profile holds the profiling statistics (if profiling). """
+    try:
+        if _batch_args.query:
+            return fname, query_document(fname, _batch_args), None, None, _batch_profile()
+        hits = _batch_cache and _batch_cache.hits
+        write_document(fname, _batch_args, _batch_template, _batch_substitutions, _batch_cache)
+        return fname, None, None, _batch_cache and _batch_cache.hits > hits, _batch_profile()
+    except Exception:
+        return fname, None, traceback.format_exc(), None, _batch_profile()
+
+def _document_size(fname):
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return 0
+
+def batch(documents, args, template, render_cache=None):
+    """ Processes the @documents in a pool of @args.jobs worker processes.
+        The template, substitutions and the imported modules are shared
+        by all documents processed by a worker. A failure to process a
+        document is reported but does not abort the batch. Returns the
+        list of (fname, error) pairs for documents which failed. The
+        cache hits and misses of the workers are added to the counters
+        of @render_cache and their profiles to the active profiler. """
+    # Start with the largest documents so that a single big document
+    # does not end up being processed last
+    documents = sorted(documents, key=_document_size, reverse=True)
+    substitutions = load_substitutions()
+    if template is not None and not args.query:
+        # Compiled before forking, so the workers share the compiled template
+        compile_template(template)
+    failures = []
+    pool = multiprocessing.Pool(args.jobs, _init_batch_worker, (args, template, substitutions))
+    try:
+        for fname, result, error, cache_hit, profile in pool.imap_unordered(_batch_process, documents):
+            if profile is not None and profiling.active is not None:
+                profiling.active.merge(profile)
+            if render_cache is not None and cache_hit is not None:
+                if cache_hit:
+                    render_cache.hits += 1
+                else:
+                    render_cache.misses += 1
+            if error:
+                logger.critical('Failed to process '+fname+':\n'+error)
+                failures.append((fname, error))
+            elif result is not None:
+                for line in result:
+                    print((fname+':'+line).encode('utf-8'))
+            else:
+                logger.info('Processed '+fname)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return failures
+
+
+def _file_states(fnames):
+    """ Returns a dict mapping each of the @fnames to its (mtime, size)
+        or to None if it does not exist """
+    ret = {}
+    for fname in fnames:
+        try:
+            st = os.stat(fname)
+            ret[fname] = (st.st_mtime, st.st_size)
+        except OSError:
+            ret[fname] = None
+    return ret
+
+def _watch_snapshot(args, libraries):
+    """ Returns the documents given by @args together with the states
+        (see _file_states) of the documents and of the files all of
+        them depend on: the possible template locations, the
+        .md-substitutions file and the macro @libraries """
+    documents = expand_documents(args.document)
+    dependencies = template_candidates(args.template, args.format)+['.md-substitutions']+sorted(libraries)
+    return documents, _file_states(documents), _file_states(dependencies)
+
+def _changed_documents(documents, previous, current):
+    """ Returns the @documents which need to be recompiled when the
+        snapshot @previous (see _watch_snapshot) changes to @current:
+        all of them if a dependency changed, otherwise those which
+        were modified or created """
+    doc_states, dep_states = previous[1:]
+    new_doc_states, new_dep_states = current[1:]
+    if new_dep_states != dep_states:
+        return documents
+    return [ fname for fname in documents if new_doc_states[fname] != doc_states.get(fname, None) and new_doc_states[fname] is not None ]
+
+def watch(args, render_cache, interval=0.5, debounce=0.2):
+    """ Compiles the documents given by @args and then keeps recompiling
+        those which change. All documents are recompiled when one of the
+        possible template locations, the .md-substitutions file or one
+        of the imported macro libraries changes.
+        Changes are collected until nothing changes for @debounce seconds,
+        so a burst of saves results in a single recompilation. Everything
+        happens in this process, so the markdown instances, the template
+        system and the render cache stay warm between rebuilds, and only
+        the top-level sections which changed are converted again (see
+        render_incremental). With a label index, the documents referencing
+        labels which changed in the rebuilt documents are rebuilt too. """
+    global _section_cache
+    _section_cache = chunks.SectionCache()
+    libraries = set()
+
+    def rebuild(documents, project):
+        template = load_template(args.template, args.format)
+        substitutions = load_substitutions()
+        if _label_index is not None:
+            changed = update_label_index(_label_index, project, args)
+            if changed:
+                documents = documents+[ fname for fname in project if fname not in documents and referenced_labels(read_document(fname), fname) & changed ]
+        for fname in documents:
+            start = time.time()
+            try:
+                m = mdx_macros.ABBREVS_RE.search(read_document(fname))
+                if m:
+                    libraries.update(mdx_macros.collect_definitions(m.group('abbrevs'), document_directory(fname))[1])
+                write_document(fname, args, template, substitutions, render_cache)
+                logger.info('Compiled '+fname+' in %.3fs' % (time.time()-start))
+            except Exception:
+                logger.critical('Failed to process '+fname+':\n'+traceback.format_exc())
 
+    def track_new_libraries(dep_states):
+        # Libraries found while rebuilding should not trigger another rebuild
+        dep_states.update(_file_states([ l for l in libraries if l not in dep_states ]))
 
+    previous = _watch_snapshot(args, libraries)
+    rebuild(previous[0], previous[0])
+    track_new_libraries(previous[2])
+    while True:
+        time.sleep(interval)
+        current = _watch_snapshot(args, libraries)
+        if current[1:] == previous[1:]:
+            continue
+        while True:
+            time.sleep(debounce)
+            settled = _watch_snapshot(args, libraries)
+            if settled[1:] == current[1:]:
+                break
+            current = settled
+        rebuild(_changed_documents(current[0], previous, current), current[0])
+        track_new_libraries(current[2])
+        previous = current
 
 
+def main(argv=None):
+  parser = build_arg_parser()
+  args = parser.parse_args(argv)
 
+  logging.basicConfig()
+  root_logger.setLevel(logging.FATAL-args.verbose*10)
+
+  render_cache = open_cache(args)
+  if args.clearcache:
+      cache.RenderCache(args.cachedir).clear()
+      if len(args.document) == 0:
+          return
+  if args.profile:
+      profiler = profiling.start()
+  if args.profile_dump:
+      cprofiler = cProfile.Profile()
+      cprofiler.enable()
+  try:
+      process_documents(parser, args, render_cache)
+  finally:
+      if args.profile_dump:
+          cprofiler.disable()
+          cprofiler.dump_stats(args.profile_dump)
+      if args.profile:
+          profiling.stop()
+          if args.profile_format == 'json':
+              sys.stderr.write(profiler.format_json())
+          else:
+              sys.stderr.write(profiler.format_table())
+      if args.cachestats and render_cache is not None:
+          stats = render_cache.stats()
+          sys.stderr.write('Render cache: %(hits)d hits, %(misses)d misses, %(entries)d entries, %(size)d bytes\n' % stats)
+      if args.cachestats:
+          sys.stderr.write('Selector cache: %(hits)d hits, %(misses)d misses, %(size)d selectors\n' % selector_cache.stats())
+      if args.cachestats and _section_cache is not None:
+          sys.stderr.write('Section cache: %(hits)d hits, %(misses)d misses, %(entries)d sections\n' % _section_cache.stats())
+
+
+def process_documents(parser, args, render_cache):
+  documents = expand_documents(args.document)
+  if len(documents) == 0:
+      parser.error('no documents found')
+  label_index = open_label_index(args)
+  if args.watch:
+      if args.query:
+          parser.error('--watch can not be used with --query')
+      if args.output and len(documents) > 1:
+          parser.error('--output can not be used with multiple documents')
+      if not args.output:
+          args.autooutput = True
+      try:
+          watch(args, render_cache)
+      except KeyboardInterrupt:
+          pass
+      return
+  if label_index is not None:
+      update_label_index(label_index, documents, args)
+  if len(documents) > 1 or documents != args.document:
+      if args.output:
+          parser.error('--output can not be used with multiple documents')
+      args.autooutput = True
+      template = load_template(args.template, args.format)
+      failures = batch(documents, args, template, render_cache)
+      if failures:
+          logger.critical(str(len(failures))+' of '+str(len(documents))+' documents failed')
+          exit(1)
+      return
 
+  fname = documents[0]
 
+  try:
+    if args.query:
+        for line in query_document(fname, args):
+            print(line.encode('utf-8'))
+        return
 
+    template = load_template(args.template, args.format)
+    write_document(fname, args, template, render_cache=render_cache)
+  except mdtree.NestingTooDeep as e:
+    logger.critical(fname+': '+str(e))
+    exit(1)
 
+if __name__ == "__main__":
+  main()
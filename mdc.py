@@ -0,0 +1,100 @@
+#!/usr/bin/python
+'''
+A tiny client for the md.py render server (see server.py).
+
+Takes the same arguments as md.py. The server address is taken from
+the MD_SERVER environment variable (defaulting to the default server
+socket, see default_address). If no server is running, the socket
+does not belong to the current user, or the server does not support
+some of the arguments, the document is processed locally.
+'''
+
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+import tempfile
+
+
+def socket_directory(create=False):
+    """ Returns the directory of the default server socket, which is
+        either $XDG_RUNTIME_DIR or a directory private to the current
+        user (mode 0700) in the temporary directory, created if @create.
+        Raises OSError if the latter does not exist or is not private
+        (e.g. because another user created it first). """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR', None)
+    if runtime_dir:
+        return runtime_dir
+    directory = os.path.join(tempfile.gettempdir(), 'md-server-'+str(os.getuid()))
+    if create:
+        try:
+            os.mkdir(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError(errno.EPERM, 'Not a private directory of the current user', directory)
+    return directory
+
+
+def default_address(create=False):
+    """ Returns the default path of the server socket (see socket_directory) """
+    return os.path.join(socket_directory(create), 'md-server.sock')
+
+
+def check_socket(address):
+    """ Raises socket.error unless @address is a unix socket owned
+        by the current user """
+    try:
+        st = os.stat(address)
+    except OSError as e:
+        raise socket.error(e.errno, e.strerror)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise socket.error(errno.EPERM, address+' is not a socket of the current user')
+
+
+def request(address, argv, cwd=None, stdin=None):
+    """ Sends the md.py arguments @argv to the server listening
+        on the unix socket @address and returns its response dict """
+    check_socket(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        req = {'argv':argv, 'cwd':cwd or os.getcwd()}
+        if stdin is not None:
+            req['stdin'] = stdin
+        sock.sendall(json.dumps(req).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def main():
+    argv = sys.argv[1:]
+    stdin = None
+    if '-' in argv:
+        stdin = sys.stdin.read().decode('utf-8', 'ignore')
+    try:
+        response = request(os.environ.get('MD_SERVER', None) or default_address(), argv, stdin=stdin)
+    except (socket.error, OSError):
+        response = {'unsupported':True}
+    if response.get('unsupported', False):
+        import md
+        md.main(argv)
+        return
+    sys.stdout.write(response['stdout'].encode('utf-8'))
+    sys.stderr.write(response['stderr'].encode('utf-8'))
+    sys.exit(response['status'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+'''
+In-memory conversion of markdown trees
+======================================
+
+Runs a markdown.Markdown instance up to (and including) its
+treeprocessors and converts the resulting tree directly into
+an lxml html tree, skipping the serialization to html text and
+its subsequent parsing.
+
+The text postprocessors of markdown only deal with placeholders
+(which all start with markdown.util.STX) so they are applied only
+to the (few) text nodes containing them.
+
+'''
+
+import logging
+import re
+
+import lxml.etree
+from markdown import util
+from markdown.util import etree
+
+logger =  logging.getLogger(__name__)
+
+# Postprocessors whose effect on a text node does not depend on the rest of the document
+KNOWN_POSTPROCESSORS = ['raw_html', 'amp_substitute', 'footnote', 'unescape']
+
+VOID_ELEMENTS = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
+HTML_COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z][^\s/>]*)[^>]*?(/?)>')
+
+# The maximal nesting depth of the elements of a converted document.
+# The treeprocessors and the serializer of markdown recurse into the
+# children of each element, so deeper documents are rejected (see
+# check_depth) instead of exhausting the stack.
+MAX_DEPTH = 500
+
+
+class NestingTooDeep(ValueError):
+    pass
+
+
+def tree_depth(root):
+    """ Returns the nesting depth of the elements of the tree @root """
+    ret = 0
+    stack = [(root, 1)]
+    while stack:
+        element, depth = stack.pop()
+        ret = max(ret, depth)
+        stack.extend([ (child, depth+1) for child in element ])
+    return ret
+
+
+def check_depth(root):
+    """ Raises NestingTooDeep if the tree @root is nested deeper than MAX_DEPTH """
+    depth = tree_depth(root)
+    if depth > MAX_DEPTH:
+        raise NestingTooDeep('The document is nested '+str(depth)+' levels deep, at most '+str(MAX_DEPTH)+' levels are supported')
+
+
+def convert_to_tree(md, source):
+    """ Runs the preprocessors, the block parser and the treeprocessors
+        of the markdown instance @md on @source (i.e. everything
+        md.convert does except for the serialization and the text
+        postprocessors) and returns the resulting tree or None if
+        the document is empty. """
+    if not source.strip():
+        return None
+    md.lines = util.text_type(source).split("\n")
+    for prep in md.preprocessors.values():
+        md.lines = prep.run(md.lines)
+    root = md.parser.parseDocument(md.lines).getroot()
+    check_depth(root)
+    for treeprocessor in md.treeprocessors.values():
+        new_root = treeprocessor.run(root)
+        if new_root is not None:
+            root = new_root
+    return root
+
+
+def serialize(md, root):
+    """ Serializes the @root produced by convert_to_tree exactly as md.convert would """
+    if root is None:
+        return u''
+    output = md.serializer(root)
+    if md.stripTopLevelTags:
+        try:
+            start = output.index('<%s>' % md.doc_tag) + len(md.doc_tag) + 2
+            end = output.rindex('</%s>' % md.doc_tag)
+            output = output[start:end].strip()
+        except ValueError:
+            if output.strip().endswith('<%s />' % md.doc_tag):
+                output = ''
+            else:
+                raise
+    for pp in md.postprocessors.values():
+        output = pp.run(output)
+    return output.strip()
+
+
+class NeedsSerialization(Exception):
+    pass
+
+
+def _self_contained(html):
+    """ Returns True if the raw @html does not contain any unclosed
+        (or unopened) tags, so that it can be parsed on its own """
+    stack = []
+    for m in HTML_TAG_RE.finditer(HTML_COMMENT_RE.sub('',html)):
+        closing, tag, self_closing = m.groups()
+        tag = tag.lower()
+        if tag in VOID_ELEMENTS or self_closing:
+            continue
+        if closing:
+            if not stack or stack.pop() != tag:
+                return False
+        else:
+            stack.append(tag)
+    return len(stack) == 0
+
+
+def _is_block_level(html):
+    m = re.match(r'^\<\/?([^ >]+)', html)
+    if m:
+        if m.group(1)[0] in ('!', '?', '@', '%'):
+            return True
+        return util.isBlockLevel(m.group(1))
+    return False
+
+
+class LxmlBuilder(object):
+    """ Converts a tree produced by the markdown instance @md into
+        an lxml html tree. Use can_build to check whether the current
+        document can be converted before calling build, which raises
+        NeedsSerialization if it encounters raw html it can not handle. """
+
+    def __init__(self, md):
+        self.md = md
+        stash = md.htmlStash
+        self.raw_html = [ html for (html, safe) in stash.rawHtmlBlocks[:stash.html_counter] ]
+        self.postprocessors = [ pp for (name, pp) in md.postprocessors.items() if name != 'raw_html' ]
+
+    def can_build(self):
+        if self.md.safeMode:
+            return False
+        for name in self.md.postprocessors.keys():
+            if name not in KNOWN_POSTPROCESSORS:
+                return False
+        return True
+
+    def _raw_html(self, m):
+        return self.raw_html[int(m.group(1))]
+
+    def _postprocess(self, text):
+        """ Applies the markdown postprocessors to the (escaped) @text """
+        text = util.HTML_PLACEHOLDER_RE.sub(self._raw_html, text)
+        for pp in self.postprocessors:
+            text = pp.run(text)
+        return text
+
+    def _append_text(self, parent, text):
+        """ Appends @text after the last child of @parent """
+        if not text:
+            return
+        if len(parent) > 0:
+            parent[-1].tail = (parent[-1].tail or '') + text
+        else:
+            parent.text = (parent.text or '') + text
+
+    def _append_markup(self, parent, html):
+        """ Parses the @html and appends the result after the last child of @parent """
+        if '<' not in html and '&' not in html and util.STX not in html and util.ETX not in html:
+            self._append_text(parent, html)
+            return
+        # Raw html which opens a tag in one text node and closes it in another
+        # would have to be parsed in the context of the whole document
+        if '<' in html and not _self_contained(html):
+            raise NeedsSerialization()
+        wrapped = u'<html><body><div>'+html+u'</div></body></html>'
+        fragment = lxml.etree.fromstring(wrapped.encode('utf-8'), lxml.etree.HTMLParser(encoding='utf-8')).find('body/div')
+        self._append_text(parent, fragment.text)
+        for child in list(fragment):
+            parent.append(child)
+
+    def _append_source_text(self, parent, text):
+        if not text:
+            return
+        if util.STX in text:
+            self._append_markup(parent, self._postprocess(_escape_cdata(text)))
+        else:
+            self._append_text(parent, text)
+
+    def _attribute(self, value):
+        if util.STX not in value:
+            return value
+        html = self._postprocess(_escape_attrib(value))
+        p = lxml.etree.fromstring((u'<html><body><p a="'+html+u'"></p></body></html>').encode('utf-8'), lxml.etree.HTMLParser(encoding='utf-8')).find('body/p')
+        return p.get('a', '')
+
+    def _new_element(self, parent, src):
+        if src.tag is etree.Comment:
+            el = lxml.etree.Comment(src.text)
+            parent.append(el)
+            return el
+        el = lxml.etree.SubElement(parent, src.tag)
+        # The markdown serializer outputs attributes in lexical order
+        for (key, value) in sorted(src.items()):
+            el.set(key, self._attribute(value))
+        return el
+
+    def _raw_block_index(self, src):
+        """ Returns the index of the raw html block if @src is a paragraph
+            which markdown would replace by the block, otherwise None """
+        if src.tag != 'p' or len(src) > 0 or src.attrib or not src.text:
+            return None
+        m = util.HTML_PLACEHOLDER_RE.match(src.text)
+        if not m or m.end() != len(src.text):
+            return None
+        index = int(m.group(1))
+        if index < len(self.raw_html) and _is_block_level(self.raw_html[index]):
+            return index
+        return None
+
+    def build(self, root):
+        """ Returns the lxml <html> tree corresponding to the markdown @root """
+        html = lxml.etree.Element('html')
+        lxml.etree.SubElement(html, 'head')
+        body = lxml.etree.SubElement(html, 'body')
+        if root is None:
+            return html
+
+        # Each item on the stack is a source element whose children still
+        # need to be converted and the lxml element they should be added to
+        stack = [(root, body)]
+        while stack:
+            src, dst = stack.pop()
+            if src is root:
+                self._append_source_text(dst, (src.text or '').lstrip())
+            elif src.tag is not etree.Comment:
+                self._append_source_text(dst, src.text)
+            for child in src:
+                index = self._raw_block_index(child)
+                if index is not None:
+                    self._append_markup(dst, self.raw_html[index]+'\n')
+                else:
+                    stack.append((child, self._new_element(dst, child)))
+                self._append_source_text(dst, child.tail)
+
+        # The serialized document is stripped
+        if len(body) > 0 and body[-1].tail:
+            body[-1].tail = body[-1].tail.rstrip() or None
+        elif body.text:
+            body.text = body.text.rstrip() or None
+        return html
+
+
+def _escape_cdata(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _escape_attrib(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\"", "&quot;").replace("\n", "&#10;")
+
+
+def to_lxml(md, root):
+    """ Converts the @root produced by convert_to_tree into an
+        lxml <html> tree equivalent to parsing the html output of
+        md.convert. Returns None if the document contains raw html
+        which can only be handled by serializing the whole document
+        (see serialize). """
+    builder = LxmlBuilder(md)
+    if not builder.can_build():
+        return None
+    try:
+        return builder.build(root)
+    except NeedsSerialization:
+        logger.debug("Document contains unbalanced raw html, falling back to serialization")
+    except ValueError as e:
+        # lxml refuses control characters which the html parser would handle
+        logger.debug("Document is not XML compatible ("+str(e)+"), falling back to serialization")
+    return None
@@ -70,24 +70,37 @@ def _latex_from_blocktypes(types,position):
     return ret
 
 
+# The headings generated for each set of block types, see headings_from_types
+_headings_cache = {}
+
+def headings_from_types(types, position='before', format='css'):
+    """ Returns the css (@format='css') or LaTeX (@format='latex') code
+        defining the headings of the block @types (e.g. the BlockTypes
+        of a markdown instance). The code is generated only once for
+        each set of types. """
+    key = (frozenset(types), position, format)
+    ret = _headings_cache.get(key, None)
+    if ret is None:
+        # Sorted, so that the code does not depend on the order of the set
+        types = sorted(key[0])
+        if format == 'css':
+            ret = _css_from_blocktypes(types,position)
+        elif format == 'latex':
+            ret = _latex_from_blocktypes(types,position)
+        _headings_cache[key] = ret
+    return ret
+
 def build_headings(doc, position='before', format='css'):
-    """ @position = 'before' (Theorem 3.1) / 'after' ( 3.1 Theorem ) """
-    def walk(node):
-        ret = set([])
-        for child in node:
-            if 'block' in child.get('class','').split(' '):
-                ret.add(child.get('type',''))
-            ret = ret.union(walk(child))
-        return ret
-
-    block_types = walk(doc)
-    if format == 'css':
-        return _css_from_blocktypes(block_types,position)
-    elif format == 'latex':
-        return _latex_from_blocktypes(block_types,position)
-
-class EndOfDfBlockException(Exception):
-    pass
+    """ @position = 'before' (Theorem 3.1) / 'after' ( 3.1 Theorem )
+
+        Returns the headings (see headings_from_types) of the types of
+        the blocks in the tree @doc. A converted document need not be
+        walked, its types are recorded in md.BlockTypes. """
+    block_types = set()
+    for node in doc.iter():
+        if node is not doc and 'block' in (node.get('class') or '').split(' '):
+            block_types.add(node.get('type',''))
+    return headings_from_types(block_types, position, format)
 
 class DefinitionBlockProcessor(BlockProcessor):
 
@@ -109,30 +122,80 @@ class DefinitionBlockProcessor(BlockProcessor):
 
   END_RE = re.compile(r'(.*){}\s*$', re.DOTALL)
 
+  # The part of START_RE before the name, references and colon: a quick
+  # test rejecting most blocks (START_RE only fails on those after trying
+  # the rest of the pattern, which may scan the whole block)
+  START_PREFIX_RE = re.compile(r'\s*[^0-9\s:\\()\][]*\**\s*[:(\[]')
+
+  # The whitespace matched by \s in START_RE and END_RE
+  WHITESPACE = ' \t\n\r\f\v'
+
   PROOFS = ['Proof']
 
   THM_STYLE = ['Theorem','Observation','Proposition','Lemma', 'Corollary']
 
   def __init__(self, parser):
       BlockProcessor.__init__(self,parser)
-      self.nested_proofs = 0
+      self.reset()
 
-
-  def _valid_type(self, tp, match):
+  def reset(self):
+      self.nested_proofs = 0
+      # The types of the blocks of the document and the maximal
+      # nesting of its proofs (exposed as md.BlockTypes, md.ProofDepth)
+      self.block_types = set()
+      self.parser.markdown.BlockTypes = self.block_types
+      self.parser.markdown.ProofDepth = 0
+      # The number of top-level definition blocks which were not terminated
+      # (a block started inside e.g. a list item ends with the item)
+      self.unterminated = 0
+      # The last block passed to test_start_block and its match
+      self._tested_block = None
+      self._tested_match = None
+      # Whether a definition block was ended outside of the loop in run
+      self._ended = False
+
+
+  @classmethod
+  def _valid_type(cls, tp, match):
+      # E.g. a link reference definition '[id]: url' has no type
+      if not tp or tp.startswith(markdown.util.STX):
+          return False
       if not (tp[0].upper()==tp[0] and tp[1:].lower() == tp[1:]):
           return False
-      if tp not in self.PROOFS:
+      if tp not in cls.PROOFS:
           return True
-      if match['references'] or match['name'] and not self.PROOF_REFERENCE_RE.match(match['name']):
+      if match['references'] or match['name'] and not cls.PROOF_REFERENCE_RE.match(match['name']):
           return False
       return True
 
+  @classmethod
+  def match_start(cls, block):
+      """ Returns the match of START_RE if @block starts a definition block, otherwise None """
+      if not cls.START_PREFIX_RE.match(block):
+          return None
+      match = cls.START_RE.match(block)
+      if match and cls._valid_type(match.group('type'),match.groupdict()):
+          return match
+      return None
+
+  @classmethod
+  def match_end(cls, block):
+      """ Returns the text of @block before the closing {} if @block
+          ends a definition block (i.e. END_RE matches it), otherwise None """
+      text = block.rstrip(cls.WHITESPACE)
+      if text.endswith('{}'):
+          return text[:-2]
+      return None
+
   def test_start_block( self, parent, block ):
-      match = self.START_RE.match(block)
-      return match and self._valid_type(match.group('type'),match.groupdict())
+      # The match is kept for run, which is called with the same block
+      if block is not self._tested_block:
+          self._tested_block = block
+          self._tested_match = self.match_start(block)
+      return self._tested_match
 
   def test_end_block( self, parent, block ):
-      return self.parser.state.isstate('definition_block') and self.END_RE.match(block)
+      return self.parser.state.isstate('definition_block') and self.match_end(block) is not None
 
   def test(self, parent, block):
       return self.test_start_block(parent, block) or self.test_end_block(parent, block)
@@ -202,70 +265,109 @@ class DefinitionBlockProcessor(BlockProcessor):
             # can access it and can construct the appropriate \begin{proof}[Proof of ...]
             element.set('name',match['type']+' '+referenced_block.text)
 
+  def _open(self, parent, match, blocks, stack):
+      """ Starts the definition block matched by @match in @parent and pushes it on the @stack """
+      # Extract info about the definition/lemma, etc.
+      m = match.groupdict()
+      typ = m['type']
+      self.block_types.add(typ)
+
+      # Create a new div to hold this definition/lemma
+      def_element = etree.SubElement(parent, 'div')
+
+      # Add info about the element to the etree
+      self.add_info(def_element,m)
+
+      # Take the remainder of this block (i.e. withouth the
+      # definition header) and add it to the list of blocks
+      # to process
+      blocks.insert(0,m['rest'])
+
+      # Add a definition_block to the current state stack
+      self.parser.state.set('definition_block')
+
+      # Keep track of nested proofs
+      # (so that we may end them with the right qed symbol)
+      if typ in self.PROOFS:
+          self.nested_proofs += 1
+          if self.nested_proofs > self.parser.markdown.ProofDepth:
+              self.parser.markdown.ProofDepth = self.nested_proofs
+
+      stack.append((def_element, typ, parent))
+
+  def _close(self, stack):
+      """ Ends the innermost definition block on the @stack """
+      def_element, typ, parent = stack.pop()
+
+      # Pop the current definition_block from the state stack
+      self.parser.state.reset()
+
+      # Test whether we are ending a proof and
+      # add a QED sign if yes
+      if typ in self.PROOFS:
+          qed = etree.SubElement(def_element,'span')
+          if self.nested_proofs > 1:
+              qed.set('class','qed nested')
+          else:
+              qed.set('class','qed')
+          self.nested_proofs -=1
+
+  def _end(self, parent, block):
+      """ Parses the text of the @block ending the definition block @parent """
+      self.parser.parseBlocks(parent,[self.match_end(block)])
+
+  def _parse_block(self, parent, blocks):
+      """ Processes the first of the @blocks with the other block
+          processors (as BlockParser.parseBlocks would) """
+      for processor in self.parser.blockprocessors.values():
+          if processor is not self and processor.test(parent, blocks[0]):
+              if processor.run(parent, blocks) is not False:
+                  break
+
   def run(self, parent, blocks):
       # Process the first of the remaining blocks
       # (blocks are separated by blank lines)
       block = blocks.pop(0)
 
-      # We are starting a new definition/lemma
-      if self.test_start_block(parent,block):
-          # Extract info about the definition/lemma, etc.
-          m = self.START_RE.match(block).groupdict()
-          typ = m['type']
-
-          # Create a new div to hold this definition/lemma
-          def_element = etree.SubElement(parent, 'div')
-
-          # Add info about the element to the etree
-          self.add_info(def_element,m)
-
-          # Take the remainder of this block (i.e. withouth the
-          # definition header) and add it to the list of blocks
-          # to process
-          blocks.insert(0,m['rest'])
-
-          # Add a definition_block to the current state stack
-          self.parser.state.set('definition_block')
-
-          # Keep track of nested proofs
-          # (so that we may end them with the right qed symbol)
-          if typ in self.PROOFS:
-              self.nested_proofs += 1
-
-          # Recursively process the blocks till we find
-          # the end of this definition/lemma
-          try:
-              end_found = False
-              self.parser.parseBlocks(def_element,blocks)
-          except EndOfDfBlockException:
-              end_found = True
-
-          if not end_found:
-              logger.warn("Unterminated definition block")
-
-          # Pop the current definition_block from the state stack
-          self.parser.state.reset()
-
-          # Test whether we are ending a proof and
-          # add a QED sign if yes
-          if typ in self.PROOFS:
-              qed = etree.SubElement(def_element,'span')
-              if self.nested_proofs > 1:
-                  qed.set('class','qed nested')
-              else:
-                  qed.set('class','qed')
-              self.nested_proofs -=1
-
-      # We are ending a definition/lemma
-      else:
-
-          last_text = self.END_RE.match(block).group(1)
-          self.parser.parseBlocks(parent,[last_text])
-
-          # there's no other way to exit the parseBlocks
-          # completely except consuming all the blocks
-          # (we still need them) or throwing an exception
-          raise EndOfDfBlockException()
+      # We are ending a definition/lemma outside of the loop below. This
+      # happens when a processor parses a part of a block separately
+      # (e.g. the text before a heading). The loop ends the innermost
+      # definition block when that processor returns; the remaining
+      # blocks of the separate parse are dropped.
+      match = self.test_start_block(parent,block)
+      if not match:
+          self._end(parent, block)
+          self._ended = True
+          del blocks[:]
+          return
+
+      # We are starting a new definition/lemma. The blocks are processed
+      # till the end of this definition/lemma, keeping the definition
+      # blocks nested in it on a stack (instead of recursing for each)
+      stack = []
+      self._open(parent, match, blocks, stack)
+      while stack and blocks:
+          current = stack[-1][0]
+          match = self.test_start_block(current, blocks[0])
+          if match:
+              blocks.pop(0)
+              self._open(current, match, blocks, stack)
+          elif self.test_end_block(current, blocks[0]):
+              self._end(current, blocks.pop(0))
+              self._ended = False
+              self._close(stack)
+          else:
+              self._parse_block(current, blocks)
+              if self._ended:
+                  self._ended = False
+                  self._close(stack)
+
+      # The blocks ran out before the ends of the remaining definition blocks
+      while stack:
+          logger.warn("Unterminated definition block")
+          if stack[-1][2] is getattr(self.parser, 'root', None):
+              self.unterminated += 1
+          self._close(stack)
 
 
 
@@ -275,8 +377,12 @@ class DefinitionBlockExtension(markdown.Extension):
 
   def extendMarkdown(self,md,md_globals):
     self.md = md
-    ext = DefinitionBlockProcessor(md.parser)
-    md.parser.blockprocessors.add('definitionblock',ext, '_begin')
+    self.processor = DefinitionBlockProcessor(md.parser)
+    md.parser.blockprocessors.add('definitionblock',self.processor, '_begin')
+    md.registerExtension(self)
+
+  def reset(self):
+    self.processor.reset()
 
 def makeExtension(configs={}):
   return DefinitionBlockExtension(configs=configs)
@@ -11,39 +11,101 @@ Adds support for macros.
 Usage
 -----
 
+Macros are defined in an Abbreviations block
+
+    === Abbreviations ===
+    \R = {\mathbb{R}};
+    \norm(x,p=2) = {\|x\|_{p}};
+    \import{macros.tmd}
+    === Abbreviations ===
+
+where the \import line includes the definitions from a shared macro
+library (a file containing either just definitions or an Abbreviations
+block), given relative to the document.
+
 '''
 
+import codecs
+import json
 import logging
+import os
 import re
+import string
+import tempfile
+
+import cache
 
 
 logger =  logging.getLogger(__name__)
 
 
 ABBREVS_RE = re.compile(r"""\s*={3,}\s*Abbreviations\s*={3,}\s*\n(?P<abbrevs>.*)\n\s*={3,}\s*Abbreviations\s*={3,}\s*""",re.DOTALL | re.UNICODE | re.MULTILINE | re.IGNORECASE)
+IMPORT_RE  = re.compile(r"""^[ \t]*\\import{(?P<path>[^}]*)}[ \t]*$""",re.UNICODE | re.MULTILINE)
 ABBREV_RE  = re.compile(r"""\s*\\(?P<name>\w+)(?P<args>\([^)]*\))?\s*=\s*{(?P<body>.*?)};\n\s*""",re.DOTALL | re.UNICODE | re.MULTILINE | re.IGNORECASE)
 
-class macro(object):
+# Tokens relevant for finding the end of the arguments of a macro call
+ARG_TOKEN_RE = re.compile(r'\\.|[(){},]', re.DOTALL)
+CLOSING = {'(':')', '{':'}'}
+
+# The maximal depth of nested macro expansions (a macro whose body calls itself
+# would otherwise be expanded forever)
+MAX_DEPTH = 32
+
+
+def scan_arguments(document, pos):
+    """ Returns the list of the (comma separated) arguments in the
+        parentheses starting at position @pos of the @document and the
+        position after the closing parenthesis. Commas inside nested
+        parentheses or braces do not separate arguments. Returns
+        (None, None) if the parentheses are not balanced. """
+    stack = []
+    values = []
+    start = pos+1
+    for tok in ARG_TOKEN_RE.finditer(document, pos+1):
+        c = tok.group()
+        if c in CLOSING:
+            stack.append(CLOSING[c])
+        elif c == ',':
+            if not stack:
+                values.append(document[start:tok.start()])
+                start = tok.end()
+        elif c in ')}':
+            if stack:
+                if stack.pop() != c:
+                    return None, None
+            elif c == ')':
+                values.append(document[start:tok.start()])
+                return values, tok.end()
+            else:
+                return None, None
+    return None, None
+
+
+def _segments(data):
+    """ Returns the list of compiled segments (see macro._compile) read from @data,
+        raising ValueError unless it consists of strings and integers """
+    if not isinstance(data, list):
+        raise ValueError('invalid compiled macro')
+    for seg in data:
+        if not isinstance(seg, (int, basestring)):
+            raise ValueError('invalid compiled macro')
+    return data
 
-    def _arg_pattern(self,name,optional=True):
-        ret = r"(?P<"+name+"full>(?P<"+name+"br>{[^}]*})|(?P<"+name+"comma>[^,)]*))"
-        if optional:
-            ret = ret + '?'
-        return ret
+
+class macro(object):
 
     def __init__(self, name, args, body):
         self.name = name.strip()
         self.body = body
         self.args = {}
+        self.params = []
+        self.required = 0
         self.invalid = False
         if len(self.name) == 0:
             self.invalid = True
             return
-        pattern = r'\\'+self.name
         if args:
             optional = False
-            required_args = []
-            optional_args = []
             for arg in args.strip('()').split(','):
                 arg = arg.strip()
                 if optional and not '=' in arg:
@@ -53,47 +115,311 @@ class macro(object):
                     optional = True
                     name, default_value = arg.split('=')
                     name = name.strip()
-                    optional_args.append(self._arg_pattern(name,optional=True))
                 else:
                     name, default_value = arg, None
-                    required_args.append(self._arg_pattern(name,optional=False))
+                    self.required += 1
                 self.args[name]=default_value
-            pattern = pattern + r'\('+','.join(required_args)
-            if len(optional_args) > 0:
-                pattern = pattern + ',?'+',?'.join(optional_args)+r'\)'
-            else:
-                pattern = pattern + r'\)'
-        pattern = pattern+'(?![A-Za-z])'
-        self.macro_pattern = re.compile(pattern)
-
-    def _repl(self, match):
-        d = match.groupdict()
-        ret = self.body
-        for name, default in self.args.items():
-            val = d[name+'br'] or d[name+'comma'] or default
+                self.params.append((name, default_value))
+        self.segments = self._compile(body)
+        # A default value may name the other parameters (e.g. \ip(x,y=x))
+        self.defaults = [ default and self._compile(default) for (name, default) in self.params ]
+
+    def to_json(self):
+        """ Returns the compiled macro as a JSON serializable dict (see from_json) """
+        return {'name':self.name, 'body':self.body, 'params':self.params, 'required':self.required,
+                'segments':self.segments, 'defaults':self.defaults}
+
+    @classmethod
+    def from_json(cls, data):
+        """ Returns the (valid) macro described by the dict @data (see to_json)
+            without compiling it again """
+        ret = cls.__new__(cls)
+        ret.name = data['name']
+        ret.body = data['body']
+        ret.params = [ (name, default) for (name, default) in data['params'] ]
+        ret.args = dict(ret.params)
+        ret.required = int(data['required'])
+        ret.invalid = False
+        ret.segments = _segments(data['segments'])
+        ret.defaults = [ default and _segments(default) for default in data['defaults'] ]
+        return ret
+
+    def _compile(self, body):
+        """ Splits the @body (or a default value) into a list of literal strings
+            and (integer) indices of the parameters which should be substituted there.
+            A parameter name is only substituted when it is not part of
+            a longer word or of a control sequence (so that e.g. the
+            parameter 'a' does not change '\langle'). """
+        if not self.params:
+            return [body]
+        names = sorted([ name for (name, default) in self.params ], key=len, reverse=True)
+        index = dict([ (name, i) for (i, (name, default)) in enumerate(self.params) ])
+        param_re = re.compile(r'(?<![\\A-Za-z])('+'|'.join([ re.escape(n) for n in names ])+r')(?![A-Za-z])')
+        segments = []
+        pos = 0
+        for m in param_re.finditer(body):
+            if m.start() > pos:
+                segments.append(body[pos:m.start()])
+            segments.append(index[m.group(1)])
+            pos = m.end()
+        if pos < len(body):
+            segments.append(body[pos:])
+        return segments
+
+    def match(self, document, pos):
+        """ Returns the values of the arguments and the end position of the
+            call of the macro starting at position @pos of @document (which
+            must start with a backslash followed by the name of the macro)
+            or (None, None) if this is not a valid call """
+        end = pos+1+len(self.name)
+        if end < len(document) and document[end] in string.ascii_letters:
+            return None, None
+        if not self.params:
+            return [], end
+        if document[end:end+1] != '(':
+            return None, None
+        values, end = scan_arguments(document, end)
+        if values is None or not self.required <= len(values) <= len(self.params):
+            return None, None
+        # As with the name, a call must not be followed directly by a letter
+        if end < len(document) and document[end] in string.ascii_letters:
+            return None, None
+        return values, end
+
+    def substitute(self, values):
+        """ Returns the body with the parameters replaced by the (positional)
+            argument @values (missing ones are replaced by their defaults,
+            in which the parameters are replaced by their values as well) """
+        vals = []
+        for (i, (name, default)) in enumerate(self.params):
+            val = values[i] if i < len(values) else None
+            if not val and default:
+                val = ''.join([ self._default_value(seg, i, values, vals) if isinstance(seg, int) else seg for seg in self.defaults[i] ])
             if not val:
                 logger.warn("value not supplied for argument "+name)
                 val = ''
-            ret = ret.replace(name, val)
-        return ret
+            vals.append(val)
+        return ''.join([ vals[seg] if isinstance(seg, int) else seg for seg in self.segments ])
+
+    def _default_value(self, index, param, values, vals):
+        """ Returns the value of the parameter @index used in the default of the
+            parameter @param, given the argument @values and the values @vals
+            of the parameters before @param """
+        if index < param:
+            return vals[index]
+        if index < len(values) and values[index]:
+            return values[index]
+        return self.params[index][0]
 
     def apply(self, document):
+        """ Expands the calls of this macro in @document (but not
+            calls of other macros, nor calls in the expansion) """
         if self.invalid:
             return document
-        return self.macro_pattern.sub(self._repl,document)
+        return MacroExpander([self], max_depth=0).expand(document)
 
-def pre_process(document):
-    m = ABBREVS_RE.search(document)
-    if not m:
-        return document
-    document = ABBREVS_RE.sub('\n\n',document)
-    abbrevs = m.groupdict()['abbrevs']
+
+class MacroExpander(object):
+    """ Expands a list of macros in a single scan of the document.
+
+        The arguments of a call are delimited by a balanced bracket
+        scanner, so they may contain parentheses, braces and (nested)
+        calls of other macros. The arguments are substituted into the
+        body unexpanded and the result is expanded again, up to
+        @max_depth levels of nesting. Calls nested deeper are left
+        as they are (and a warning is logged), so with @max_depth=0
+        only the calls in the document itself are expanded.
+    """
+    NAME_RE = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, macros, max_depth=MAX_DEPTH):
+        self.macros = {}
+        for m in macros:
+            if not m.invalid:
+                self.macros[m.name] = m
+        self.max_depth = max_depth
+        # Finds the positions where (at least) one of the macros might apply
+        names = sorted(self.macros.keys(), key=len, reverse=True)
+        if names:
+            self.start_re = re.compile(r'\\(?='+'|'.join([ re.escape(n) for n in names ])+')', re.UNICODE)
+        else:
+            self.start_re = None
+        self._candidates = {}
+
+    def candidates(self, name):
+        """ Returns the list of the macros whose name is a prefix
+            of @name, the longest ones first """
+        ret = self._candidates.get(name, None)
+        if ret is None:
+            ret = []
+            for l in range(len(name), 0, -1):
+                m = self.macros.get(name[:l], None)
+                if m is not None:
+                    ret.append(m)
+            self._candidates[name] = ret
+        return ret
+
+    def _match(self, document, pos):
+        """ Returns the triple (macro, argument values, end) describing
+            the macro call at position @pos of @document or (None, None, None) """
+        name = self.NAME_RE.match(document, pos+1).group()
+        for m in self.candidates(name):
+            values, end = m.match(document, pos)
+            if values is not None:
+                return m, values, end
+        return None, None, None
+
+    def contains_call(self, document):
+        if self.start_re is None:
+            return False
+        for start_match in self.start_re.finditer(document):
+            if self._match(document, start_match.start())[0] is not None:
+                return True
+        return False
+
+    def expand(self, document, depth=0):
+        """ Expands the macro calls in @document """
+        if self.start_re is None or '\\' not in document:
+            return document
+        out = []
+        pos = 0
+        for start_match in self.start_re.finditer(document):
+            start = start_match.start()
+            if start < pos:
+                continue
+            m, values, end = self._match(document, start)
+            if m is None:
+                continue
+            out.append(document[pos:start])
+            text = m.substitute(values)
+            if depth < self.max_depth:
+                text = self.expand(text, depth+1)
+            elif self.max_depth > 0 and self.contains_call(text):
+                logger.warn("macros nested more than "+str(self.max_depth)+" levels deep in "+document[start:end])
+            out.append(text)
+            pos = end
+        out.append(document[pos:])
+        return ''.join(out)
+
+
+def apply_sequentially(macros, document):
+    """ Applies the @macros to the @document one after another
+        (scanning the whole document once for each macro). """
+    for m in macros:
+        document = m.apply(document)
+    return document
+
+
+def parse_macros(abbrevs):
+    """ Returns the list of macros defined in @abbrevs (the contents
+        of an Abbreviations block) in the order they are applied """
     macros = {}
     for abbrev in ABBREV_RE.finditer(abbrevs):
         d = abbrev.groupdict()
         macros[d['name']] = macro(d['name'],d['args'],d['body'])
+    return list(macros.values())
 
-    for m in macros.values():
-        document = m.apply(document)
 
-    return document
+def collect_definitions(abbrevs, base_dir='.', importing=()):
+    """ Returns the list of texts containing the macro definitions of the
+        Abbreviations block @abbrevs, where each \import{path} line is
+        replaced by the definitions in the file path (relative to @base_dir),
+        and the list of the imported files. A macro library is either a file
+        containing just definitions or a document with an Abbreviations block. """
+    texts = []
+    files = []
+    pos = 0
+    for m in IMPORT_RE.finditer(abbrevs):
+        texts.append(abbrevs[pos:m.start()])
+        pos = m.end()
+        path = os.path.normpath(os.path.join(base_dir, m.group('path').strip()))
+        if path in importing:
+            logger.warn("circular import of the macro library "+path)
+            continue
+        files.append(path)
+        try:
+            library = codecs.open(path, 'r', encoding='utf-8').read()
+        except (IOError, OSError) as e:
+            logger.warn("could not import macros from "+path+" ("+str(e)+")")
+            continue
+        block = ABBREVS_RE.search(library)
+        if block:
+            library = block.group('abbrevs')
+        lib_texts, lib_files = collect_definitions(library+'\n', os.path.dirname(path), importing+(path,))
+        texts.extend(lib_texts)
+        files.extend(lib_files)
+    texts.append(abbrevs[pos:])
+    return texts, files
+
+
+def macro_sources(document, base_dir='.'):
+    """ Returns the list of texts defining the macros used by @document
+        (see collect_definitions) """
+    m = ABBREVS_RE.search(document)
+    if not m:
+        return []
+    return collect_definitions(m.group('abbrevs'), base_dir)[0]
+
+
+# Directory where compiled macro sets are stored as JSON (None disables
+# the on-disk cache), see load_macro_set
+cache_directory = None
+
+# Compiled macro sets keyed by the hash of their definitions
+_macro_sets = {}
+MAX_MACRO_SETS = 64
+
+
+# Stored macro sets are only valid for the code which produced them
+_code_version = repr(os.path.getmtime(__file__))
+
+def _macro_set_key(texts):
+    return cache.hash_strings([_code_version]+texts)
+
+
+def load_macro_set(texts):
+    """ Returns a MacroExpander for the macros defined in the @texts.
+        Each distinct set of definitions is compiled only once per process
+        and, if cache_directory is set, is stored there for later runs. """
+    key = _macro_set_key(texts)
+    expander = _macro_sets.get(key, None)
+    if expander is not None:
+        return expander
+    path = None
+    if cache_directory is not None:
+        path = os.path.join(cache_directory, key+'.json')
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+            expander = MacroExpander([ macro.from_json(m) for m in data ])
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            expander = None
+    if expander is None:
+        expander = MacroExpander(parse_macros(''.join(texts)))
+        if path is not None:
+            try:
+                if not os.path.isdir(cache_directory):
+                    os.makedirs(cache_directory)
+                data = json.dumps([ m.to_json() for m in expander.macros.values() ])
+                fd, tmp = tempfile.mkstemp(dir=cache_directory)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data.encode('utf-8'))
+                os.rename(tmp, path)
+            except (IOError, OSError) as e:
+                logger.warn("could not store the compiled macros in "+path+" ("+str(e)+")")
+    if len(_macro_sets) >= MAX_MACRO_SETS:
+        _macro_sets.clear()
+    _macro_sets[key] = expander
+    return expander
+
+
+def pre_process(document, base_dir='.'):
+    """ Removes the Abbreviations block from @document and expands the
+        macros it defines (or imports, relative to @base_dir) """
+    m = ABBREVS_RE.search(document)
+    if not m:
+        return document
+    document = ABBREVS_RE.sub('\n\n',document)
+    texts = collect_definitions(m.groupdict()['abbrevs'], base_dir)[0]
+    return load_macro_set(texts).expand(document)
@@ -13,6 +13,7 @@ Usage
 
 '''
 
+import bisect
 import logging
 import markdown
 
@@ -30,10 +31,13 @@ import re
 logger = logging.getLogger(__name__)
 
 
+REFERENCE_RE = re.compile(r'{\s*ref:\s*#(?P<id>[^\s}]*)[\s]*}')
+
+
 class ReferencesPattern(Pattern):
 
     def __init__(self):
-        markdown.inlinepatterns.Pattern.__init__(self, r'{\s*ref:\s*#(?P<id>[^\s}]*)[\s]*}')
+        markdown.inlinepatterns.Pattern.__init__(self, REFERENCE_RE.pattern)
 
     def handleMatch(self, m):
         node = markdown.util.etree.Element('ref')
@@ -52,27 +56,42 @@ class AnchorPattern(Pattern):
 
 
 class TOCNode(object):
+    """ A node of the table of contents. The children are kept
+        ordered by their (numeric) section numbers. """
+    __slots__ = ['title', 'ids', 'nodes', 'root']
+
     def __init__(self, title=None, root=False):
         self.title = title
-        self.children = {}
+        self.ids = []
+        self.nodes = []
         self.root = root
 
+    def items(self):
+        """ Returns the list of the pairs (number, node) of the children """
+        return zip(self.ids, self.nodes)
+
     def _get_child(self, id, create=True):
-        if id in self.children:
-            return self.children[id]
+        id = int(id)
+        # Sections are inserted in order, so the child is usually the last one
+        if self.ids and self.ids[-1] == id:
+            return self.nodes[-1]
+        pos = bisect.bisect_left(self.ids, id)
+        if pos < len(self.ids) and self.ids[pos] == id:
+            return self.nodes[pos]
         if create:
-            self.children[id] = TOCNode()
-            return self.children[id]
+            node = TOCNode()
+            self.ids.insert(pos, id)
+            self.nodes.insert(pos, node)
+            return node
         return None
 
     def _get_descendant(self, path, create=True):
-        if len(path) == 0:
-            return self
-        child = self._get_child(path[0], create)
-        if child:
-            return child._get_descendant(path[1:], create)
-        else:
-            return child
+        node = self
+        for id in path:
+            node = node._get_child(id, create)
+            if node is None:
+                return None
+        return node
 
     def to_element(self, prefix=''):
         if self.root:
@@ -90,70 +109,118 @@ class TOCNode(object):
             element.set('path', prefix)
         if len(prefix) > 0:
             prefix = prefix + '.'
-        if len(self.children) > 0:
+        if len(self.nodes) > 0:
             children = etree.SubElement(element, 'ul')
-            for (id, node) in sorted(self.children.items()):
-                children.append(node.to_element(prefix+id))
+            for (id, node) in self.items():
+                children.append(node.to_element(prefix+str(id)))
         return element
 
-    def insert_section(self, section_number, title):
-        path = section_number.split('.')
-        node = self._get_descendant(path, create=True)
+    def insert_section(self, section, title):
+        """ Sets the @title of the section numbered @section (a dotted
+            string or a sequence of numbers) """
+        if isinstance(section, basestring):
+            section = section.split('.')
+        node = self._get_descendant(section, create=True)
         node.title = title
 
 
 class BlockNumberingProcessor(Treeprocessor):
+    # The kinds of the events recorded by _walk (see run)
+    CLEAR, BLOCK, BLOCK_NUMBER, LABEL = range(4)
+
     def __init__(self, md_instance, number_referenced_only, number_by_type):
         self.depth_limit = 1
+        self.number_by_type = number_by_type
+        self.md = md_instance
+        self.number_referenced_only = number_referenced_only
+        self.reset()
+
+    def reset(self):
+        """ Clears the numbering state so that the processor
+            can be used for a new document """
         self.current_section_tuple = [0]*self.depth_limit
         self.current_numbering = {}
+        self.current_number = ''
         self.inBlock = False
         self.inBlockType = ''
         self.labels = {}
-        self.number_by_type = number_by_type
-        self.md = md_instance
-        self.number_referenced_only = number_referenced_only
+        self.md.Labels = self.labels
+        # The labels defined in other documents, used for the references
+        # to labels not defined in this one (maps the keys to the pairs
+        # (number, href), see md.external_labels)
+        self.external_labels = {}
+        # Whether to warn about references to undefined labels (chunks
+        # of a document rendered separately leave that to resolve_references)
+        self.warn_undefined = True
+
+    @property
+    def current_section_tuple(self):
+        return self._section_tuple
+
+    @current_section_tuple.setter
+    def current_section_tuple(self, numbers):
+        self._section_tuple = list(numbers)
+        # The formatted section numbers of the prefixes of the tuple
+        # (self._section_strings[i] is the number of its first i+1 items)
+        self._section_strings = []
+        for number in self._section_tuple:
+            self._push_section(number)
+
+    def _push_section(self, number):
+        if self._section_strings:
+            self._section_strings.append(self._section_strings[-1]+'.'+str(number))
+        else:
+            self._section_strings.append(str(number))
 
     def section(self, tag):
+        """ Advances the section numbering if @tag is a heading. Returns
+            None if it is not, otherwise whether the block numbering
+            restarts at the heading. """
         depth = self._tag2depth(tag)
         if depth is None:
-            return False
-        logger.debug('SECTION: '+str(self.current_section_tuple)+'='+self.section_number())
-        if depth < len(self.current_section_tuple):
-            self.current_section_tuple[depth] += 1
-            self.current_section_tuple = self.current_section_tuple[:depth+1]
+            return None
+        logger.debug('SECTION: %s=%s', self._section_tuple, self.section_number())
+        if depth < len(self._section_tuple):
+            del self._section_tuple[depth+1:]
+            del self._section_strings[depth:]
+            self._section_tuple[depth] += 1
+            self._push_section(self._section_tuple[depth])
         else:
-            self.current_section_tuple.append(1)
-        if depth < self.depth_limit:
-            self.clear_numbering()
-        return True
+            self._section_tuple.append(1)
+            self._push_section(1)
+        return depth < self.depth_limit
 
     def section_number(self, depth=None):
-        if depth is None:
-            depth = len(self.current_section_tuple)
-        return '.'.join(map(lambda x: str(x), self.current_section_tuple[:depth]))
+        """ Returns the number of the current section (truncated
+            to @depth levels) as a dotted string """
+        if depth is None or depth > len(self._section_strings):
+            depth = len(self._section_strings)
+        if depth == 0:
+            return ''
+        return self._section_strings[depth-1]
 
     def clear_numbering(self):
         for k in self.current_numbering:
             self.current_numbering[k] = 0
 
-    def block_number(self, typ):
+    def block_number(self, typ, prefix=None):
+        """ Returns the current number of blocks of type @typ in the
+            section numbered @prefix (default: the current section) """
         if not self.number_by_type:
             typ = 'generic'
-        logger.debug('BLOCK_NUMBER:'+str(self.current_numbering))
-        return self.section_number(depth=self.depth_limit)+'.'+str(self.current_numbering[typ])
+        if prefix is None:
+            prefix = self.section_number(depth=self.depth_limit)
+        logger.debug('BLOCK_NUMBER:%s', self.current_numbering)
+        return prefix+'.'+str(self.current_numbering[typ])
 
-    def block_is_labeled(self, block):
-        return block.find('.//label') is not None
-
-    def next_number(self, typ):
+    def next_number(self, typ, prefix=None):
         if not self.number_by_type:
             typ = 'generic'
         try:
             self.current_numbering[typ] += 1
         except:
             self.current_numbering[typ] = 1
-        return self.block_number(typ)
+        return self.block_number(typ, prefix)
 
     def _tag2depth(self, tag):
         if len(tag) != 2 or not tag.startswith('h'):
@@ -164,32 +231,96 @@ class BlockNumberingProcessor(Treeprocessor):
             return None
 
     def run(self, root):
+        """ Numbers the sections, blocks and labels in a single walk of
+            the tree. Whether a block is numbered may depend on labels
+            inside it (number_referenced_only), so the walk records the
+            numbering events in document order and the blocks and labels
+            are numbered by replaying them (see _number). The references
+            found by the walk are resolved afterwards. """
         self.current_number = ''
-        self._recursive_run(root)
-        self._recursive_ref(root)
+        self.events = []
+        refs = []
+        self._current_block = None
+        self._walk(root, refs)
+        self._number(self.events)
+        self.events = []
+        self._resolve_references(refs)
         return root
 
-    def _recursive_ref(self, root):
-        for child in root:
-            logger.debug(child.tag)
-            if child.tag == 'ref':
-                    logger.debug(child.tag+'->'+child.get('key'))
-                    number = etree.SubElement(child, 'a')
-                    number.set('class', 'reference_number')
-                    try:
-                        number.text = self.labels[child.get('key', '')]
-                        number.set('href', '#'+self.labels[child.get('key', '')])
-                    except:
-                        logger.warn('Undefined reference \''+child.get('key')+"'")
-                        number.text = '??'
+    def _resolve_references(self, refs):
+        for ref in refs:
+            logger.debug('%s->%s', ref.tag, ref.get('key'))
+            number = etree.SubElement(ref, 'a')
+            number.set('class', 'reference_number')
+            key = ref.get('key', '')
+            if key in self.labels:
+                number.text = self.labels[key]
+                number.set('href', '#'+self.labels[key])
+            elif key in self.external_labels:
+                number.text, href = self.external_labels[key]
+                number.set('href', href)
             else:
-                    self._recursive_ref(child)
-
-    def _recursive_run(self, root):
-        clearInBlock = False
-        for child in root:
+                if self.warn_undefined:
+                    logger.warn('Undefined reference \''+ref.get('key')+"'")
+                number.text = '??'
+
+    def _number(self, events):
+        """ Numbers the blocks and labels by replaying the @events
+            recorded by _walk """
+        for event in events:
+            kind = event[0]
+            if kind == self.CLEAR:
+                self.clear_numbering()
+            elif kind == self.BLOCK:
+                (kind, block, typ, prefix, labeled) = event
+                if not self.number_referenced_only or labeled:
+                    self.current_number = self.next_number(typ, prefix)
+                    block.set('id', self.current_number)
+                    block.set('class', block.get('class', '')+' anchor')
+                else:
+                    block.set('class', block.get('class', '')+' do_not_number')
+            elif kind == self.BLOCK_NUMBER:
+                (kind, element, block_event) = event
+                if block_event is not None and (not self.number_referenced_only or block_event[4]):
+                    element.text = self.current_number
+            else:
+                (kind, key, in_block, typ, prefix) = event
+                if in_block:
+                    number = self.block_number(typ, prefix)
+                else:
+                    number = 'sec'+prefix
+                self.labels[key] = number
+
+    def _walk(self, root, refs):
+        """ Numbers the sections in @root, records the numbering events
+            of its blocks and labels and appends its references to
+            @refs. The tree is walked with an explicit stack, so that
+            it may be nested arbitrarily deep. """
+        # Each frame holds the iterator over the children of an element,
+        # whether a block was among the children walked so far, whether
+        # a label was found in them and the event of the block being walked
+        stack = [[iter(root), False, False, None]]
+        while stack:
+            frame = stack[-1]
+            child = next(frame[0], None)
+            if child is None:
+                stack.pop()
+                if stack:
+                    # The walk of the child of the parent frame is finished
+                    parent = stack[-1]
+                    if frame[2]:
+                        parent[2] = True
+                        if parent[3] is not None:
+                            parent[3][4] = True
+                    if parent[1]:
+                        self.inBlock = False
+                continue
             child_classes = child.get('class', '').split(' ')
-            if self.section(child.tag):
+            frame[3] = None
+            clear = self.section(child.tag)
+            if clear is not None:
+                if clear:
+                    self.events.append((self.CLEAR,))
                 title = child.text
                 child.text = ''
                 number = etree.SubElement(child, 'span')
@@ -197,32 +328,56 @@ class BlockNumberingProcessor(Treeprocessor):
                 number.set('class', 'section_number anchor')
                 number.text = self.section_number()
                 number.tail = title
-                self.md.TOC.insert_section(self.section_number(), title)
+                self.md.TOC.insert_section(self._section_tuple, title)
             elif 'block' in child_classes:
                 self.inBlock = True
                 self.inBlockType = child.get('type', '')
-                self.doNotNumber = True
-                clearInBlock = True
+                self._current_block = None
+                frame[1] = True
                 if 'do_not_number' not in child_classes:
-                    if not self.number_referenced_only or self.block_is_labeled(child):
-                        self.current_number = self.next_number(child.get('type', ''))
-                        child.set('id', self.current_number)
-                        child.set('class', child.get('class', '')+' anchor')
-                        self.doNotNumber = False
-                    else:
-                        child.set('class', child.get('class', '')+' do_not_number')
+                    # Whether the block is labeled is known after its contents are walked
+                    frame[3] = [self.BLOCK, child, child.get('type', ''), self.section_number(depth=self.depth_limit), False]
+                    self.events.append(frame[3])
+                    self._current_block = frame[3]
             elif 'block_number' in child_classes:
-                if not self.doNotNumber:
-                    child.text = self.current_number
+                self.events.append((self.BLOCK_NUMBER, child, self._current_block))
             elif 'label' == child.tag:
                 if self.inBlock:
-                    number = self.block_number(self.inBlockType)
+                    prefix = self.section_number(depth=self.depth_limit)
                 else:
-                    number = 'sec'+self.section_number()
-                self.labels[child.get('key', '')] = number
-            self._recursive_run(child)
-            if clearInBlock:
-                self.inBlock = False
+                    prefix = self.section_number()
+                self.events.append((self.LABEL, child.get('key', ''), self.inBlock, self.inBlockType, prefix))
+                frame[2] = True
+            elif 'ref' == child.tag:
+                refs.append(child)
+            stack.append([iter(child), False, False, None])
+
+
+def resolve_references(root, labels, external_labels=None):
+    """ Sets the numbers of the references in the (lxml) tree @root
+        according to @labels, which maps the label keys to numbers,
+        or, for keys not in @labels, to @external_labels (see
+        BlockNumberingProcessor.external_labels) """
+    if external_labels is None:
+        external_labels = {}
+    for ref in root.iter('ref'):
+        for number in ref:
+            if number.tag == 'a' and number.get('class') == 'reference_number':
+                break
+        else:
+            continue
+        key = ref.get('key', '')
+        if key in labels:
+            number.text = labels[key]
+            number.set('href', '#'+labels[key])
+        elif key in external_labels:
+            number.text, href = external_labels[key]
+            number.set('href', href)
+        else:
+            logger.warn('Undefined reference \''+key+"'")
+            number.text = '??'
+            if 'href' in number.attrib:
+                del number.attrib['href']
 
 
 class ReferencesExtension(markdown.Extension):
@@ -242,10 +397,15 @@ class ReferencesExtension(markdown.Extension):
     def extendMarkdown(self, md, md_globals):
         self.md = md
         self.md.TOC = TOCNode(root=True)
-        extNumbering = BlockNumberingProcessor(md, self.config.get('number_referenced_only', False), self.config.get('number_by_type', False))
+        self.processor = BlockNumberingProcessor(md, self.config.get('number_referenced_only', False), self.config.get('number_by_type', False))
         md.inlinePatterns.add('references', ReferencesPattern(), '_begin')
         md.inlinePatterns.add('anchors', AnchorPattern(), '_begin')
-        md.treeprocessors.add('blocknumbering', extNumbering, '>inline')
+        md.treeprocessors.add('blocknumbering', self.processor, '>inline')
+        md.registerExtension(self)
+
+    def reset(self):
+        self.md.TOC = TOCNode(root=True)
+        self.processor.reset()
 
 
 def makeExtension(*args, **configs):
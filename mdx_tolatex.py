@@ -3,10 +3,133 @@ import os
 from markdown.util import etree
 import re
 
-from utils import get_uri_info, get_child_by_css_selector
+from utils import get_uri_info, get_child_by_class
 
 logger =  logging.getLogger(__name__)
 
+class _Region(object):
+  """ A part of the output of a _Writer which may still be stripped """
+  __slots__ = ['pos', 'lstrip', 'hold', 'content']
+
+  def __init__(self, pos, lstrip, hold):
+    self.pos = pos
+    self.lstrip = lstrip
+    self.hold = hold
+    self.content = False
+
+
+class _Writer(object):
+  """ Collects the output of the laTeXRenderer as a list of fragments.
+
+      Parts of the output are marked as regions (see begin) which are
+      stripped of whitespace when they are finished. Leading whitespace
+      is dropped as it is written (it can not become non-leading), so
+      stripping a region only has to look at its trailing fragments.
+      Consequently everything before the last fragment containing
+      non-whitespace can not change anymore and, if an @out file object
+      is given, it is written out as soon as enough of it accumulates.
+  """
+  FLUSH_FRAGMENTS = 4096
+
+  def __init__(self, out=None):
+    self.out = out
+    self.fragments = []
+    # The number of fragments already written to out
+    self.base = 0
+    # The index of the last fragment containing non-whitespace
+    self.last_solid = -1
+    self.regions = []
+    # The number of regions to be stripped which do not have any content yet
+    self.lstrip_pending = 0
+
+  def write(self, s):
+    if not s:
+      return
+    if self.lstrip_pending:
+      s = s.lstrip()
+      if not s:
+        return
+    self.fragments.append(s)
+    if not s.isspace():
+      self.last_solid = self.base+len(self.fragments)-1
+      # Only the innermost regions may lack content
+      for region in reversed(self.regions):
+        if region.content:
+          break
+        region.content = True
+      self.lstrip_pending = 0
+
+  def begin(self, lstrip=False, hold=False):
+    """ Starts a region. If @lstrip is True, leading whitespace of the region
+        is dropped. The contents of a @hold region are not written out
+        until the region is ended by take. """
+    self.regions.append(_Region(self.base+len(self.fragments), lstrip, hold))
+    if lstrip:
+      self.lstrip_pending += 1
+
+  def _pop(self):
+    region = self.regions.pop()
+    if region.lstrip and not region.content:
+      self.lstrip_pending -= 1
+    return region
+
+  def _rstrip(self, pos):
+    """ Removes trailing whitespace from the output starting at @pos """
+    fragments = self.fragments
+    while self.base+len(fragments) > pos:
+      f = fragments[-1].rstrip()
+      if f:
+        fragments[-1] = f
+        break
+      fragments.pop()
+
+  def end(self, strip=False):
+    """ Ends the innermost region, stripping its trailing whitespace if @strip is True """
+    region = self._pop()
+    if strip:
+      self._rstrip(region.pos)
+
+  def rstrip_region(self):
+    """ Strips the trailing whitespace of the innermost region (leaving it open) """
+    self._rstrip(self.regions[-1].pos)
+
+  def take(self):
+    """ Ends the innermost region and returns (and removes) its contents """
+    region = self._pop()
+    start = region.pos-self.base
+    ret = ''.join(self.fragments[start:])
+    del self.fragments[start:]
+    self.last_solid = min(self.last_solid, region.pos-1)
+    return ret
+
+  def flush(self):
+    """ Writes the fragments which can not change anymore to out """
+    limit = min([self.last_solid]+[ r.pos for r in self.regions if r.hold ])
+    self._write_out(limit-self.base)
+
+  def close(self):
+    """ Writes all the remaining fragments to out """
+    self._write_out(len(self.fragments))
+
+  def _write_out(self, count):
+    if count <= 0:
+      return
+    self.out.write(''.join(self.fragments[:count]))
+    del self.fragments[:count]
+    self.base += count
+
+  def maybe_flush(self):
+    if self.out is not None and len(self.fragments) > self.FLUSH_FRAGMENTS:
+      self.flush()
+
+  def getvalue(self):
+    return ''.join(self.fragments)
+
+
+# The operations on the work stack of laTeXRenderer._run
+_RENDER, _END_NODE, _CHILD, _TAIL, _EMIT, _END_STRIP, _MATH_OFF, _LINK = range(8)
+
+
 class laTeXRenderer(object):
   IGNORE_CLASSES = ['section_number','reference_number','block_number', 'block_name','block_references']
 
@@ -16,16 +139,25 @@ class laTeXRenderer(object):
       else:
           self.options = {}
       self.math_mode = False
+      # Maps the names of files whose existence was checked
+      # while rendering to the result of the check
+      self.dependencies = {}
 
   def render_from_HTML(self, html ):
     tree = etree.fromstring(html.encode('utf-8'))
     return self.render_from_dom(tree)
 
-  def render_from_dom(self, dom_tree ):
-    return self._render(dom_tree)
+  def render_from_dom(self, dom_tree, out = None ):
+    """ Returns the LaTeX code for @dom_tree or, if a file object
+        @out is given, writes it there as it is produced """
+    writer = _Writer(out)
+    self._run(dom_tree, writer)
+    if out is None:
+      return writer.getvalue()
+    writer.close()
 
   def _sectionDepth(self,tag):
-    if len(tag) != 2 or not tag.startswith('h'):
+    if not isinstance(tag, basestring) or len(tag) != 2 or not tag.startswith('h'):
       return None
     try:
       return int(tag[1])-1
@@ -37,10 +169,11 @@ class laTeXRenderer(object):
       return ''
     ret = s
     if not self.math_mode:
+      # Backslashes first, so that those of the escapes are kept
+      ret = ret.replace('\\','\\textbackslash{}')
       ret = ret.replace('_','\\'+'_')
       ret = ret.replace('&','\\'+'&')
       ret = ret.replace('%','\\'+'%')
-      ret = ret.replace('\\','\\textbackslash{}')
     return ret
 
   def _ignore_node(self,node):
@@ -50,21 +183,90 @@ class laTeXRenderer(object):
       return False
 
   def _render(self, node, ignore_info_nodes = True):
-    if  ignore_info_nodes and self._ignore_node(node):
-        return ''
-    output=self._escape(node.text)+' '
-    for child in node:
+    """ Returns the LaTeX code for @node """
+    writer = _Writer()
+    self._run(node, writer, ignore_info_nodes)
+    return writer.getvalue()
+
+  def _run(self, root, writer, ignore_info_nodes = True):
+    """ Renders @root into the @writer. Instead of recursing into the
+        children of an element, the work still to be done is kept on
+        a stack of operations, so the depth of the tree is not limited
+        by the recursion limit. The wrapping of an element's contents
+        (e.g. \emph{...}) is written when the element is reached, the
+        closing part is pushed on the stack to be written after the
+        contents. """
+    stack = [(_RENDER, root, ignore_info_nodes)]
+    while stack:
+      op = stack.pop()
+      code = op[0]
+      if code == _RENDER:
+        node = op[1]
+        if op[2] and self._ignore_node(node):
+          continue
+        if len(node) == 0:
+          writer.write(self._escape(node.text)+' ')
+          continue
+        # A nested qed strips the output of its parent produced so far
+        strip = False
+        for child in node:
+          cls = child.get('class')
+          if cls and 'qed' in cls and 'nested' in cls:
+            strip = True
+            break
+        writer.begin(lstrip=strip)
+        writer.write(self._escape(node.text)+' ')
+        stack.append((_END_NODE,))
+        for child in reversed(node):
+          stack.append((_CHILD, child))
+      elif code == _END_NODE:
+        writer.end()
+        writer.maybe_flush()
+      elif code == _TAIL:
+        writer.write(self._escape(op[1].tail))
+      elif code == _EMIT:
+        writer.write(op[1])
+      elif code == _END_STRIP:
+        writer.end(strip=True)
+      elif code == _MATH_OFF:
+        self.math_mode = False
+      elif code == _LINK:
+        self._link(op[1], writer.take().strip(), writer)
+      else:
+        stack.append((_TAIL, op[1]))
+        self._child(op[1], writer, stack)
+
+  def _wrap(self, child, prefix, suffix, output, stack):
+    """ Writes @prefix, the stripped contents of @child and @suffix """
+    if len(child) == 0:
+      if self._ignore_node(child):
+        output.write(prefix+suffix)
+      else:
+        output.write(prefix+self._escape(child.text).strip()+suffix)
+      return
+    output.write(prefix)
+    output.begin(lstrip=True)
+    stack.append((_EMIT, suffix))
+    stack.append((_END_STRIP,))
+    stack.append((_RENDER, child, True))
+
+  def _child(self, child, output, stack):
+      # Comments (only their tail, pushed by _run, is rendered)
+      if not isinstance(child.tag, basestring):
+          return
       sec_depth = self._sectionDepth(child.tag)
       if sec_depth is not None:
           if 'do_not_number' in child.get('class',''):
-              output+='\\'+"sub"*sec_depth+'section*{'+self._render(child).strip()+'}\n'
+              self._wrap(child, '\\'+"sub"*sec_depth+'section*{', '}\n', output, stack)
           else:
-              output+='\\'+"sub"*sec_depth+'section{'+self._render(child).strip()+'}\n'
+              self._wrap(child, '\\'+"sub"*sec_depth+'section{', '}\n', output, stack)
 
       elif child.tag == 'label':
-        output+='\\label{'+child.get('key','')+'} '
+        output.write('\\label{'+child.get('key','')+'} ')
       elif child.tag == 'p':
-        output+='\n\n'+self._render(child)+'\n\n'
+        output.write('\n\n')
+        stack.append((_EMIT, '\n\n'))
+        stack.append((_RENDER, child, True))
       elif child.tag == 'div':
         classes = child.get('class','').split(' ')
         if 'block' in classes:
@@ -72,8 +274,9 @@ class laTeXRenderer(object):
           environment_type = classes[0].lower()
           if 'do_not_number' in classes and environment_type != 'proof':
             environment_type +='*'
-          block_name_tag = get_child_by_css_selector(child, '.block_name')
-          block_refs_tag = get_child_by_css_selector(child, '.block_references')
+          # The name & references of the block (not of the blocks nested in it)
+          block_name_tag = get_child_by_class(child, 'block_name')
+          block_refs_tag = get_child_by_class(child, 'block_references')
           name_ref = []
           if block_name_tag is not None:
               name_ref.append(self._render(block_name_tag, ignore_info_nodes=False).strip())
@@ -85,42 +288,27 @@ class laTeXRenderer(object):
                   name_ref = '[Proof '+name_ref+']'
               else:
                   name_ref = '['+name_ref+']'
-          output +='\n\\begin{'+environment_type+'}'+name_ref+'\n'+self._render(child).strip()+'\n\\end{'+environment_type+'}\n'
+          self._wrap(child, '\n\\begin{'+environment_type+'}'+name_ref+'\n', '\n\\end{'+environment_type+'}\n', output, stack)
       elif 'qed' in child.get('class',''):
           if 'nested' in child.get('class',''):
-              output = output.strip()+r'\renewcommand{\qedsymbol}{$\blacksquare$}'+"\n"
+              output.rstrip_region()
+              output.write(r'\renewcommand{\qedsymbol}{$\blacksquare$}'+"\n")
       elif child.tag == 'em':
-        output+='\\emph{'+self._render(child).strip()+'}'
+        self._wrap(child, '\\emph{', '}', output, stack)
       elif child.tag == 'strong':
-        output+='{\\bf '+self._render(child).strip()+'}'
+        self._wrap(child, '{\\bf ', '}', output, stack)
       elif child.tag == 'ref':
         key = child.get('key','')
-        output+='\\ref{'+key+'}'
+        output.write('\\ref{'+key+'}')
       elif child.tag == 'bib':
         key = child.get('key','')
-        output+='\\cite{'+key+'}'
+        output.write('\\cite{'+key+'}')
       elif child.tag == 'a':
-          # FIXME:
-          # Here we are relying on the fact that
-          # we have already processed <ref> tags, so
-          # this <a> element is not a descendant of a <ref> tag
-          # so it should point to somewhere out of this document.
-          url = child.get('href')
-          render_chld = self._render(child)
-          if child.text:
-              txt = child.text + render_chld
-          else:
-              txt = render_chld
-          txt = txt.strip()
-          if len(txt) > 0:
-              output+='\\href{'+url+'}{'+txt+'}'
-          else:
-              output+='\\url{'+url+'}'
-          if 'attach_files' in self.options:
-              info = get_uri_info(url)
-              if info['filename']:
-                  output+='\\incfile{'+txt+'}{'+str(info['filename'])+'}{'+str(info['mimetype'])+'}'
-
+          # The text of the link (rendered with its contents) is needed
+          # as a whole, see _link
+          output.begin(lstrip=True, hold=True)
+          stack.append((_LINK, child))
+          stack.append((_RENDER, child, True))
       elif child.tag == 'img':
           fname = child.get('src')
           ext = ''
@@ -129,22 +317,45 @@ class laTeXRenderer(object):
               if fname[-i] == '.':
                   break
           base = fname[:-len(ext)]
-          if os.path.exists(base+'.pdf'):
+          self.dependencies[base+'.pdf'] = os.path.exists(base+'.pdf')
+          if self.dependencies[base+'.pdf']:
               fname = base+'.pdf'
-          output+='\\begin{center}\\includegraphics{'+fname+'}\\end{center}'
+          output.write('\\begin{center}\\includegraphics{'+fname+'}\\end{center}')
       elif child.tag == 'mathjax':
         self.math_mode=True
-        output+=self._render(child).strip()
-        self.math_mode=False
+        if len(child) == 0:
+          if not self._ignore_node(child):
+            output.write(self._escape(child.text).strip())
+          self.math_mode=False
+          return
+        output.begin(lstrip=True)
+        stack.append((_MATH_OFF,))
+        stack.append((_END_STRIP,))
+        stack.append((_RENDER, child, True))
       elif child.tag == 'ul':
-        output+='\\begin{itemize}\n  '+self._render(child).strip()+'\n\\end{itemize}'
+        self._wrap(child, '\\begin{itemize}\n  ', '\n\\end{itemize}', output, stack)
       elif child.tag == 'ol':
-        output+='\\begin{enumerate}\n  '+self._render(child).strip()+'\n\\end{enumerate}'
+        self._wrap(child, '\\begin{enumerate}\n  ', '\n\\end{enumerate}', output, stack)
       elif child.tag == 'li':
-        output+='  \\item '+self._render(child)
+        output.write('  \\item ')
+        stack.append((_RENDER, child, True))
       elif child.tag == 'blockquote':
-        output+='\\begin{quotation}\n  '+self._render(child).strip()+'\n\\end{quotation}'
+        self._wrap(child, '\\begin{quotation}\n  ', '\n\\end{quotation}', output, stack)
       else:
-        output+=self._render(child)
-      output +=self._escape(child.tail)
-    return output
+        stack.append((_RENDER, child, True))
+
+  def _link(self, child, txt, output):
+          # FIXME:
+          # Here we are relying on the fact that
+          # we have already processed <ref> tags, so
+          # this <a> element is not a descendant of a <ref> tag
+          # so it should point to somewhere out of this document.
+          url = child.get('href')
+          if len(txt) > 0:
+              output.write('\\href{'+url+'}{'+txt+'}')
+          else:
+              output.write('\\url{'+url+'}')
+          if 'attach_files' in self.options:
+              info = get_uri_info(url)
+              if info['filename']:
+                  output.write('\\incfile{'+txt+'}{'+str(info['filename'])+'}{'+str(info['mimetype'])+'}')
@@ -0,0 +1,215 @@
+'''
+Profiling of md.py
+==================
+
+Records the time spent (and the number of calls) in the stages of
+the pipeline and in the individual markdown processors and inline
+patterns. Profiling is enabled by calling start (md.py does this
+when given --profile); until then the hooks cost (almost) nothing:
+stage returns a shared no-op context manager and the processors of
+a markdown instance are only wrapped by instrument while profiling.
+
+For each name the report lists the number of calls, the total time
+(nested calls of the same name are counted once), the self time
+(the total time minus the time spent in other recorded names) and
+the peak RSS growth: how much (in KiB) the maximal resident set size
+of the process grew while in the name. This is not the memory
+allocated there; memory allocated and freed below an earlier peak
+is not counted at all.
+
+'''
+
+import json
+import resource
+import sys
+import time
+from functools import wraps
+
+# The active Profiler or None if profiling is disabled
+active = None
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_context = _NullContext()
+
+
+def _peak_rss():
+    """ Returns the maximal resident set size of the process in KiB """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+    return rss
+
+
+class _Record(object):
+    __slots__ = ['calls', 'time', 'self_time', 'peak_rss_growth', 'depth']
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.self_time = 0.0
+        self.peak_rss_growth = 0
+        self.depth = 0
+
+
+class _Frame(object):
+    __slots__ = ['record', 'start', 'children', 'peak_rss']
+
+    def __init__(self, record, peak_rss):
+        self.record = record
+        self.start = time.time()
+        self.children = 0.0
+        self.peak_rss = peak_rss
+
+
+class Profiler(object):
+    def __init__(self):
+        self.records = {}
+        self.stack = []
+
+    def enter(self, name):
+        record = self.records.get(name, None)
+        if record is None:
+            record = self.records[name] = _Record()
+        record.calls += 1
+        record.depth += 1
+        self.stack.append(_Frame(record, _peak_rss()))
+
+    def exit(self):
+        frame = self.stack.pop()
+        elapsed = time.time()-frame.start
+        record = frame.record
+        record.depth -= 1
+        record.self_time += elapsed-frame.children
+        if record.depth == 0:
+            record.time += elapsed
+            record.peak_rss_growth += _peak_rss()-frame.peak_rss
+        if self.stack:
+            self.stack[-1].children += elapsed
+
+    def stats(self):
+        """ Returns a dict mapping the recorded names to dicts
+            with the keys calls, time, self_time and peak_rss_growth_kib """
+        return dict([ (name, {'calls':r.calls, 'time':r.time, 'self_time':r.self_time, 'peak_rss_growth_kib':r.peak_rss_growth})
+                      for (name, r) in self.records.items() ])
+
+    def merge(self, stats):
+        """ Adds the @stats of another profiler (e.g. of a worker process) """
+        for (name, s) in stats.items():
+            record = self.records.get(name, None)
+            if record is None:
+                record = self.records[name] = _Record()
+            record.calls += s['calls']
+            record.time += s['time']
+            record.self_time += s['self_time']
+            record.peak_rss_growth = max(record.peak_rss_growth, s['peak_rss_growth_kib'])
+
+    def reset(self):
+        self.records = {}
+
+    def format_table(self):
+        lines = ['%-48s %8s %10s %10s %22s' % ('name', 'calls', 'time [s]', 'self [s]', 'peak RSS growth [KiB]')]
+        for (name, s) in sorted(self.stats().items(), key=lambda x: -x[1]['time']):
+            lines.append('%-48s %8d %10.4f %10.4f %22d' % (name[:48], s['calls'], s['time'], s['self_time'], s['peak_rss_growth_kib']))
+        return '\n'.join(lines)+'\n'
+
+    def format_json(self):
+        return json.dumps(self.stats(), indent=2, sort_keys=True)+'\n'
+
+
+class _Stage(object):
+    __slots__ = ['profiler', 'name']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.exit()
+        return False
+
+
+def start():
+    """ Enables profiling and returns the Profiler """
+    global active
+    if active is None:
+        active = Profiler()
+    return active
+
+
+def stop():
+    global active
+    active = None
+
+
+def stage(name):
+    """ Returns a context manager recording the time spent in its body under @name """
+    if active is None:
+        return _null_context
+    return _Stage(active, name)
+
+
+def _wrap(name, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = active
+        if profiler is None:
+            return func(*args, **kwargs)
+        profiler.enter(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.exit()
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+# The methods wrapped by instrument for each kind of markdown processor
+PROCESSOR_METHODS = [
+    ('preprocessors', 'preprocessor', ['run']),
+    ('parser.blockprocessors', 'blockprocessor', ['test', 'run']),
+    ('treeprocessors', 'treeprocessor', ['run']),
+    ('inlinePatterns', 'inlinepattern', ['handleMatch']),
+    ('postprocessors', 'postprocessor', ['run']),
+]
+
+
+def _registries(md):
+    for (attr, kind, methods) in PROCESSOR_METHODS:
+        registry = md
+        for part in attr.split('.'):
+            registry = getattr(registry, part)
+        yield registry, kind, methods
+
+
+def instrument(md):
+    """ Wraps the methods of the processors of the markdown instance
+        @md so that they are recorded by the active profiler. """
+    if active is None:
+        return
+    for (registry, kind, methods) in _registries(md):
+        for (name, processor) in registry.items():
+            for method in methods:
+                if method in processor.__dict__:
+                    continue
+                setattr(processor, method, _wrap(kind+':'+name+'.'+method, getattr(processor, method)))
+
+
+def uninstrument(md):
+    """ Removes the wrappers installed by instrument """
+    for (registry, kind, methods) in _registries(md):
+        for processor in registry.values():
+            for method in methods:
+                wrapper = processor.__dict__.get(method, None)
+                if wrapper is not None and hasattr(wrapper, '__wrapped__'):
+                    delattr(processor, method)
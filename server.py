@@ -0,0 +1,183 @@
+#!/usr/bin/python
+'''
+Render server for md.py
+=======================
+
+Keeps a warmed up md.py (imported markdown extensions, lxml, template
+system, ...) in memory and processes requests sent over a unix socket
+so that editor integrations do not pay the interpreter startup cost on
+every save. The socket is only accessible to the user running the
+server.
+
+
+Protocol
+--------
+
+The client connects, sends a single JSON object and shuts down the
+writing side of the connection. The object has the following keys:
+
+   argv  -- the list of md.py command line arguments
+   cwd   -- the directory relative to which the arguments are interpreted
+   stdin -- (optional) the document text when the document is given as '-'
+
+The server answers with a JSON object having the keys
+
+   status -- the exit status md.py would have
+   stdout -- what md.py would print to the standard output
+   stderr -- what md.py would print to the standard error
+
+and closes the connection. Requests using options which must not run
+in the server (see UNSUPPORTED_OPTIONS) are refused with the additional
+key unsupported set to true. Requests are processed one at a time, so
+the output is the same as that of the command line tool run with the
+same arguments in the same directory. See mdc.py for a client.
+
+'''
+
+import argparse
+import io
+import json
+import logging
+import os
+import stat
+import sys
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+import md
+from mdc import default_address
+
+logger = logging.getLogger(__name__)
+
+
+# The options (attribute names of the parsed arguments) which are not
+# processed by the server: --watch never returns and --renderoptions are
+# evaluated as python expressions
+UNSUPPORTED_OPTIONS = {'watch':'--watch', 'renderoptions':'--renderoptions'}
+
+
+class _Capture(object):
+    """ A file-like object collecting everything written to it as utf-8 """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, s):
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8')
+        self.chunks.append(s)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return b''.join(self.chunks).decode('utf-8', 'replace')
+
+
+def process_request(request):
+    """ Runs md.main with the arguments of the @request and returns
+        the response dict (see the module docstring) """
+    stdout, stderr = _Capture(), _Capture()
+    stdin = request.get('stdin', u'').encode('utf-8')
+    saved = sys.stdin, sys.stdout, sys.stderr, os.getcwd(), md.root_logger.level
+    handler = logging.StreamHandler(stderr)
+    md.root_logger.addHandler(handler)
+    status = 0
+    try:
+        sys.stdin, sys.stdout, sys.stderr = io.BytesIO(stdin), stdout, stderr
+        args = md.build_arg_parser().parse_args(request.get('argv', []))
+        for (attr, option) in sorted(UNSUPPORTED_OPTIONS.items()):
+            if getattr(args, attr):
+                stderr.write('md server: '+option+' is not supported by the server\n')
+                return {'status':2, 'stdout':'', 'stderr':stderr.getvalue(), 'unsupported':True}
+        os.chdir(request.get('cwd', saved[3]))
+        md.main(request.get('argv', []))
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            status = e.code
+        elif e.code is not None:
+            stderr.write(str(e.code)+'\n')
+            status = 1
+    except Exception as e:
+        logger.exception('Error processing request '+repr(request.get('argv')))
+        stderr.write('md server: '+str(e)+'\n')
+        status = 1
+    finally:
+        md.root_logger.removeHandler(handler)
+        md.root_logger.setLevel(saved[4])
+        sys.stdin, sys.stdout, sys.stderr = saved[:3]
+        os.chdir(saved[3])
+    return {
+        'status':status,
+        'stdout':stdout.getvalue(),
+        'stderr':stderr.getvalue()
+    }
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.read().decode('utf-8'))
+        except ValueError as e:
+            response = {'status':2, 'stdout':'', 'stderr':'md server: malformed request ('+str(e)+')\n'}
+        else:
+            response = process_request(request)
+        self.wfile.write(json.dumps(response).encode('utf-8'))
+
+
+class UnixServer(socketserver.UnixStreamServer):
+    def server_bind(self):
+        # Replace the socket left behind by a server which was killed,
+        # but never anything else
+        try:
+            if stat.S_ISSOCK(os.lstat(self.server_address).st_mode):
+                os.unlink(self.server_address)
+        except OSError:
+            pass
+        # The socket is created accessible to its owner only
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+
+def warm_up():
+    """ Renders a small document so that the markdown extensions and
+        the rest of the pipeline are imported before the first request """
+    md.render_md(u'# Warm up #\n\nTheorem: up {#warm}.\n{}\n\nSee {ref:#warm}.\n', tree='lxml')
+
+
+def serve(address):
+    server = UnixServer(address, RequestHandler)
+    warm_up()
+    logger.info('Serving on '+address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(address):
+            os.unlink(address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A render server for md.py')
+    parser.add_argument('-a', '--address', help='path of the unix socket to listen on (defaults to md-server.sock in $XDG_RUNTIME_DIR or in a private directory in the temporary directory)', default=None)
+    parser.add_argument('--verbose', '-v', action='count', help='be verbose', default=0)
+    args = parser.parse_args()
+    md.root_logger.setLevel(logging.FATAL-args.verbose*10)
+    try:
+        address = args.address or default_address(create=True)
+    except OSError as e:
+        logger.critical('Could not create the socket directory ('+str(e)+')')
+        exit(1)
+    try:
+        serve(address)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
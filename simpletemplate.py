@@ -0,0 +1,192 @@
+'''
+Built-in template engine
+========================
+
+Renders templates when neither Django nor Jinja2 is installed. Only
+the subset of the Django template language used by the default
+templates is supported:
+
+    {{ var }}               the value of var (escaped unless inside
+                            an autoescape off block), an empty string
+                            if it is missing
+    {{ 'text' }}            a literal string (not escaped)
+    {% if a or b %} ...
+    {% else %} ...
+    {% endif %}             conditions made of variables combined
+                            with not, and, or
+    {% autoescape off %} ... {% endautoescape %}
+    {# comment #}
+
+A template is compiled once into a tree of text segments, variables
+and blocks which is then rendered in a single pass.
+
+'''
+
+import re
+
+# Same tokenization as Django (tags do not span lines)
+TOKEN_RE = re.compile(r'({%.*?%}|{{.*?}}|{#.*?#})')
+LITERAL_RE = re.compile(r'''^(?:'([^']*)'|"([^"]*)")$''')
+
+
+class TemplateSyntaxError(Exception):
+    pass
+
+
+def escape(text):
+    """ Escapes @text for html the way Django does """
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&#39;')
+
+
+def to_text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if not isinstance(value, unicode):
+        return unicode(value)
+    return value
+
+
+class _Variable(object):
+    __slots__ = ['name', 'literal']
+
+    def __init__(self, expr):
+        m = LITERAL_RE.match(expr)
+        if m:
+            self.name = None
+            self.literal = m.group(1) if m.group(1) is not None else m.group(2)
+        elif re.match(r'^\w+$', expr, re.UNICODE):
+            self.name = expr
+            self.literal = None
+        else:
+            raise TemplateSyntaxError('Unsupported variable expression {{ '+expr+' }}')
+
+
+class _Condition(object):
+    """ A condition of an if tag: a disjunction of conjunctions
+        of (possibly negated) variables """
+    __slots__ = ['clauses']
+
+    def __init__(self, expr):
+        self.clauses = []
+        for clause in re.split(r'\s+or\s+', expr.strip()):
+            terms = []
+            for term in re.split(r'\s+and\s+', clause):
+                words = term.split()
+                negated = False
+                while words and words[0] == 'not':
+                    negated = not negated
+                    words = words[1:]
+                if len(words) != 1 or not re.match(r'^\w+$', words[0], re.UNICODE) or words[0] in ('and', 'or'):
+                    raise TemplateSyntaxError('Unsupported condition {% if '+expr+' %}')
+                terms.append((negated, words[0]))
+            self.clauses.append(terms)
+
+    def evaluate(self, context):
+        for terms in self.clauses:
+            for (negated, name) in terms:
+                if bool(context.get(name, None)) == negated:
+                    break
+            else:
+                return True
+        return False
+
+
+class _If(object):
+    __slots__ = ['condition', 'then_nodes', 'else_nodes']
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.then_nodes = []
+        self.else_nodes = None
+
+
+class _Autoescape(object):
+    __slots__ = ['enabled', 'nodes']
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.nodes = []
+
+
+class Template(object):
+    def __init__(self, source):
+        self.nodes = self._parse(source)
+
+    def _parse(self, source):
+        root = []
+        # Each item is the open block tag and the list its contents are appended to
+        stack = []
+        nodes = root
+        for (i, token) in enumerate(TOKEN_RE.split(source)):
+            if i % 2 == 0:
+                if token:
+                    nodes.append(token)
+            elif token.startswith('{#'):
+                continue
+            elif token.startswith('{{'):
+                nodes.append(_Variable(token[2:-2].strip()))
+            else:
+                words = token[2:-2].split(None, 1)
+                tag = words[0] if words else ''
+                arg = words[1] if len(words) > 1 else ''
+                if tag == 'if':
+                    block = _If(_Condition(arg))
+                    nodes.append(block)
+                    stack.append((tag, block))
+                    nodes = block.then_nodes
+                elif tag == 'autoescape':
+                    if arg.strip() not in ('on', 'off'):
+                        raise TemplateSyntaxError("The autoescape tag takes 'on' or 'off'")
+                    block = _Autoescape(arg.strip() == 'on')
+                    nodes.append(block)
+                    stack.append((tag, block))
+                    nodes = block.nodes
+                elif tag == 'else':
+                    if not stack or stack[-1][0] != 'if' or stack[-1][1].else_nodes is not None:
+                        raise TemplateSyntaxError('Unexpected {% else %}')
+                    block = stack[-1][1]
+                    block.else_nodes = []
+                    nodes = block.else_nodes
+                elif tag in ('endif', 'endautoescape'):
+                    if not stack or 'end'+stack[-1][0] != tag:
+                        raise TemplateSyntaxError('Unexpected {% '+tag+' %}')
+                    stack.pop()
+                    nodes = self._current_nodes(stack, root)
+                else:
+                    raise TemplateSyntaxError('Unsupported tag '+token)
+        if stack:
+            raise TemplateSyntaxError('Unclosed {% '+stack[-1][0]+' %}')
+        return root
+
+    def _current_nodes(self, stack, root):
+        if not stack:
+            return root
+        tag, block = stack[-1]
+        if tag == 'autoescape':
+            return block.nodes
+        if block.else_nodes is not None:
+            return block.else_nodes
+        return block.then_nodes
+
+    def render(self, context):
+        out = []
+        self._render(self.nodes, context, True, out)
+        return u''.join(out)
+
+    def _render(self, nodes, context, autoescape, out):
+        for node in nodes:
+            if isinstance(node, basestring):
+                out.append(node)
+            elif isinstance(node, _Variable):
+                if node.name is None:
+                    out.append(node.literal)
+                else:
+                    value = to_text(context.get(node.name, u''))
+                    out.append(escape(value) if autoescape else value)
+            elif isinstance(node, _If):
+                if node.condition.evaluate(context):
+                    self._render(node.then_nodes, context, autoescape, out)
+                elif node.else_nodes is not None:
+                    self._render(node.else_nodes, context, autoescape, out)
+            else:
+                self._render(node.nodes, context, node.enabled, out)
@@ -0,0 +1,84 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md
+import mdx_macros
+
+
+DOCUMENTS = {
+    'a.md':u'# First\n\nTheorem: The first document.\n{}\n',
+    'b.md':u'# Second\n\nThe *second* document.\n',
+    'c.md':u'# Third\n\n' + u'A longer third document.\n\n'*50,
+}
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        for fname, text in DOCUMENTS.items():
+            with open(fname, 'w') as f:
+                f.write(text.encode('utf-8'))
+
+    def tearDown(self):
+        mdx_macros.cache_directory = None
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def parse_args(self, options):
+        args = md.build_arg_parser().parse_args(['-j', '2', '--cachedir', 'cache'] + options + sorted(DOCUMENTS))
+        args.autooutput = True
+        return args
+
+    def test_outputs(self):
+        args = self.parse_args(['--nocache'])
+        failures = md.batch(sorted(DOCUMENTS), args, md.load_template(None, 'html'))
+        self.assertEqual(failures, [])
+        with open('a.html') as f:
+            self.assertIn('The first document.', f.read())
+        with open('b.html') as f:
+            self.assertIn('<em>second</em>', f.read())
+        self.assertTrue(os.path.exists('c.html'))
+
+    def test_failure(self):
+        args = self.parse_args(['--nocache'])
+        failures = md.batch(sorted(DOCUMENTS)+['missing.md'], args, md.load_template(None, 'html'))
+        # The failure is reported but the other documents are still processed
+        self.assertEqual([ fname for (fname, error) in failures ], ['missing.md'])
+        self.assertIn('IOError', failures[0][1])
+        for fname in sorted(DOCUMENTS):
+            self.assertTrue(os.path.exists(fname[:-3]+'.html'))
+
+    def test_cache_counters(self):
+        args = self.parse_args([])
+        render_cache = md.open_cache(args)
+        template = md.load_template(None, 'html')
+        md.batch(sorted(DOCUMENTS), args, template, render_cache)
+        self.assertEqual((render_cache.hits, render_cache.misses), (0, 3))
+        md.batch(sorted(DOCUMENTS), args, template, render_cache)
+        self.assertEqual((render_cache.hits, render_cache.misses), (3, 3))
+
+    def test_query(self):
+        args = self.parse_args(['--nocache', '-q', 'h1'])
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            failures = md.batch(sorted(DOCUMENTS), args, None)
+            lines = [ line for line in sys.stdout.getvalue().splitlines() if line ]
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(failures, [])
+        self.assertEqual(sorted(lines), ['a.md:text_content= 1First', 'b.md:text_content= 1Second', 'c.md:text_content= 1Third'])
+        self.assertFalse(os.path.exists('a.html'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.directory = os.path.join(self.base, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def open_cache(self, max_size):
+        render_cache = cache.RenderCache(self.directory, max_size)
+        self.listings = 0
+        entries = render_cache.entries
+        def counting_entries():
+            self.listings += 1
+            return entries()
+        render_cache.entries = counting_entries
+        return render_cache
+
+    def actual_size(self):
+        return sum([ size for (mtime, size, path) in cache.RenderCache(self.directory).entries() ])
+
+    def test_store(self):
+        render_cache = self.open_cache(1024*1024)
+        for i in range(50):
+            render_cache.put(cache.hash_strings([str(i)]), u'output '+str(i))
+        # Replacing an entry does not count it twice
+        render_cache.put(cache.hash_strings(['0']), u'a longer output 0')
+        self.assertEqual(render_cache.get(cache.hash_strings(['0'])), u'a longer output 0')
+        self.assertEqual(render_cache.total_size(), self.actual_size())
+        # The cache directory was listed only once
+        self.assertEqual(self.listings, 1)
+
+    def test_evict(self):
+        render_cache = self.open_cache(1000)
+        for i in range(100):
+            render_cache.put(cache.hash_strings([str(i)]), u'x'*100)
+            self.assertLessEqual(render_cache.total_size(), 1000)
+            self.assertEqual(render_cache.total_size(), self.actual_size())
+        self.assertEqual(render_cache.get(cache.hash_strings(['99'])), u'x'*100)
+        self.assertIsNone(render_cache.get(cache.hash_strings(['0'])))
+
+    def test_clear(self):
+        render_cache = self.open_cache(1024*1024)
+        render_cache.put(cache.hash_strings(['a']), u'output')
+        render_cache.clear()
+        self.assertEqual(render_cache.total_size(), 0)
+        self.assertEqual(self.actual_size(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
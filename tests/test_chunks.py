@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+
+import lxml.etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chunks
+import md
+
+
+LINK_DOCUMENT = u'''Intro with a [link][s].
+
+# One {#one}
+
+Theorem: See {ref:#two}. {#t1}
+{}
+
+[s]: http://example.com
+
+# Two {#two}
+
+Another [link][s] and {ref:#t1}.
+'''
+
+
+class ParallelRenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.min_chunk_size = chunks.MIN_CHUNK_SIZE
+        # Split at every top-level heading
+        chunks.MIN_CHUNK_SIZE = 0
+
+    def tearDown(self):
+        chunks.MIN_CHUNK_SIZE = self.min_chunk_size
+
+    def render(self, text, **kwargs):
+        return lxml.etree.tostring(md.render_md(text, tree='lxml', **kwargs)[1])
+
+    def test_link_reference_definition(self):
+        # The link reference definitions are repeated in each chunk
+        for (text, offset) in chunks.split_document(LINK_DOCUMENT):
+            self.assertIn('[s]: http://example.com', text)
+        serial = self.render(LINK_DOCUMENT)
+        self.assertIn('href="http://example.com"', serial)
+        self.assertEqual(self.render(LINK_DOCUMENT, jobs=2), serial)
+
+    def test_incremental(self):
+        sections = chunks.SectionCache()
+        self.assertEqual(self.render(LINK_DOCUMENT, sections=sections), self.render(LINK_DOCUMENT))
+        converted = sections.misses
+        # Only the edited section is converted again
+        edited = LINK_DOCUMENT.replace('Another', 'One more')
+        self.assertEqual(self.render(edited, sections=sections), self.render(edited))
+        self.assertEqual(sections.misses, converted+1)
+
+    def test_incremental_failure(self):
+        def fail(tasks, jobs):
+            raise RuntimeError('conversion failed')
+        convert_sections = md._convert_sections
+        md._convert_sections = fail
+        try:
+            self.assertEqual(self.render(LINK_DOCUMENT, sections=chunks.SectionCache()), self.render(LINK_DOCUMENT))
+        finally:
+            md._convert_sections = convert_sections
+
+
+if __name__ == '__main__':
+    unittest.main()
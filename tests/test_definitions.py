@@ -0,0 +1,89 @@
+import os
+import sys
+import unittest
+
+import markdown
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mdx_defs import DefinitionBlockExtension, DefinitionBlockProcessor
+
+
+BLOCKS = [
+    u'Theorem: A theorem.',
+    u'  Theorem* (Compactness) [Tychonoff]: A named theorem.\n{}',
+    u'Definition [Cantor] (A set): Swapped.',
+    u'Proof: A proof.',
+    u'Proof (of {ref:#compactness}): A proof of a theorem.',
+    u'Proof (of the lemma): A proof of a lemma.',
+    u'Proof [Someone]: Proofs have no references.',
+    u'theorem: Lowercase.',
+    u'THEOREM: Uppercase.',
+    u'Some text: with a colon.',
+    u'Text without a colon.',
+    u'[id]: http://example.com',
+    u'2 Theorem: A number.',
+    u'Theorem (unclosed: name.',
+    u'Example\n: on two lines.',
+    u'',
+]
+
+
+def reference_match(block):
+    """ The match_start result without the prefilter """
+    match = DefinitionBlockProcessor.START_RE.match(block)
+    if match and DefinitionBlockProcessor._valid_type(match.group('type'), match.groupdict()):
+        return match
+    return None
+
+
+class DefinitionMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        extension = DefinitionBlockExtension({})
+        self.markdown = markdown.Markdown(extensions=[extension])
+        self.processor = extension.processor
+        self.calls = []
+        def match_start(block):
+            self.calls.append(block)
+            return DefinitionBlockProcessor.match_start(block)
+        self.processor.match_start = match_start
+
+    def test_prefilter(self):
+        for block in BLOCKS:
+            expected = reference_match(block)
+            match = DefinitionBlockProcessor.match_start(block)
+            if expected is None:
+                self.assertIsNone(match, block)
+            else:
+                self.assertEqual(match.groupdict(), expected.groupdict(), block)
+        self.assertIsNotNone(DefinitionBlockProcessor.match_start(BLOCKS[1]))
+        self.assertIsNone(DefinitionBlockProcessor.match_start(BLOCKS[6]))
+
+    def test_cached_match(self):
+        parent = markdown.util.etree.Element('div')
+        block = u'Theorem: A theorem.'
+        match = self.processor.test_start_block(parent, block)
+        self.assertEqual(match.group('type'), 'Theorem')
+        # test and run are called with the same block
+        self.assertIs(self.processor.test(parent, block), match)
+        self.assertIs(self.processor.test_start_block(parent, block), match)
+        self.assertEqual(self.calls, [block])
+        # Another block (even with the same text) is matched again
+        self.assertIsNone(self.processor.test_start_block(parent, u'Some text.'))
+        self.assertIsNotNone(self.processor.test_start_block(parent, u''.join(block)))
+        self.assertEqual(len(self.calls), 3)
+        self.processor.reset()
+        self.processor.test_start_block(parent, block)
+        self.assertEqual(len(self.calls), 4)
+
+    def test_convert(self):
+        html = self.markdown.convert(u'Theorem: A theorem.\n\nSome text.\n\n{}\n\nProof: A proof.\n{}\n')
+        self.assertIn('class="block Theorem"', html)
+        self.assertIn('class="block Proof do_not_number"', html)
+        # Each block is matched once
+        self.assertEqual(len(self.calls), len(set(self.calls)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+
+import lxml.html
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md
+from utils import build_id_index, get_by_id
+
+
+DOCUMENT = '''<div>
+<div class="theorem" id="t1">A theorem using
+  <ref><a href="#d1">1</a></ref>, <ref><a href="#inner">2</a></ref>,
+  <ref><a href="#t2">3</a></ref>, <ref><a href="other.html#x">4</a></ref>
+  and <ref><a href="#missing">5</a></ref>.
+</div>
+<div class="definition" id="d1">A <span id="inner">definition</span>.</div>
+<div class="theorem" id="t2">Another theorem.</div>
+<div class="remark" id="r1">A remark <span id="d1">(a duplicate id)</span>.</div>
+</div>'''
+
+
+def ids(elements):
+    return [ e.get('id') for e in elements ]
+
+
+class IdIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = lxml.html.fromstring(DOCUMENT)
+
+    def test_index(self):
+        index = build_id_index(self.tree)
+        self.assertEqual(sorted(index), ['d1', 'inner', 'r1', 't1', 't2'])
+        # The first element in document order wins
+        self.assertEqual(index['d1'].get('class'), 'definition')
+        for id in ['d1', 'inner', 'r1', 't1', 't2', 'missing']:
+            self.assertIs(get_by_id(self.tree, id, index), get_by_id(self.tree, id))
+        self.assertIsNone(get_by_id(self.tree, 'missing', index))
+
+    def test_filter(self):
+        selected = list(md.filter('.theorem', self.tree))
+        self.assertEqual(ids(selected[:-1]), ['t1', 't2'])
+        references = selected[-1]
+        self.assertEqual(references.tag, 'references')
+        self.assertEqual(references[0].tag, 'h1')
+        # The definition is added once (with the span referenced inside it),
+        # the selected theorem, the other document and the missing id are not
+        self.assertEqual(ids(references[1:]), ['d1'])
+        self.assertEqual(references[1].get('class'), 'definition')
+        # The definition was moved out of the document
+        self.assertNotIn('d1', ids(self.tree))
+
+    def test_no_references(self):
+        selected = list(md.filter('.remark', self.tree))
+        self.assertEqual(ids(selected), ['r1'])
+        selected = list(md.filter('.theorem', self.tree, include_references=False))
+        self.assertEqual(ids(selected), ['t1', 't2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md
+from mdx_defs import headings_from_types
+
+
+# Fenced code and raw html are replaced by placeholders (starting with
+# markdown.util.STX) while parsing, which look like the start of a block
+PLACEHOLDER_DOCUMENT = u'''Intro
+
+```
+code
+```
+
+<div>
+raw
+</div>
+
+Theorem: A theorem.
+{}
+'''
+
+
+class BlockTypesTest(unittest.TestCase):
+
+    def test_placeholders_are_not_blocks(self):
+        renderer, tree = md.render_md(PLACEHOLDER_DOCUMENT, tree='lxml')
+        self.assertEqual(renderer.BlockTypes, set(['Theorem']))
+        self.assertEqual(tree.findtext('body/pre/code'), 'code\n')
+        self.assertEqual(tree.findtext('body/div'), '\nraw\n')
+        css = headings_from_types(renderer.BlockTypes, position='after', format='css')
+        self.assertIn('[type="Theorem"]', css)
+        self.assertNotIn('wzxhzdk', css)
+
+
+if __name__ == '__main__':
+    unittest.main()
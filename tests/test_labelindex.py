@@ -0,0 +1,123 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import labelindex
+import md
+
+
+DOCUMENT_A = u'''# Introduction
+
+We use {ref:#compactness} from the other lecture.
+'''
+
+DOCUMENT_B = u'''# Preliminaries
+
+# Compactness
+
+Theorem: A compact space. {#compactness}
+{}
+'''
+
+
+class LabelIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        self.write('a.md', DOCUMENT_A)
+        self.write('b.md', DOCUMENT_B)
+        self.args = md.build_arg_parser().parse_args(['--nocache', '-j', '1', '--labelindex', 'labels.json', 'a.md', 'b.md'])
+        # Count the documents converted to index their labels
+        self.converted = []
+        self.document_labels = md.document_labels
+        def document_labels(fname, args):
+            self.converted.append(fname)
+            return self.document_labels(fname, args)
+        md.document_labels = document_labels
+
+    def tearDown(self):
+        md.document_labels = self.document_labels
+        md.open_label_index(md.build_arg_parser().parse_args([]))
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def write(self, fname, text):
+        with open(fname, 'w') as f:
+            f.write(text.encode('utf-8'))
+
+    def update(self):
+        self.converted = []
+        index = md.open_label_index(self.args)
+        return index, md.update_label_index(index, ['a.md', 'b.md'], self.args)
+
+    def test_file_format(self):
+        index, changed = self.update()
+        self.assertEqual(changed, set(['compactness']))
+        with open('labels.json') as f:
+            data = json.load(f)
+        self.assertEqual(data['version'], labelindex.LabelIndex.VERSION)
+        self.assertEqual(sorted(data['documents']), ['a.md', 'b.md'])
+        self.assertEqual(data['documents']['a.md']['labels'], {})
+        self.assertEqual(data['documents']['b.md']['labels'], {'compactness':['2.1', '2.1']})
+        self.assertEqual(data['documents']['b.md']['fingerprint'], md.label_fingerprint(DOCUMENT_B, 'b.md', self.args))
+        self.assertEqual(labelindex.LabelIndex('labels.json').labels(exclude='a.md'), {'compactness':('b.md', '2.1', '2.1')})
+
+    def test_reference(self):
+        self.update()
+        md.main(['--nocache', '--labelindex', 'labels.json', '-o', 'a.html', 'a.md'])
+        with open('a.html') as f:
+            html = f.read()
+        self.assertIn('href="b.html#2.1">2.1</a>', html)
+        self.assertNotIn('??', html)
+
+    def test_incremental(self):
+        self.update()
+        self.assertEqual(sorted(self.converted), ['a.md', 'b.md'])
+        # Nothing changed
+        index, changed = self.update()
+        self.assertEqual(self.converted, [])
+        self.assertEqual(changed, set())
+        # Only B changed (and its label got another number)
+        self.write('b.md', u'# Before\n\n'+DOCUMENT_B)
+        index, changed = self.update()
+        self.assertEqual(self.converted, ['b.md'])
+        self.assertEqual(changed, set(['compactness']))
+        self.assertEqual(index.labels()['compactness'], ('b.md', '3.1', '3.1'))
+        # A removed document is dropped from the index
+        os.unlink('b.md')
+        index, changed = self.update()
+        self.assertEqual(self.converted, [])
+        self.assertEqual(index.documents(), ['a.md'])
+
+    def test_rebuild(self):
+        self.update()
+        with open('labels.json') as f:
+            data = json.load(f)
+        # A fingerprint mismatch converts the document again
+        data['documents']['a.md']['fingerprint'] = 'outdated'
+        with open('labels.json', 'w') as f:
+            json.dump(data, f)
+        self.update()
+        self.assertEqual(self.converted, ['a.md'])
+        # An index written by another version is rebuilt
+        data['version'] = labelindex.LabelIndex.VERSION+1
+        with open('labels.json', 'w') as f:
+            json.dump(data, f)
+        self.update()
+        self.assertEqual(sorted(self.converted), ['a.md', 'b.md'])
+        # So is an unreadable one
+        with open('labels.json', 'w') as f:
+            f.write('{')
+        self.update()
+        self.assertEqual(sorted(self.converted), ['a.md', 'b.md'])
+
+
+if __name__ == '__main__':
+    unittest.main()
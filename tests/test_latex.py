@@ -0,0 +1,115 @@
+import copy
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md
+import mdx_tolatex
+from mdx_tolatex import laTeXRenderer
+from postprocess import build_sections
+
+
+RAW_DOCUMENT = u'''Intro with <span>inline html</span>.
+
+```
+fenced code
+```
+
+<div>
+raw
+</div>
+
+Theorem: A theorem.
+{}
+
+<!-- a comment -->
+'''
+
+
+NESTED_PROOF = u'''Theorem: Outer.
+
+Proof: outer proof.
+
+Claim: Inner.
+{}
+
+Proof: inner.
+{}
+
+Done.
+{}
+{}
+'''
+
+
+def latex_tree(text):
+    return md.html_document([build_sections(md.render_md(text, tree='lxml')[1])])
+
+
+def render_latex(text):
+    return laTeXRenderer({}).render_from_dom(latex_tree(text))
+
+
+class LaTeXTest(unittest.TestCase):
+
+    def test_raw_blocks(self):
+        latex = render_latex(RAW_DOCUMENT)
+        self.assertNotIn(u'\x02', latex)
+        self.assertNotIn(u'\x03', latex)
+        self.assertNotIn('wzxhzdk', latex)
+        self.assertIn('fenced code', latex)
+        self.assertIn('inline html', latex)
+        self.assertEqual(latex.count('\\begin{theorem}'), 1)
+        self.assertEqual(latex.count('\\end{theorem}'), 1)
+
+    def test_emphasis(self):
+        latex = render_latex(u'Some *emph* and **strong** and *a **b** c*.')
+        self.assertIn('\\emph{emph}', latex)
+        self.assertIn('{\\bf strong}', latex)
+        self.assertIn('\\emph{a  {\\bf b} c}', latex)
+
+    def test_links(self):
+        latex = render_latex(u'A [link](http://example.com/a) and '
+                             u'[*em* link](http://example.com/b).')
+        self.assertIn('\\href{http://example.com/a}{link}', latex)
+        self.assertIn('\\href{http://example.com/b}{\\emph{em} link}', latex)
+        latex = render_latex(u'A [](http://example.com/c) link.')
+        self.assertIn('\\url{http://example.com/c}', latex)
+        self.assertNotIn('\\href', latex)
+
+    def test_nested_qed(self):
+        latex = render_latex(NESTED_PROOF)
+        self.assertEqual(latex.count('\\begin{proof}'), 2)
+        self.assertEqual(latex.count('\\end{proof}'), 2)
+        inner = latex.index('inner.')
+        self.assertLess(latex.index('\\begin{claim}'), inner)
+        self.assertEqual(latex.count('\\renewcommand{\\qedsymbol}'), 1)
+        self.assertLess(inner, latex.index('\\renewcommand{\\qedsymbol}'))
+        self.assertLess(latex.index('\\renewcommand{\\qedsymbol}'),
+                        latex.index('Done.'))
+
+    def test_escaping(self):
+        latex = render_latex(u'Math $a_1 + b_{2}$ and a_b & 50% \\\\ c.')
+        self.assertIn('$a_1 + b_{2}$', latex)
+        self.assertIn('a\\_b \\& 50\\%', latex)
+        self.assertIn('\\textbackslash{} c', latex)
+
+    def test_stream(self):
+        text = (RAW_DOCUMENT + NESTED_PROOF) * 20
+        tree = latex_tree(text)
+        expected = laTeXRenderer({}).render_from_dom(copy.deepcopy(tree))
+        flush = mdx_tolatex._Writer.FLUSH_FRAGMENTS
+        mdx_tolatex._Writer.FLUSH_FRAGMENTS = 1
+        try:
+            out = StringIO()
+            laTeXRenderer({}).render_from_dom(tree, out=out)
+        finally:
+            mdx_tolatex._Writer.FLUSH_FRAGMENTS = flush
+        self.assertEqual(out.getvalue(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
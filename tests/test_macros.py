@@ -0,0 +1,129 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mdx_macros
+
+
+DEFINITIONS = r'''\R = {\mathbb{R}};
+\norm(x) = {\|x\|};
+\ip(x,y=x) = {\langle x, y \rangle};
+\pair(a,b) = {(a,b)};
+\set(a) = {\{a\}};
+'''
+
+
+def expand(text, definitions=DEFINITIONS):
+    return mdx_macros.MacroExpander(mdx_macros.parse_macros(definitions)).expand(text)
+
+
+class MacroTest(unittest.TestCase):
+
+    def test_calls(self):
+        self.assertEqual(expand(r'$\R$'), r'$\mathbb{R}$')
+        self.assertEqual(expand(r'$\norm(v)$'), r'$\|v\|$')
+        self.assertEqual(expand(r'$\pair(1,2)$'), r'$(1,2)$')
+
+    def test_followed_by_letter(self):
+        self.assertEqual(expand(r'\Rn \R.'), r'\Rn \mathbb{R}.')
+        self.assertEqual(expand(r'\norm(x)y'), r'\norm(x)y')
+        self.assertEqual(expand(r'\pair(1,2)c'), r'\pair(1,2)c')
+        self.assertEqual(expand(r'\norm(x) y'), r'\|x\| y')
+        self.assertEqual(expand(r'\pair(1,2).'), r'(1,2).')
+
+    def test_defaults(self):
+        self.assertEqual(expand(r'\ip(a,b)'), r'\langle a, b \rangle')
+        # The default of y names the parameter x
+        self.assertEqual(expand(r'\ip(a)'), r'\langle a, a \rangle')
+
+    def test_argument_count(self):
+        self.assertEqual(expand(r'\pair(1)'), r'\pair(1)')
+        self.assertEqual(expand(r'\norm(1,2)'), r'\norm(1,2)')
+
+    def test_nested_arguments(self):
+        self.assertEqual(expand(r'\pair(f(x,y),{a,b})'), r'(f(x,y),{a,b})')
+        self.assertEqual(expand(r'\ip(\norm(v))'), r'\langle \|v\|, \|v\| \rangle')
+        self.assertEqual(expand(r'\norm(\pair(1,2))'), r'\|(1,2)\|')
+
+    def test_unbalanced(self):
+        self.assertEqual(expand(r'\norm(x'), r'\norm(x')
+        self.assertEqual(expand(r'\norm(x})'), r'\norm(x})')
+
+    def test_parameter_inside_control_sequence(self):
+        # The parameter a is not substituted in \{ ... \} nor in \langle
+        self.assertEqual(expand(r'\set(b)'), r'\{b\}')
+        self.assertEqual(expand(r'\f(1)', r'\f(a) = {\langle a \rangle};' + '\n'), r'\langle 1 \rangle')
+
+    def test_single_pass(self):
+        macros = mdx_macros.parse_macros(DEFINITIONS)
+        text = r'$\ip(\norm(\R), \pair(x,\R))$ and \set(\R) \norm(u)v \ip(w)'
+        self.assertEqual(mdx_macros.MacroExpander(macros).expand(text), mdx_macros.apply_sequentially(macros, text))
+
+    def test_recursion(self):
+        self.assertTrue(expand(r'\loop', r'\loop = {x\loop};' + '\n').startswith('xxx'))
+
+
+class MacroLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'library.tmd'), 'w') as f:
+            f.write('=== Abbreviations ===\n' + DEFINITIONS + '=== Abbreviations ===\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_import(self):
+        document = '=== Abbreviations ===\n\\import{library.tmd}\n\\Z = {\\mathbb{Z}};\n\n=== Abbreviations ===\n\n$\\R \\Z \\ip(a)$\n'
+        self.assertEqual(mdx_macros.pre_process(document, self.directory).strip(), r'$\mathbb{R} \mathbb{Z} \langle a, a \rangle$')
+
+
+class MacroCacheTest(unittest.TestCase):
+
+    DOCUMENT = u'=== Abbreviations ===\n' + DEFINITIONS + u'\n=== Abbreviations ===\n\n$\\ip(\\norm(\\R))$ \\set(a)\n'
+    EXPANDED = u'$\\langle \\|\\mathbb{R}\\|, \\|\\mathbb{R}\\| \\rangle$ \\{a\\}'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        mdx_macros.cache_directory = self.directory
+        mdx_macros._macro_sets.clear()
+
+    def tearDown(self):
+        mdx_macros.cache_directory = None
+        mdx_macros._macro_sets.clear()
+        shutil.rmtree(self.directory)
+
+    def expand(self):
+        # Not from the in-memory cache
+        mdx_macros._macro_sets.clear()
+        return mdx_macros.pre_process(self.DOCUMENT).strip()
+
+    def stored(self):
+        return [ os.path.join(self.directory, fname) for fname in os.listdir(self.directory) ]
+
+    def test_stored_as_json(self):
+        self.assertEqual(self.expand(), self.EXPANDED)
+        self.assertEqual(len(self.stored()), 1)
+        self.assertTrue(self.stored()[0].endswith('.json'))
+        # The stored set is used instead of parsing the definitions again
+        parse_macros = mdx_macros.parse_macros
+        mdx_macros.parse_macros = None
+        try:
+            self.assertEqual(self.expand(), self.EXPANDED)
+        finally:
+            mdx_macros.parse_macros = parse_macros
+
+    def test_invalid_file(self):
+        self.expand()
+        for data in ['{not json', '[{"name":"R"}]', '[{"name":"R","body":"","params":[],"required":0,"segments":[{}],"defaults":[]}]']:
+            with open(self.stored()[0], 'w') as f:
+                f.write(data)
+            self.assertEqual(self.expand(), self.EXPANDED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import codecs
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markdown.util import etree
+
+import md
+import mdtree
+from bench import nested_document
+from mdx_tolatex import laTeXRenderer
+from postprocess import build_sections
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ENVIRONMENT_RE = re.compile(r'\\(begin|end)\{([^}]*)\}')
+
+# Each level is an element, the document adds a few more (see mdtree.MAX_DEPTH)
+DEPTH = mdtree.MAX_DEPTH-10
+
+
+def blocks(element):
+    """ Returns the nested list of the types of the definition blocks in @element """
+    ret = []
+    stack = [(element, ret)]
+    while stack:
+        element, types = stack.pop()
+        for child in reversed(element):
+            if 'block' in (child.get('class') or '').split(' '):
+                nested = []
+                types.insert(0, (child.get('type'), nested))
+                stack.append((child, nested))
+            else:
+                stack.append((child, types))
+    return ret
+
+
+def block_depth(types):
+    ret = 0
+    stack = [(types, 0)]
+    while stack:
+        types, depth = stack.pop()
+        ret = max(ret, depth)
+        stack.extend([ (nested, depth+1) for (tp, nested) in types ])
+    return ret
+
+
+class NestingTest(unittest.TestCase):
+
+    def render(self, text):
+        tree = md.render_md(text, tree='lxml')[1]
+        # The LaTeX renderer gets (and changes) the tree
+        types = blocks(tree)
+        latex = laTeXRenderer({}).render_from_dom(md.html_document([build_sections(tree)]))
+        return types, latex
+
+    def assertBalanced(self, latex):
+        """ Checks that the LaTeX environments are properly nested and
+            returns their number """
+        stack = []
+        count = 0
+        for m in ENVIRONMENT_RE.finditer(latex):
+            if m.group(1) == 'begin':
+                stack.append(m.group(2))
+                count += 1
+            else:
+                self.assertTrue(stack, 'unexpected \\end{'+m.group(2)+'}')
+                self.assertEqual(stack.pop(), m.group(2))
+        self.assertEqual(stack, [])
+        return count
+
+    def test_nested_file(self):
+        with codecs.open(os.path.join(TESTS_DIR, 'nested.tmd'), 'r', encoding='utf-8') as f:
+            types, latex = self.render(f.read())
+        self.assertEqual(types, [('Defintion', [('Lemma', [])])])
+        self.assertEqual(self.assertBalanced(latex), 2)
+        self.assertLess(latex.index('\\begin{lemma}'), latex.index(u'Tady pokra\u010duje'))
+        self.assertLess(latex.index(u'Tady pokra\u010duje'), latex.index('\\end{defintion}'))
+
+    def test_deep_nesting(self):
+        # Each level is a claim followed by its proof containing the next level
+        types, latex = self.render(nested_document(DEPTH, width=1).decode('utf-8'))
+        self.assertEqual(block_depth(types), DEPTH)
+        level = types
+        for i in range(DEPTH-1):
+            self.assertEqual([ tp for (tp, nested) in level ], ['Claim', 'Proof'])
+            level = level[1][1]
+        self.assertEqual([ tp for (tp, nested) in level ], ['Claim', 'Proof'])
+        self.assertEqual(self.assertBalanced(latex), 2*DEPTH)
+        self.assertEqual(latex.count('The innermost argument.'), 1)
+
+    def test_too_deep(self):
+        self.assertRaises(mdtree.NestingTooDeep, md.render_md, nested_document(mdtree.MAX_DEPTH, width=1).decode('utf-8'), tree='lxml')
+
+    def test_numbering_walk(self):
+        # Deeper than the recursion limit
+        renderer = md.get_renderer()
+        root = etree.Element('div')
+        parent = root
+        for i in range(2*sys.getrecursionlimit()):
+            parent = etree.SubElement(parent, 'div')
+            parent.set('class', 'block')
+            parent.set('type', 'Theorem')
+            etree.SubElement(parent, 'label').set('key', 'l'+str(i))
+        etree.SubElement(parent, 'ref').set('key', 'l0')
+        renderer.treeprocessors['blocknumbering'].run(root)
+        self.assertEqual(root[0].get('id'), '0.1')
+        self.assertEqual(parent.get('id'), '0.'+str(2*sys.getrecursionlimit()))
+        self.assertEqual(parent.find('ref/a').text, '0.1')
+
+
+if __name__ == '__main__':
+    unittest.main()
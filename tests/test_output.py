@@ -0,0 +1,88 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md
+
+
+class WriteDocumentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.document = os.path.join(self.directory, 'doc.md')
+        self.output = os.path.join(self.directory, 'doc.html')
+        with open(self.document, 'w') as f:
+            f.write('Intro\n\n# Section\n\nTheorem: A theorem. {#t}\n{}\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self):
+        args = md.build_arg_parser().parse_args(['--nocache', '-o', self.output, self.document])
+        md.write_document(self.document, args, md.load_template(None, 'html'))
+
+    def test_write(self):
+        self.write()
+        with open(self.output) as f:
+            self.assertIn('A theorem.', f.read())
+        self.assertEqual(sorted(os.listdir(self.directory)), ['doc.html', 'doc.md'])
+        # The output gets the usual permissions, not those of a temporary file
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(self.output).st_mode & 0o777, 0o666 & ~umask)
+
+    def test_failure_keeps_output(self):
+        with open(self.output, 'w') as f:
+            f.write('previous')
+        def fail(*args):
+            raise RuntimeError('rendering failed')
+        render_document = md.render_document
+        md.render_document = fail
+        try:
+            self.assertRaises(RuntimeError, self.write)
+        finally:
+            md.render_document = render_document
+        with open(self.output) as f:
+            self.assertEqual(f.read(), 'previous')
+        self.assertEqual(sorted(os.listdir(self.directory)), ['doc.html', 'doc.md'])
+
+
+class LoadTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_relative_names(self):
+        # Templates with the same relative name and modification time
+        # in different directories
+        for name in ['one', 'two']:
+            os.mkdir(os.path.join(self.directory, name))
+            fname = os.path.join(self.directory, name, 'custom.html')
+            with open(fname, 'w') as f:
+                f.write('template '+name)
+            os.utime(fname, (1000000000, 1000000000))
+        for name in ['one', 'two', 'one']:
+            os.chdir(os.path.join(self.directory, name))
+            self.assertEqual(md.load_template('custom', 'html'), u'template '+name)
+
+    def test_missing_default(self):
+        template_candidates = md.template_candidates
+        md.template_candidates = lambda tpl, fmt: [ os.path.join(self.directory, 'missing.html') ]
+        try:
+            self.assertEqual(md.load_template(None, 'html'), '{{ content }}')
+            self.assertEqual(md.render_template(md.load_template(None, 'html'), {'content':u'text'}), u'text')
+        finally:
+            md.template_candidates = template_candidates
+
+
+if __name__ == '__main__':
+    unittest.main()
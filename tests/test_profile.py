@@ -0,0 +1,60 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md
+
+
+class ProfileOptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.document = os.path.join(self.directory, 'doc.md')
+        self.output = os.path.join(self.directory, 'doc.html')
+        with open(self.document, 'w') as f:
+            f.write('# Section\n\nSome *text*.\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_arguments(self):
+        parser = md.build_arg_parser()
+        args = parser.parse_args(['--profile', 'doc.md'])
+        self.assertTrue(args.profile)
+        self.assertEqual(args.profile_format, 'table')
+        self.assertEqual(args.document, ['doc.md'])
+        args = parser.parse_args(['--profile', '--profile-format', 'json', 'doc.md'])
+        self.assertEqual(args.profile_format, 'json')
+        self.assertEqual(args.document, ['doc.md'])
+
+    def profile(self, *options):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            md.main(['--nocache', '-o', self.output, '--profile']+list(options)+[self.document])
+            return sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+
+    def test_profile(self):
+        table = self.profile()
+        self.assertIn('markdown', table)
+        self.assertIn('peak RSS growth [KiB]', table)
+        stats = json.loads(self.profile('--profile-format', 'json'))
+        self.assertEqual(sorted(stats['markdown']), ['calls', 'peak_rss_growth_kib', 'self_time', 'time'])
+        with open(self.output) as f:
+            self.assertIn('Some <em>text</em>.', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markdown.util import etree
+
+import chunks
+import md
+from mdx_references import TOCNode
+
+
+NUMBERING_DOCUMENT = u'''A label before the first section {#intro}.
+
+# One
+
+Theorem: Labelled. {#t1}
+{}
+
+Lemma: Unlabelled.
+{}
+
+## One A
+
+Definition: Nested. {#d1}
+
+Claim: Inside the definition. {#c1}
+{}
+
+{}
+
+Theorem: Unlabelled with a label in its proof.
+{}
+
+Proof: The proof {#p1}.
+{}
+
+See {ref:#t1}, {ref:#d1}, {ref:#c1}, {ref:#p1}, {ref:#intro} and {ref:#missing}.
+
+# Two {#two}
+
+Theorem: Unlabelled.
+{}
+
+Theorem: Labelled. {#t2}
+{}
+
+See {ref:#t2} in {ref:#two}.
+'''
+
+
+def render(text, number_referenced_only=False):
+    return md.render_md(text, tree='lxml', ext_config={'references':{'number_referenced_only':number_referenced_only}})
+
+
+def blocks(tree):
+    """ Returns the list of the triples (type, id, number) of the blocks in @tree """
+    ret = []
+    for e in tree.iter():
+        if 'block' in (e.get('class') or '').split(' '):
+            numbers = [ n.text for n in e.iter() if n.get('class') == 'block_number' ]
+            ret.append((e.get('type'), e.get('id'), numbers[0] if numbers else None))
+    return ret
+
+
+def references(tree):
+    """ Returns the list of the pairs (text, href) of the references in @tree """
+    return [ (a.text, a.get('href')) for a in tree.iter('a') if a.get('class') == 'reference_number' ]
+
+
+class _Records(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class NumberingTest(unittest.TestCase):
+
+    def test_numbering(self):
+        records = _Records()
+        logger = logging.getLogger('mdx_references')
+        logger.addHandler(records)
+        # md.main sets the level of the root logger
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            renderer, tree = render(NUMBERING_DOCUMENT)
+        finally:
+            logger.setLevel(level)
+            logger.removeHandler(records)
+        self.assertEqual(records.messages, ["Undefined reference 'missing'"])
+        self.assertEqual(blocks(tree), [
+            ('Theorem', '1.1', '1.1'),
+            ('Lemma', '1.2', '1.2'),
+            ('Definition', '1.3', '1.3'),
+            ('Claim', '1.4', '1.4'),
+            ('Theorem', '1.5', '1.5'),
+            ('Proof', None, None),
+            ('Theorem', '2.1', '2.1'),
+            ('Theorem', '2.2', '2.2'),
+        ])
+        self.assertEqual(references(tree), [
+            ('1.1', '#1.1'), ('1.3', '#1.3'), ('1.4', '#1.4'), ('1.5', '#1.5'), ('sec0', '#sec0'), ('??', None),
+            ('2.2', '#2.2'), ('sec2', '#sec2'),
+        ])
+
+    def test_number_referenced_only(self):
+        # Only the blocks containing a label are numbered
+        renderer, tree = render(NUMBERING_DOCUMENT, number_referenced_only=True)
+        self.assertEqual(blocks(tree), [
+            ('Theorem', '1.1', '1.1'),
+            ('Lemma', None, None),
+            ('Definition', '1.2', '1.2'),
+            ('Claim', '1.3', '1.3'),
+            ('Theorem', None, None),
+            ('Proof', None, None),
+            ('Theorem', None, None),
+            ('Theorem', '2.1', '2.1'),
+        ])
+        self.assertIn('do_not_number', [ e.get('class') for e in tree.iter('div') if e.get('type') == 'Lemma' ][0])
+        # A label in a proof refers to the last numbered block, which
+        # here is the claim (the theorem of the proof is not numbered)
+        self.assertEqual(references(tree), [
+            ('1.1', '#1.1'), ('1.2', '#1.2'), ('1.3', '#1.3'), ('1.3', '#1.3'), ('sec0', '#sec0'), ('??', None),
+            ('2.1', '#2.1'), ('sec2', '#sec2'),
+        ])
+
+
+def toc_paths(toc):
+    """ Returns the list of the paths of the sections in the table of contents @toc """
+    return [ li.get('path') for li in toc.to_element().iter('li') ]
+
+
+def toc_document():
+    """ Returns a document with 12 sections, the 10th of which has 11 subsections
+        and a subsubsection, each containing a theorem """
+    out = []
+    for i in range(1, 13):
+        out.append('# Section '+str(i)+'\n\nTheorem: In '+str(i)+'.\n{}\n\n')
+        if i == 10:
+            for j in range(1, 12):
+                out.append('## Subsection '+str(j)+'\n\nTheorem: In 10.'+str(j)+'.\n{}\n\n')
+            out.append('### Subsubsection\n\nTheorem: Deep. {#deep}\n{}\n\nSee {ref:#deep}.\n\n')
+    return u''.join(out)
+
+
+class TOCTest(unittest.TestCase):
+
+    EXPECTED = [ str(i) for i in range(1, 10) ] + ['10'] + [ '10.'+str(j) for j in range(1, 12) ] + ['10.11.1', '11', '12']
+
+    def test_order(self):
+        renderer, tree = render(toc_document())
+        self.assertEqual(toc_paths(renderer.TOC), self.EXPECTED)
+        toc = renderer.TOC.to_element()
+        self.assertEqual([ span.text for span in toc.iter('span') if span.get('class') == 'section_number' ][9:12], ['10', '10.1', '10.2'])
+        self.assertEqual(toc.find('ul/li[10]/a').get('href'), '#sec10')
+        # The blocks are numbered within their top-level section
+        numbers = [ b[1] for b in blocks(tree) ]
+        self.assertEqual(numbers[9:12], ['10.1', '10.2', '10.3'])
+        self.assertEqual(numbers[-3:], ['10.13', '11.1', '12.1'])
+        self.assertEqual([ s.get('id') for s in tree.iter('span') if 'section_number' in (s.get('class') or '') ][-4:], ['sec10.11', 'sec10.11.1', 'sec11', 'sec12'])
+        self.assertEqual(references(tree), [('10.13', '#10.13')])
+
+    def test_insertion_order(self):
+        # Sections inserted out of order (e.g. from separately rendered chunks)
+        # are ordered by their numbers
+        toc = TOCNode(root=True)
+        for section in ['10', '9', '10.2', '10.10', '1', '10.1', (2,), '2.1']:
+            toc.insert_section(section, 'Title')
+        self.assertEqual(toc_paths(toc), ['1', '2', '2.1', '9', '10', '10.1', '10.2', '10.10'])
+
+    def test_parallel(self):
+        min_chunk_size = chunks.MIN_CHUNK_SIZE
+        chunks.MIN_CHUNK_SIZE = 0
+        try:
+            renderer = md.render_md(toc_document(), tree='lxml', jobs=2)[0]
+        finally:
+            chunks.MIN_CHUNK_SIZE = min_chunk_size
+        self.assertEqual(toc_paths(renderer.TOC), self.EXPECTED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import sys
+import unittest
+
+import markdown
+from markdown.util import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md
+import mdx_macros
+
+
+DOCUMENT_A = u'''Title: First
+Author: A. Author
+
+Intro with a footnote[^note] and some HTML.
+
+# Definitions {#defs}
+
+Definition: A *set* is a collection. {#set}
+{}
+
+Theorem: Every set is a set[^other]. {#thm}
+{}
+
+Proof: Obvious, see {ref:#set}.
+{}
+
+[^note]: The note.
+[^other]: Another note.
+
+*[HTML]: Hyper Text Markup Language
+'''
+
+DOCUMENT_B = u'''Title: Second
+
+An abbreviation: CSS, and a footnote[^b].
+
+# Results {#results}
+
+Lemma: A lemma with HTML. {#lemma}
+{}
+
+## Remarks
+
+Remark: See {ref:#lemma}.
+{}
+
+[^b]: The note of B.
+
+*[CSS]: Cascading Style Sheets
+'''
+
+
+def state(converter, html):
+    """ Returns everything a template gets from a conversion """
+    return {
+        'html':html,
+        'toc':etree.tostring(converter.TOC.to_element()),
+        'types':sorted(converter.BlockTypes),
+        'meta':converter.Meta,
+    }
+
+
+class ReuseTest(unittest.TestCase):
+
+    def fresh(self, text):
+        converter = markdown.Markdown(extensions=md.MD_EXTENSIONS)
+        return state(converter, converter.convert(mdx_macros.pre_process(text, '.')))
+
+    def reused(self, text):
+        converter, html = md.render_md(text)
+        return state(converter, html)
+
+    def test_reuse(self):
+        expected = [ self.fresh(text) for text in [DOCUMENT_A, DOCUMENT_B, DOCUMENT_A] ]
+        self.assertIn('fn:note', expected[0]['html'])
+        self.assertIn('<abbr title="Hyper Text Markup Language">HTML</abbr>', expected[0]['html'])
+        self.assertNotIn('Hyper Text', expected[1]['html'])
+        self.assertEqual(expected[1]['meta']['title'], ['Second'])
+        self.assertIn('Definitions', expected[0]['toc'])
+        self.assertIn('Theorem', expected[0]['types'])
+        for (text, state) in zip([DOCUMENT_A, DOCUMENT_B, DOCUMENT_A], expected):
+            got = self.reused(text)
+            for key in sorted(state):
+                self.assertEqual(got[key], state[key], key)
+        # The same instance was used for all the documents
+        self.assertTrue(md.render_md(DOCUMENT_B)[0] is md.render_md(DOCUMENT_A)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+class SelectorCacheTest(unittest.TestCase):
+
+    def test_reuse(self):
+        selectors = utils.SelectorCache(4)
+        sel = selectors.get('div.theorem')
+        self.assertIs(selectors.get('div.theorem'), sel)
+        self.assertEqual(selectors.stats(), {'hits':1, 'misses':1, 'size':1})
+
+    def test_evict(self):
+        selectors = utils.SelectorCache(3)
+        for selector in ['h1', 'h2', 'h3']:
+            selectors.get(selector)
+        # Using h1 makes h2 the least recently used selector
+        selectors.get('h1')
+        selectors.get('h4')
+        self.assertEqual(list(selectors.selectors), ['h3', 'h1', 'h4'])
+        self.assertEqual(selectors.stats(), {'hits':1, 'misses':4, 'size':3})
+        selectors.get('h2')
+        self.assertEqual(list(selectors.selectors), ['h1', 'h4', 'h2'])
+        self.assertEqual(selectors.misses, 5)
+
+    def test_bounded(self):
+        selectors = utils.SelectorCache(10)
+        for i in range(100):
+            selectors.get('#id%d' % i)
+            self.assertLessEqual(len(selectors.selectors), 10)
+        self.assertEqual(sorted(selectors.selectors), sorted([ '#id%d' % i for i in range(90, 100) ]))
+
+    def test_shared_cache(self):
+        self.assertIs(utils.css_selector('p.remark'), utils.selector_cache.get('p.remark'))
+
+
+if __name__ == '__main__':
+    unittest.main()
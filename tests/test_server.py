@@ -0,0 +1,107 @@
+import os
+import shutil
+import socket
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mdc
+import server
+
+
+class ProcessRequestTest(unittest.TestCase):
+
+    def test_render(self):
+        response = server.process_request({'argv':['-'], 'stdin':u'Some *text*.\n'})
+        self.assertEqual(response['status'], 0)
+        self.assertIn('Some <em>text</em>.', response['stdout'])
+        self.assertNotIn('unsupported', response)
+
+    def test_unsupported_options(self):
+        for argv in [['--watch', 'doc.md'], ['-w', 'doc.md'], ['--renderoptions', 'a=__import__("os")', 'doc.md']]:
+            response = server.process_request({'argv':argv})
+            self.assertEqual(response['status'], 2)
+            self.assertTrue(response['unsupported'])
+            self.assertIn('not supported', response['stderr'])
+
+
+class UnixServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, 'md.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_socket_mode(self):
+        for attempt in range(2):
+            # The second server replaces the stale socket of the first
+            srv = server.UnixServer(self.address, server.RequestHandler)
+            srv.server_close()
+            mode = os.lstat(self.address).st_mode
+            self.assertTrue(stat.S_ISSOCK(mode))
+            self.assertEqual(stat.S_IMODE(mode), 0o600)
+
+    def test_keeps_other_files(self):
+        with open(self.address, 'w') as f:
+            f.write('data')
+        self.assertRaises(Exception, server.UnixServer, self.address, server.RequestHandler)
+        with open(self.address) as f:
+            self.assertEqual(f.read(), 'data')
+
+
+class SocketDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = os.environ.pop('XDG_RUNTIME_DIR', None)
+        self.tempdir = tempfile.tempdir
+        tempfile.tempdir = self.directory
+        self.private = os.path.join(self.directory, 'md-server-'+str(os.getuid()))
+
+    def tearDown(self):
+        tempfile.tempdir = self.tempdir
+        if self.environ is not None:
+            os.environ['XDG_RUNTIME_DIR'] = self.environ
+        shutil.rmtree(self.directory)
+
+    def test_runtime_directory(self):
+        os.environ['XDG_RUNTIME_DIR'] = self.directory
+        try:
+            self.assertEqual(mdc.default_address(), os.path.join(self.directory, 'md-server.sock'))
+        finally:
+            del os.environ['XDG_RUNTIME_DIR']
+
+    def test_private_directory(self):
+        # The client does not create the directory
+        self.assertRaises(OSError, mdc.default_address)
+        address = mdc.default_address(create=True)
+        self.assertEqual(os.path.dirname(address), self.private)
+        self.assertEqual(stat.S_IMODE(os.lstat(self.private).st_mode), 0o700)
+        self.assertEqual(mdc.default_address(), address)
+
+    def test_shared_directory(self):
+        os.mkdir(self.private)
+        os.chmod(self.private, 0o777)
+        self.assertRaises(OSError, mdc.default_address, True)
+        os.rmdir(self.private)
+        os.symlink(self.directory, self.private)
+        self.assertRaises(OSError, mdc.default_address, True)
+
+    def test_check_socket(self):
+        address = os.path.join(self.directory, 'md.sock')
+        self.assertRaises(socket.error, mdc.request, address, ['-'])
+        with open(address, 'w') as f:
+            f.write('data')
+        self.assertRaises(socket.error, mdc.request, address, ['-'])
+        os.unlink(address)
+        server.UnixServer(address, server.RequestHandler).server_close()
+        mdc.check_socket(address)
+
+
+if __name__ == '__main__':
+    unittest.main()
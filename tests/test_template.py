@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import codecs
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md
+import simpletemplate
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONTEXT = {
+    'title':u'Compact <spaces> & "limits"',
+    'author':u'A. Author',
+    'email':u'author@example.com',
+    'date':u'2014',
+    'keywords':u'topology, compactness',
+    'subject':u'Topology',
+    'abstract':u'Every <em>compact</em> space is ...',
+    'content':u'<section><p>Theorem: A &amp; B čtverec.</p></section>',
+    'toc':u'<ul><li>One</li></ul>',
+    'headings':u'\\newtheorem{theorem}{Theorem}',
+    'headings_css':u'.block_heading[type="Theorem"]:after { content:"Theorem"; }',
+    'basename':u'compact',
+    'css_path':u'md.css',
+    'cdn':u'http://cdn.example.com',
+    'resources_location':u'../resources',
+    'fontsize':11,
+    'margin':u'2cm',
+    'pdf':u'',
+    'bib':u'refs.bib',
+}
+
+# A context without most of the optional variables
+SPARSE_CONTEXT = {'content':u'<p>Text</p>', 'toc':u'', 'headings':u'', 'headings_css':u''}
+
+
+def django_render(source, context):
+    md.load_template_system()
+    import django.template
+    return django.template.Template(source).render(django.template.Context(context))
+
+
+def render(source, context):
+    return simpletemplate.Template(source).render(context)
+
+
+class TemplateTest(unittest.TestCase):
+
+    def assertSameAsDjango(self, source, context):
+        try:
+            expected = django_render(source, context)
+        except ImportError:
+            self.skipTest('Django is not installed')
+        self.assertEqual(render(source, context), expected)
+
+    def test_default_templates(self):
+        for name in ['default-template.html', 'default-template.tex']:
+            with codecs.open(os.path.join(ROOT_DIR, name), 'r', encoding='utf-8') as f:
+                source = f.read()
+            self.assertSameAsDjango(source, CONTEXT)
+            self.assertSameAsDjango(source, SPARSE_CONTEXT)
+
+    def test_nested_if(self):
+        source = u'{% if a %}A{% if b %}B{% else %}not B{% endif %}{% else %}{% if not b %}neither{% else %}only B{% endif %}{% endif %}'
+        for (a, b) in [(True, True), (True, False), (False, True), (False, False)]:
+            self.assertSameAsDjango(source, {'a':a, 'b':b})
+        self.assertEqual(render(source, {'a':True, 'b':False}), u'Anot B')
+        self.assertEqual(render(source, {}), u'neither')
+
+    def test_conditions(self):
+        source = u'{% if a and not b or c %}yes{% else %}no{% endif %}'
+        for a in (0, 1):
+            for b in (0, 1):
+                for c in (0, 1):
+                    self.assertSameAsDjango(source, {'a':a, 'b':b, 'c':c})
+
+    def test_autoescape(self):
+        source = u'{{ x }}|{% autoescape off %}{{ x }}{% autoescape on %}|{{ x }}{% endautoescape %}{% endautoescape %}|{{ "<&>" }}'
+        context = {'x':u'<a href="x">&\'</a>'}
+        self.assertSameAsDjango(source, context)
+        self.assertEqual(render(source, context), u'&lt;a href=&quot;x&quot;&gt;&amp;&#39;&lt;/a&gt;|<a href="x">&\'</a>|&lt;a href=&quot;x&quot;&gt;&amp;&#39;&lt;/a&gt;|<&>')
+
+    def test_missing_variable(self):
+        source = u'[{{ missing }}]{# a comment #}'
+        self.assertSameAsDjango(source, {})
+        self.assertEqual(render(source, {}), u'[]')
+
+    def test_syntax_errors(self):
+        for source in [u'{% if a %}', u'{% endif %}', u'{% if a %}{% else %}{% else %}{% endif %}', u'{% for x in y %}{% endfor %}', u'{{ a.b }}', u'{% autoescape maybe %}{% endautoescape %}']:
+            self.assertRaises(simpletemplate.TemplateSyntaxError, simpletemplate.Template, source)
+
+
+if __name__ == '__main__':
+    unittest.main()
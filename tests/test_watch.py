@@ -0,0 +1,85 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md
+
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        os.mkdir('notes')
+        self.write('notes/a.md', 'First document.\n')
+        self.write('notes/b.md', 'Second document.\n')
+        self.args = md.build_arg_parser().parse_args(['-w', 'notes'])
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def write(self, fname, text, mtime=None):
+        with open(fname, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(fname, (mtime, mtime))
+
+    def snapshot(self, libraries=()):
+        return md._watch_snapshot(self.args, set(libraries))
+
+    def test_file_states(self):
+        self.write('notes/a.md', 'First document.\n', 1000)
+        states = md._file_states(['notes/a.md', 'missing.md'])
+        self.assertEqual(states, {'notes/a.md':(1000, 16), 'missing.md':None})
+
+    def test_dependencies(self):
+        documents, doc_states, dep_states = self.snapshot(['macros.md'])
+        self.assertEqual(documents, ['notes/a.md', 'notes/b.md'])
+        self.assertEqual(sorted(doc_states), documents)
+        dependencies = md.template_candidates(None, 'html')+['.md-substitutions', 'macros.md']
+        self.assertEqual(sorted(dep_states), sorted(dependencies))
+        self.assertIsNone(dep_states['.md-substitutions'])
+        self.assertIsNone(dep_states['macros.md'])
+        # The template of the format being compiled is watched
+        self.args.format = 'latex'
+        self.args.template = 'lecture'
+        self.assertIn(os.path.join('.', 'lecture.tex'), self.snapshot()[2])
+
+    def test_changed_document(self):
+        self.write('notes/a.md', 'First document.\n', 1000)
+        previous = self.snapshot()
+        self.assertEqual(md._changed_documents(previous[0], previous, previous), [])
+        self.write('notes/a.md', 'First document, changed.\n', 2000)
+        current = self.snapshot()
+        self.assertEqual(md._changed_documents(current[0], previous, current), ['notes/a.md'])
+
+    def test_new_and_removed_documents(self):
+        previous = self.snapshot()
+        self.write('notes/c.md', 'Third document.\n')
+        os.remove('notes/b.md')
+        current = self.snapshot()
+        self.assertEqual(current[0], ['notes/a.md', 'notes/c.md'])
+        self.assertEqual(md._changed_documents(current[0], previous, current), ['notes/c.md'])
+
+    def test_changed_dependency(self):
+        previous = self.snapshot(['macros.md'])
+        self.write('.md-substitutions', 'name=value\n')
+        current = self.snapshot(['macros.md'])
+        self.assertEqual(current[1], previous[1])
+        self.assertEqual(md._changed_documents(current[0], previous, current), ['notes/a.md', 'notes/b.md'])
+        self.write('macros.md', '{def:x}y{/def}\n')
+        changed = self.snapshot(['macros.md'])
+        self.assertEqual(md._changed_documents(changed[0], current, changed), ['notes/a.md', 'notes/b.md'])
+        self.write('default-template.html', '{{ content }}')
+        template = self.snapshot(['macros.md'])
+        self.assertEqual(md._changed_documents(template[0], changed, template), ['notes/a.md', 'notes/b.md'])
+
+
+if __name__ == '__main__':
+    unittest.main()
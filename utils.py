@@ -1,7 +1,42 @@
 import mimetypes
 import re
+from collections import OrderedDict
 from lxml.cssselect import CSSSelector
 
+
+class SelectorCache(object):
+    """ A bounded cache of compiled css selectors. When more than
+        @max_size selectors are cached, the least recently used
+        one is dropped. """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.selectors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, selector):
+        """ Returns the compiled CSSSelector for the css @selector """
+        sel = self.selectors.pop(selector,None)
+        if sel is None:
+            self.misses += 1
+            sel = CSSSelector(selector)
+            if len(self.selectors) >= self.max_size:
+                self.selectors.popitem(last=False)
+        else:
+            self.hits += 1
+        self.selectors[selector] = sel
+        return sel
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'size':len(self.selectors)}
+
+# The selector cache shared by all the code building css selectors
+selector_cache = SelectorCache()
+
+def css_selector(selector):
+    """ Returns the (cached) compiled CSSSelector for the css @selector """
+    return selector_cache.get(selector)
+
 def find_children_by_class(parent,cls):
     """ Returns a list of descendants of @parent having
         css class @cls in their class list """
@@ -13,17 +48,40 @@ def find_children_by_class(parent,cls):
         ret += find_children_by_class(ch,cls)
     return ret
 
+def get_child_by_class(parent,cls):
+    """ Returns the first child (not a deeper descendant) of @parent
+        having css class @cls in its class list or None """
+    for ch in parent:
+        if cls in (ch.get('class') or '').split(' '):
+            return ch
+    return None
+
 def get_child_by_css_selector(parent,selector):
-    sel = CSSSelector(selector)
+    sel = css_selector(selector)
     for ch in sel(parent):
         return ch
     return None
 
 
-def get_by_id( elements, id ):
+def build_id_index( elements ):
+    """ Returns a dict mapping each id to the element with that id which
+        is either in elements or a descendant of an element in elements
+        (the first one in document order, as found by get_by_id) """
+    index = {}
+    for e in elements:
+        for el in e.iter():
+            id = el.get('id',None)
+            if id is not None and id not in index:
+                index[id] = el
+    return index
+
+def get_by_id( elements, id, index = None ):
     """ Returns the element with id @id which is either in elements or
         a descendant of an element in elements. If there is no such element
-        returns None """
+        returns None. If an @index of elements (see build_id_index) is
+        given, the element is looked up in it instead. """
+    if index is not None:
+        return index.get(id,None)
     for e in elements:
         if e.get('id',None) == id:
             return e
@@ -35,7 +93,8 @@ def get_by_id( elements, id ):
 def section_level(node):
     """ Returns None if node is not a heading tag
         or the heading level """
-    if len(node.tag) != 2 or not node.tag.startswith('h'):
+    # Comments and processing instructions have no string tag
+    if not isinstance(node.tag, basestring) or len(node.tag) != 2 or not node.tag.startswith('h'):
       return None
     try:
       return int(node.tag[1])